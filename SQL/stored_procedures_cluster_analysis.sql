@@ -142,6 +142,142 @@ AND (
 );
 
 
+END$$
+
+
+CREATE PROCEDURE `create_cluster_indexed`()
+BEGIN
+# Alternative implementation of 'create_cluster' producing the same 'derived_cluster_meta', 'derived_cluster_comp'
+# and 'derived_cluster' tables. Each clonotype (donor, locus, V, J, CDR3 length) is addressed by a 16 byte MD5 key,
+# which is NULL if any of its components is NULL (the same rows that never match in 'create_cluster'). The cluster
+# components of each event are assigned by indexed key lookups, one locus at a time, and the final assignment joins
+# the cluster components with NULL-safe '<=>' comparisons over an index.
+#
+
+DROP TABLE IF EXISTS derived_cluster_meta, derived_cluster_comp, derived_cluster;
+DROP TEMPORARY TABLE IF EXISTS temp_table_cluster_comp, temp_table_cluster_key;
+
+CREATE TABLE derived_cluster_meta (
+	`cluster_comp_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+	`nodes` int(10) unsigned NOT NULL,
+	`donor_identifier` varchar(45) NOT NULL,
+	`locus` char(1) NOT NULL,
+	`segment_v` varchar(20),
+	`segment_j` varchar(20),
+	`cdr3_length` int(10) unsigned,
+	UNIQUE KEY `cluster_comp_id_UNIQUE` (`cluster_comp_id`)
+) AS
+SELECT
+	COUNT(DISTINCT event_id) AS nodes,
+	donor_identifier,
+	CAST('H' AS char(1)) AS locus,
+	igh_segment_v AS segment_v,
+	igh_segment_j AS segment_j,
+	LENGTH(igh_cdr3) AS cdr3_length
+FROM derived_segment_association
+GROUP BY donor_identifier, segment_v, segment_j, cdr3_length
+UNION
+SELECT
+	COUNT(DISTINCT event_id) AS nodes,
+	donor_identifier,
+	CAST('K' AS char(1)) AS locus,
+	igk_segment_v AS segment_v,
+	igk_segment_j AS segment_j,
+	LENGTH(igk_cdr3) AS cdr3_length
+FROM derived_segment_association
+GROUP BY donor_identifier, segment_v, segment_j, cdr3_length
+UNION
+SELECT
+	COUNT(DISTINCT event_id) AS nodes,
+	donor_identifier,
+	CAST('L' AS char(1)) AS locus,
+	igl_segment_v AS segment_v,
+	igl_segment_j AS segment_j,
+	LENGTH(igl_cdr3) AS cdr3_length
+FROM derived_segment_association
+GROUP BY donor_identifier, segment_v, segment_j, cdr3_length;
+
+CREATE TEMPORARY TABLE temp_table_cluster_key (
+	PRIMARY KEY (`cluster_key`)
+) AS
+SELECT
+	UNHEX(MD5(CONCAT(donor_identifier, CHAR(31), locus, CHAR(31), segment_v, CHAR(31), segment_j, CHAR(31), cdr3_length))) AS cluster_key,
+	cluster_comp_id
+FROM derived_cluster_meta
+WHERE segment_v IS NOT NULL
+	AND segment_j IS NOT NULL
+	AND cdr3_length IS NOT NULL;
+
+CREATE TEMPORARY TABLE temp_table_cluster_comp (
+	`event_id` int(10) unsigned NOT NULL,
+	`cluster_comp_heavy_id` int(10) unsigned,
+	`cluster_comp_kappa_id` int(10) unsigned,
+	`cluster_comp_lambda_id` int(10) unsigned,
+	KEY `heavy_key` (`heavy_key`),
+	KEY `kappa_key` (`kappa_key`),
+	KEY `lambda_key` (`lambda_key`)
+) AS
+SELECT
+	event_id,
+	UNHEX(MD5(CONCAT(donor_identifier, CHAR(31), 'H', CHAR(31), igh_segment_v, CHAR(31), igh_segment_j, CHAR(31), LENGTH(igh_cdr3)))) AS heavy_key,
+	UNHEX(MD5(CONCAT(donor_identifier, CHAR(31), 'K', CHAR(31), igk_segment_v, CHAR(31), igk_segment_j, CHAR(31), LENGTH(igk_cdr3)))) AS kappa_key,
+	UNHEX(MD5(CONCAT(donor_identifier, CHAR(31), 'L', CHAR(31), igl_segment_v, CHAR(31), igl_segment_j, CHAR(31), LENGTH(igl_cdr3)))) AS lambda_key
+FROM derived_segment_association;
+
+SET SQL_SAFE_UPDATES=0;
+
+UPDATE temp_table_cluster_comp
+INNER JOIN temp_table_cluster_key
+ON temp_table_cluster_comp.heavy_key = temp_table_cluster_key.cluster_key
+SET temp_table_cluster_comp.cluster_comp_heavy_id = temp_table_cluster_key.cluster_comp_id;
+
+UPDATE temp_table_cluster_comp
+INNER JOIN temp_table_cluster_key
+ON temp_table_cluster_comp.kappa_key = temp_table_cluster_key.cluster_key
+SET temp_table_cluster_comp.cluster_comp_kappa_id = temp_table_cluster_key.cluster_comp_id;
+
+UPDATE temp_table_cluster_comp
+INNER JOIN temp_table_cluster_key
+ON temp_table_cluster_comp.lambda_key = temp_table_cluster_key.cluster_key
+SET temp_table_cluster_comp.cluster_comp_lambda_id = temp_table_cluster_key.cluster_comp_id;
+
+# Equivalent to the INNER JOIN on the heavy cluster component in 'create_cluster'
+DELETE FROM temp_table_cluster_comp WHERE cluster_comp_heavy_id IS NULL;
+
+SET SQL_SAFE_UPDATES=1;
+
+CREATE TABLE derived_cluster_comp (
+	`cluster_id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+	`nodes` int(10) unsigned NOT NULL,
+	`cluster_comp_heavy_id` int(10) unsigned NOT NULL,
+	`cluster_comp_kappa_id` int(10) unsigned,
+	`cluster_comp_lambda_id` int(10) unsigned,
+	UNIQUE KEY `cluster_id_UNIQUE` (`cluster_id`),
+	KEY `cluster_comp` (`cluster_comp_heavy_id`, `cluster_comp_kappa_id`, `cluster_comp_lambda_id`)
+) AS
+SELECT
+	COUNT(DISTINCT event_id) AS nodes,
+	cluster_comp_heavy_id,
+	cluster_comp_kappa_id,
+	cluster_comp_lambda_id
+FROM temp_table_cluster_comp
+GROUP BY cluster_comp_heavy_id, cluster_comp_kappa_id, cluster_comp_lambda_id;
+
+CREATE TABLE derived_cluster (
+	`event_id` int(10) unsigned NOT NULL,
+	`cluster_id` int(10) unsigned NOT NULL
+) AS
+SELECT
+	temp_table_cluster_comp.event_id AS event_id,
+	derived_cluster_comp.cluster_id AS cluster_id
+FROM temp_table_cluster_comp
+INNER JOIN derived_cluster_comp
+ON temp_table_cluster_comp.cluster_comp_heavy_id = derived_cluster_comp.cluster_comp_heavy_id
+	AND temp_table_cluster_comp.cluster_comp_kappa_id <=> derived_cluster_comp.cluster_comp_kappa_id
+	AND temp_table_cluster_comp.cluster_comp_lambda_id <=> derived_cluster_comp.cluster_comp_lambda_id;
+
+DROP TEMPORARY TABLE IF EXISTS temp_table_cluster_comp, temp_table_cluster_key;
+
 END$$
 
 DELIMITER ;
@@ -1,8 +1,8 @@
 # Name			:	Stored Procedures for segment analysis
 # Author		:	Christian Busse
 # Maintainer	:	Christian Busse (christian.busse@dkfz-heidelberg.de)
-# Version:		:	0.2.1
-# Date			:	2016-03-19
+# Version:		:	0.3.1
+# Date			:	2026-10-18
 # License		:	AGPLv3
 # Description	:	This script generates several stored procedures to assist in the analysis of segment associations.
 #					Currently these are: 1) 'sub_temp_table_segment_association': Combines V, D and segments of all
@@ -12,10 +12,18 @@
 #					3) 'create_segment_view' which further combines this data to create a table containing
 #					associated/paired sequences based on identical event_id. Importantly, 'create_segments_view' does
 #					consider the functionality status of the sequences and will fall back to the secondary sequence of
-#					a given locus if the primary is non-functional.
+#					a given locus if the primary is non-functional. 4) 'create_segment_association_linear' is an
+#					alternative to 'create_segment_association' with identical output, which selects the functional
+#					CDR3 of all loci once via 'sub_table_functional_cdr3' and uses indexed intermediate tables.
+#					5) 'update_segment_association' which incrementally updates the tables created by
+#					'create_segment_association_linear' with the sequences loaded since its last run.
+#					6) 'sub_table_segment_association_unified', called by the procedures above, which stores one
+#					row per associated event with the light chain columns already resolved (kappa precedence) in
+#					the indexed table 'derived_segment_association_unified'.
 # Notes			:	ATTENTION: 1) 'create_segment_view' does its functionality assessment *ONLY* based on the presence
 #					of stop codons in the CDR3. 2) Runtime of the procedure seems to scale exponentially with the amount
 #					of data. While small data sets complete within minutes, large data sets can take several hours.
+#					For large data sets use 'create_segment_association_linear' instead.
 #					3) Be aware that 'sequences.consensus_rank' is NULL for Sanger sequences (this is handled correctly
 #					in the current implementation). 4) 'sub_temp_table_v_segment_replacement_mutations' masks the
 #					primer binding region with a fixed and identical length for all loci (currently the first 24 bp). It
@@ -69,14 +77,17 @@ END$$
 
 CREATE PROCEDURE `sub_temp_table_segment_association`()
 BEGIN
-# Create temporary tables containing the connected V(D)J joints.
+# Create temporary tables containing the connected V(D)J joints. The tables are indexed on seq_id when they
+# are created, so that the D and constant segments are added by indexed joins instead of nested loops.
 #
 
 # === Heavy ===
 
 DROP TABLE IF EXISTS temp_table_H_VDJ, temp_table_H_VJ, temp_table_H_D, temp_table_H_C;
 
-CREATE TEMPORARY TABLE temp_table_H_VJ AS (
+CREATE TEMPORARY TABLE temp_table_H_VJ (
+	INDEX `seq_id` (`seq_id`)
+) AS (
 	SELECT
 		v_segment.seq_id AS seq_id,
 		v_segment.name AS v_segment_name,
@@ -92,7 +103,9 @@ CREATE TEMPORARY TABLE temp_table_H_VJ AS (
 ALTER TABLE temp_table_H_VJ ADD COLUMN d_segment_name VARCHAR(20) AFTER v_segment_name;
 ALTER TABLE temp_table_H_VJ ADD COLUMN c_segment_name VARCHAR(20) AFTER j_segment_name;
 
-CREATE TEMPORARY TABLE temp_table_H_D AS (
+CREATE TEMPORARY TABLE temp_table_H_D (
+	INDEX `seq_id` (`seq_id`)
+) AS (
 	SELECT
 		seq_id,
 		`name` AS d_segment_name,
@@ -103,22 +116,15 @@ CREATE TEMPORARY TABLE temp_table_H_D AS (
 		AND igblast_rank=1
 );
 
-CREATE TEMPORARY TABLE temp_table_H_C AS (
-	SELECT
-		seq_id,
-		`name` AS c_segment_name
-	FROM constant_segments
-);
-
 SET SQL_SAFE_UPDATES=0;
 UPDATE temp_table_H_VJ, temp_table_H_D SET temp_table_H_VJ.d_segment_name = temp_table_H_D.d_segment_name
 WHERE temp_table_H_VJ.seq_id = temp_table_H_D.seq_id;
 
-UPDATE temp_table_H_VJ, temp_table_H_C SET temp_table_H_VJ.c_segment_name = temp_table_H_C.c_segment_name
-WHERE temp_table_H_VJ.seq_id = temp_table_H_C.seq_id;
+UPDATE temp_table_H_VJ INNER JOIN constant_segments ON temp_table_H_VJ.seq_id = constant_segments.seq_id
+SET temp_table_H_VJ.c_segment_name = constant_segments.`name`;
 SET SQL_SAFE_UPDATES=1;
 
-DROP TABLE IF EXISTS temp_table_H_D, temp_table_H_C;
+DROP TABLE IF EXISTS temp_table_H_D;
 
 ALTER TABLE temp_table_H_VJ RENAME temp_table_H_VDJ;
 
@@ -126,7 +132,9 @@ ALTER TABLE temp_table_H_VJ RENAME temp_table_H_VDJ;
 
 DROP TABLE IF EXISTS temp_table_K_VJ, temp_table_K_C;
 
-CREATE TEMPORARY TABLE temp_table_K_VJ AS (
+CREATE TEMPORARY TABLE temp_table_K_VJ (
+	INDEX `seq_id` (`seq_id`)
+) AS (
 	SELECT
 		v_segment.seq_id AS seq_id,
 		v_segment.name AS v_segment_name,
@@ -141,27 +149,20 @@ CREATE TEMPORARY TABLE temp_table_K_VJ AS (
 
 ALTER TABLE temp_table_K_VJ ADD COLUMN c_segment_name VARCHAR(20) AFTER j_segment_name;
 
-CREATE TEMPORARY TABLE temp_table_K_C AS (
-	SELECT
-		seq_id,
-		`name` AS c_segment_name
-	FROM constant_segments
-);
-
 SET SQL_SAFE_UPDATES=0;
 
-UPDATE temp_table_K_VJ, temp_table_K_C SET temp_table_K_VJ.c_segment_name = temp_table_K_C.c_segment_name
-WHERE temp_table_K_VJ.seq_id = temp_table_K_C.seq_id;
+UPDATE temp_table_K_VJ INNER JOIN constant_segments ON temp_table_K_VJ.seq_id = constant_segments.seq_id
+SET temp_table_K_VJ.c_segment_name = constant_segments.`name`;
 
 SET SQL_SAFE_UPDATES=1;
 
-DROP TABLE IF EXISTS temp_table_K_C;
-
 # === Lambda ===
 
 DROP TABLE IF EXISTS temp_table_L_VJ, temp_table_L_C;
 
-CREATE TEMPORARY TABLE temp_table_L_VJ AS (
+CREATE TEMPORARY TABLE temp_table_L_VJ (
+	INDEX `seq_id` (`seq_id`)
+) AS (
 	SELECT
 		v_segment.seq_id AS seq_id,
 		v_segment.name AS v_segment_name,
@@ -176,21 +177,12 @@ CREATE TEMPORARY TABLE temp_table_L_VJ AS (
 
 ALTER TABLE temp_table_L_VJ ADD COLUMN c_segment_name VARCHAR(20) AFTER j_segment_name;
 
-CREATE TEMPORARY TABLE temp_table_L_C AS (
-	SELECT
-		seq_id,
-		`name` AS c_segment_name
-	FROM constant_segments
-);
-
 SET SQL_SAFE_UPDATES=0;
 
-UPDATE temp_table_L_VJ, temp_table_L_C SET temp_table_L_VJ.c_segment_name = temp_table_L_C.c_segment_name
-WHERE temp_table_L_VJ.seq_id = temp_table_L_C.seq_id;
+UPDATE temp_table_L_VJ INNER JOIN constant_segments ON temp_table_L_VJ.seq_id = constant_segments.seq_id
+SET temp_table_L_VJ.c_segment_name = constant_segments.`name`;
 
 SET SQL_SAFE_UPDATES=1;
-
-DROP TABLE IF EXISTS temp_table_L_C;
 END$$
 
 
@@ -421,6 +413,715 @@ CREATE TABLE derived_segment_association ENGINE=MYISAM AS (
 		AND sort.sample_id = sample.sample_id
 );
 
+CALL sub_table_segment_association_unified;
+
+END$$
+
+
+CREATE PROCEDURE `sub_table_functional_cdr3`()
+BEGIN
+# Create a table containing the CDR3 of the functional sequence of each event and locus. A sequence is
+# selected if its CDR3 contains no stop codon and no other such sequence of the same event and locus has
+# a lower consensus_rank. This is the same selection as the group-wise minimum in 'create_segment_association',
+# but computed once for all loci with a GROUP BY on an indexed table instead of a LEFT JOIN of each locus
+# onto itself. Sequences with a NULL consensus_rank (Sanger) or NULL event_id are always selected, as in the
+# original implementation.
+#
+
+DROP TABLE IF EXISTS derived_functional_cdr3;
+DROP TEMPORARY TABLE IF EXISTS temp_table_functional_cdr3, temp_table_functional_cdr3_min;
+
+CREATE TEMPORARY TABLE temp_table_functional_cdr3 (
+	KEY `event_locus` (`event_id`, `locus`)
+) AS
+SELECT
+	sequences.event_id,
+	sequences.seq_id,
+	sequences.locus,
+	sequences.consensus_rank,
+	CDR_FWR.prot_seq
+FROM sequences
+INNER JOIN CDR_FWR
+ON sequences.seq_id=CDR_FWR.seq_id
+WHERE locus IN ('H', 'K', 'L')
+	AND region='CDR3'
+	AND stop_codon=0;
+
+CREATE TEMPORARY TABLE temp_table_functional_cdr3_min (
+	PRIMARY KEY (`event_id`, `locus`)
+) AS
+SELECT
+	event_id,
+	locus,
+	MIN(consensus_rank) AS consensus_rank
+FROM temp_table_functional_cdr3
+WHERE event_id IS NOT NULL
+	AND consensus_rank IS NOT NULL
+GROUP BY event_id, locus;
+
+CREATE TABLE derived_functional_cdr3 (
+	KEY `event_id` (`event_id`),
+	KEY `seq_id` (`seq_id`),
+	KEY `locus` (`locus`)
+) ENGINE=MYISAM AS
+SELECT
+	temp_table_functional_cdr3.event_id,
+	temp_table_functional_cdr3.seq_id,
+	temp_table_functional_cdr3.locus,
+	temp_table_functional_cdr3.prot_seq
+FROM temp_table_functional_cdr3
+LEFT JOIN temp_table_functional_cdr3_min
+ON temp_table_functional_cdr3.event_id = temp_table_functional_cdr3_min.event_id
+	AND temp_table_functional_cdr3.locus = temp_table_functional_cdr3_min.locus
+WHERE temp_table_functional_cdr3.consensus_rank IS NULL
+	OR temp_table_functional_cdr3_min.consensus_rank IS NULL
+	OR temp_table_functional_cdr3.consensus_rank = temp_table_functional_cdr3_min.consensus_rank;
+
+DROP TEMPORARY TABLE IF EXISTS temp_table_functional_cdr3, temp_table_functional_cdr3_min;
+END$$
+
+
+CREATE PROCEDURE `create_segment_association_linear`()
+BEGIN
+# Alternative implementation of 'create_segment_association' producing the same 'derived_segment_association'
+# table. The functional CDR3 selection is taken from 'derived_functional_cdr3' (see 'sub_table_functional_cdr3')
+# and all intermediate tables are indexed on seq_id, so that runtime scales roughly linearly with the amount of data.
+# Unlike 'create_segment_association', an existing 'derived_segment_association' table is replaced.
+#
+CALL sub_temp_table_v_segment_replacement_mutations;
+CALL sub_temp_table_segment_association;
+CALL sub_table_functional_cdr3;
+
+ALTER TABLE derived_mutations_replacement ADD INDEX `seq_id` (`seq_id`);
+
+DROP TABLE IF EXISTS derived_segment_association;
+CREATE TABLE derived_segment_association ENGINE=MYISAM AS (
+	SELECT
+		`event`.event_id,
+		`event`.plate,
+		`event`.well,
+		donor.donor_identifier,
+		sample.tissue,
+		sort.population,
+		sort.antigen,
+		temp_associated.igh_segment_v,
+		temp_associated.igh_segment_d,
+		temp_associated.igh_segment_j,
+		temp_associated.igh_cdr3,
+		temp_associated.igh_segment_c,
+		temp_associated.igh_shm,
+		temp_associated.igk_segment_v,
+		temp_associated.igk_segment_j,
+		temp_associated.igk_cdr3,
+		temp_associated.igk_segment_c,
+		temp_associated.igk_shm,
+		temp_associated.igl_segment_v,
+		temp_associated.igl_segment_j,
+		temp_associated.igl_cdr3,
+		temp_associated.igl_segment_c,
+		temp_associated.igl_shm
+	FROM (
+		SELECT
+			temp_heavy.event_id			AS igh_segment_event_id,
+			temp_heavy.v_segment_name	AS igh_segment_v,
+			temp_heavy.d_segment_name	AS igh_segment_d,
+			temp_heavy.j_segment_name	AS igh_segment_j,
+			temp_heavy.CDR3				AS igh_cdr3,
+			temp_heavy.c_segment_name	AS igh_segment_c,
+			temp_heavy.repl_mutations	AS igh_shm,
+			temp_kappa.v_segment_name	AS igk_segment_v,
+			temp_kappa.j_segment_name	AS igk_segment_j,
+			temp_kappa.CDR3				AS igk_cdr3,
+			temp_kappa.c_segment_name	AS igk_segment_c,
+			temp_kappa.repl_mutations	AS igk_shm,
+			temp_lambda.v_segment_name	AS igl_segment_v,
+			temp_lambda.j_segment_name	AS igl_segment_j,
+			temp_lambda.CDR3			AS igl_cdr3,
+			temp_lambda.c_segment_name	AS igl_segment_c,
+			temp_lambda.repl_mutations	AS igl_shm
+		FROM (
+			SELECT
+				sequences.event_id,
+				temp_table_H_VDJ.v_segment_name,
+				temp_table_H_VDJ.d_segment_name,
+				temp_table_H_VDJ.j_segment_name,
+				CDR.prot_seq AS CDR3,
+				temp_table_H_VDJ.c_segment_name,
+				derived_mutations_replacement.repl_mutations
+			FROM temp_table_H_VDJ
+			INNER JOIN derived_functional_cdr3 AS CDR
+			INNER JOIN sequences
+			INNER JOIN derived_mutations_replacement
+			ON temp_table_H_VDJ.seq_id = CDR.seq_id
+				AND CDR.locus = 'H'
+				AND temp_table_H_VDJ.seq_id = sequences.seq_id
+				AND temp_table_H_VDJ.seq_id = derived_mutations_replacement.seq_id
+		) AS temp_heavy
+		LEFT OUTER JOIN (
+			SELECT
+				sequences.event_id,
+				sequences.consensus_rank,
+				temp_table_K_VJ.v_segment_name,
+				temp_table_K_VJ.j_segment_name,
+				CDR.prot_seq AS CDR3,
+				temp_table_K_VJ.c_segment_name,
+				derived_mutations_replacement.repl_mutations
+			FROM temp_table_K_VJ
+			INNER JOIN derived_functional_cdr3 AS CDR
+			INNER JOIN sequences
+			INNER JOIN derived_mutations_replacement
+			ON temp_table_K_VJ.seq_id = CDR.seq_id
+				AND CDR.locus = 'K'
+				AND temp_table_K_VJ.seq_id = sequences.seq_id
+				AND temp_table_K_VJ.seq_id = derived_mutations_replacement.seq_id
+		) AS temp_kappa
+		ON temp_heavy.event_id = temp_kappa.event_id
+		LEFT OUTER JOIN (
+			SELECT
+				sequences.event_id,
+				sequences.consensus_rank,
+				temp_table_L_VJ.v_segment_name,
+				temp_table_L_VJ.j_segment_name,
+				CDR.prot_seq AS CDR3,
+				temp_table_L_VJ.c_segment_name,
+				derived_mutations_replacement.repl_mutations
+			FROM temp_table_L_VJ
+			INNER JOIN derived_functional_cdr3 AS CDR
+			INNER JOIN sequences
+			INNER JOIN derived_mutations_replacement
+			ON temp_table_L_VJ.seq_id = CDR.seq_id
+				AND CDR.locus = 'L'
+				AND temp_table_L_VJ.seq_id = sequences.seq_id
+				AND temp_table_L_VJ.seq_id = derived_mutations_replacement.seq_id
+		) AS temp_lambda
+		ON temp_heavy.event_id = temp_lambda.event_id
+		WHERE temp_kappa.v_segment_name IS NOT NULL
+			OR temp_lambda.v_segment_name IS NOT NULL
+	) AS temp_associated
+	INNER JOIN `event`
+	INNER JOIN sort
+	INNER JOIN sample
+	INNER JOIN donor
+	ON `event`.event_id = temp_associated.igh_segment_event_id
+		AND sample.donor_id = donor.donor_id
+		AND `event`.sort_id = sort.sort_id
+		AND sort.sample_id = sample.sample_id
+);
+
+ALTER TABLE derived_segment_association ADD INDEX `event_id` (`event_id`);
+
+CALL sub_table_segment_association_unified;
+
+CREATE TABLE IF NOT EXISTS derived_watermark (
+	`table_name` varchar(64) NOT NULL,
+	`max_seq_id` int(10) unsigned NOT NULL,
+	PRIMARY KEY (`table_name`)
+);
+REPLACE INTO derived_watermark (table_name, max_seq_id)
+SELECT 'derived_mutations_replacement', IFNULL(MAX(seq_id), 0) FROM derived_mutations_replacement;
+REPLACE INTO derived_watermark (table_name, max_seq_id)
+SELECT 'derived_segment_association', IFNULL(MAX(seq_id), 0) FROM derived_mutations_replacement;
+
+END$$
+
+
+CREATE PROCEDURE `sub_table_v_segment_replacement_mutations_delta`()
+BEGIN
+# Add the replacement mutation counts of all sequences with @last_seq_id < seq_id <= @max_seq_id to
+# 'derived_mutations_replacement'. Counts only depend on the sequence itself, so existing rows stay valid.
+#
+
+SET @length_primer = 24;
+
+DELETE FROM derived_mutations_replacement WHERE seq_id > @last_seq_id AND seq_id <= @max_seq_id;
+
+INSERT INTO derived_mutations_replacement (seq_id, repl_mutations)
+	SELECT
+		sequences.seq_id,
+		IFNULL(repl_mutations,0) AS repl_mutations
+	FROM sequences
+	LEFT OUTER JOIN (
+		SELECT seq_id, SUM(real_replacement) AS repl_mutations
+		FROM (
+			SELECT *
+			FROM (
+				SELECT
+					mutations.*,
+					(replacement + silent) AS real_replacement,
+					(@length_primer + query_start - germline_start) AS non_temp_start,
+					CDR_FWR.end AS fwr3_end
+				FROM mutations
+				INNER JOIN igblast_alignment
+				INNER JOIN CDR_FWR
+				ON mutations.seq_id=igblast_alignment.seq_id
+					AND mutations.seq_id=CDR_FWR.seq_id
+				WHERE germline_start <= query_start
+					AND CDR_FWR.region='FR3'
+					AND mutations.seq_id > @last_seq_id
+					AND mutations.seq_id <= @max_seq_id
+			) AS mutations_plus_cutoff
+			WHERE position_codonstart_on_seq >= non_temp_start
+				AND position_codonstart_on_seq < fwr3_end
+		) AS mutations_filtered
+		WHERE insertion=0 AND deletion=0 AND stop_codon_germline=0
+		GROUP BY seq_id
+	) AS mutations_aggregated
+	ON sequences.seq_id=mutations_aggregated.seq_id
+	WHERE sequences.seq_id > @last_seq_id
+		AND sequences.seq_id <= @max_seq_id;
+
+END$$
+
+
+CREATE PROCEDURE `sub_table_functional_cdr3_delta`()
+BEGIN
+# Recompute the rows of 'derived_functional_cdr3' for all events in 'temp_table_delta_events' and add
+# sequences without event_id with @last_seq_id < seq_id <= @max_seq_id. See 'sub_table_functional_cdr3'.
+#
+
+DROP TEMPORARY TABLE IF EXISTS temp_table_functional_cdr3, temp_table_functional_cdr3_min;
+
+DELETE derived_functional_cdr3
+FROM derived_functional_cdr3
+INNER JOIN temp_table_delta_events
+ON derived_functional_cdr3.event_id = temp_table_delta_events.event_id;
+
+CREATE TEMPORARY TABLE temp_table_functional_cdr3 (
+	KEY `event_locus` (`event_id`, `locus`)
+) AS
+SELECT
+	sequences.event_id,
+	sequences.seq_id,
+	sequences.locus,
+	sequences.consensus_rank,
+	CDR_FWR.prot_seq
+FROM sequences
+INNER JOIN CDR_FWR
+INNER JOIN temp_table_delta_events
+ON sequences.seq_id=CDR_FWR.seq_id
+	AND sequences.event_id = temp_table_delta_events.event_id
+WHERE locus IN ('H', 'K', 'L')
+	AND region='CDR3'
+	AND stop_codon=0
+UNION ALL
+SELECT
+	sequences.event_id,
+	sequences.seq_id,
+	sequences.locus,
+	sequences.consensus_rank,
+	CDR_FWR.prot_seq
+FROM sequences
+INNER JOIN CDR_FWR
+ON sequences.seq_id=CDR_FWR.seq_id
+WHERE sequences.event_id IS NULL
+	AND sequences.seq_id > @last_seq_id
+	AND sequences.seq_id <= @max_seq_id
+	AND locus IN ('H', 'K', 'L')
+	AND region='CDR3'
+	AND stop_codon=0;
+
+CREATE TEMPORARY TABLE temp_table_functional_cdr3_min (
+	PRIMARY KEY (`event_id`, `locus`)
+) AS
+SELECT
+	event_id,
+	locus,
+	MIN(consensus_rank) AS consensus_rank
+FROM temp_table_functional_cdr3
+WHERE event_id IS NOT NULL
+	AND consensus_rank IS NOT NULL
+GROUP BY event_id, locus;
+
+INSERT INTO derived_functional_cdr3 (event_id, seq_id, locus, prot_seq)
+SELECT
+	temp_table_functional_cdr3.event_id,
+	temp_table_functional_cdr3.seq_id,
+	temp_table_functional_cdr3.locus,
+	temp_table_functional_cdr3.prot_seq
+FROM temp_table_functional_cdr3
+LEFT JOIN temp_table_functional_cdr3_min
+ON temp_table_functional_cdr3.event_id = temp_table_functional_cdr3_min.event_id
+	AND temp_table_functional_cdr3.locus = temp_table_functional_cdr3_min.locus
+WHERE temp_table_functional_cdr3.consensus_rank IS NULL
+	OR temp_table_functional_cdr3_min.consensus_rank IS NULL
+	OR temp_table_functional_cdr3.consensus_rank = temp_table_functional_cdr3_min.consensus_rank;
+
+DROP TEMPORARY TABLE IF EXISTS temp_table_functional_cdr3, temp_table_functional_cdr3_min;
+END$$
+
+
+CREATE PROCEDURE `sub_temp_table_segment_association_delta`()
+BEGIN
+# Delta counterpart of 'sub_temp_table_segment_association'. Creates the same temporary V(D)J tables, but only
+# for the sequences of the events in 'temp_table_delta_events'. The D and constant segments are looked up by
+# seq_id for each of these sequences (if several exist, an arbitrary one is taken, as by the UPDATEs of the
+# full build).
+#
+
+DROP TABLE IF EXISTS temp_table_delta_seq_ids, temp_table_H_VDJ, temp_table_K_VJ, temp_table_L_VJ;
+
+CREATE TEMPORARY TABLE temp_table_delta_seq_ids (
+	PRIMARY KEY (`seq_id`)
+) AS
+SELECT sequences.seq_id
+FROM sequences
+INNER JOIN temp_table_delta_events
+ON sequences.event_id = temp_table_delta_events.event_id;
+
+# === Heavy ===
+
+CREATE TEMPORARY TABLE temp_table_H_VDJ (
+	INDEX `seq_id` (`seq_id`)
+) AS (
+	SELECT
+		v_segment.seq_id AS seq_id,
+		v_segment.`name` AS v_segment_name,
+		(
+			SELECT d_segment.`name` FROM VDJ_segments AS d_segment
+			WHERE d_segment.seq_id = v_segment.seq_id
+				AND d_segment.type='D'
+				AND d_segment.locus='H'
+				AND d_segment.igblast_rank=1
+			LIMIT 1
+		) AS d_segment_name,
+		j_segment.`name` AS j_segment_name,
+		(
+			SELECT constant_segments.`name` FROM constant_segments
+			WHERE constant_segments.seq_id = v_segment.seq_id
+			LIMIT 1
+		) AS c_segment_name,
+		v_segment.locus AS locus
+	FROM temp_table_delta_seq_ids
+	INNER JOIN VDJ_segments AS v_segment
+	ON v_segment.seq_id = temp_table_delta_seq_ids.seq_id
+		AND v_segment.type='V'
+		AND v_segment.locus='H'
+		AND v_segment.igblast_rank=1
+	INNER JOIN VDJ_segments AS j_segment
+	ON j_segment.seq_id = v_segment.seq_id
+		AND j_segment.type='J'
+		AND j_segment.locus='H'
+		AND j_segment.igblast_rank=1
+);
+
+# === Kappa ===
+
+CREATE TEMPORARY TABLE temp_table_K_VJ (
+	INDEX `seq_id` (`seq_id`)
+) AS (
+	SELECT
+		v_segment.seq_id AS seq_id,
+		v_segment.`name` AS v_segment_name,
+		j_segment.`name` AS j_segment_name,
+		(
+			SELECT constant_segments.`name` FROM constant_segments
+			WHERE constant_segments.seq_id = v_segment.seq_id
+			LIMIT 1
+		) AS c_segment_name,
+		v_segment.locus AS locus
+	FROM temp_table_delta_seq_ids
+	INNER JOIN VDJ_segments AS v_segment
+	ON v_segment.seq_id = temp_table_delta_seq_ids.seq_id
+		AND v_segment.type='V'
+		AND v_segment.locus='K'
+		AND v_segment.igblast_rank=1
+	INNER JOIN VDJ_segments AS j_segment
+	ON j_segment.seq_id = v_segment.seq_id
+		AND j_segment.type='J'
+		AND j_segment.locus='K'
+		AND j_segment.igblast_rank=1
+);
+
+# === Lambda ===
+
+CREATE TEMPORARY TABLE temp_table_L_VJ (
+	INDEX `seq_id` (`seq_id`)
+) AS (
+	SELECT
+		v_segment.seq_id AS seq_id,
+		v_segment.`name` AS v_segment_name,
+		j_segment.`name` AS j_segment_name,
+		(
+			SELECT constant_segments.`name` FROM constant_segments
+			WHERE constant_segments.seq_id = v_segment.seq_id
+			LIMIT 1
+		) AS c_segment_name,
+		v_segment.locus AS locus
+	FROM temp_table_delta_seq_ids
+	INNER JOIN VDJ_segments AS v_segment
+	ON v_segment.seq_id = temp_table_delta_seq_ids.seq_id
+		AND v_segment.type='V'
+		AND v_segment.locus='L'
+		AND v_segment.igblast_rank=1
+	INNER JOIN VDJ_segments AS j_segment
+	ON j_segment.seq_id = v_segment.seq_id
+		AND j_segment.type='J'
+		AND j_segment.locus='L'
+		AND j_segment.igblast_rank=1
+);
+
+DROP TABLE IF EXISTS temp_table_delta_seq_ids;
+END$$
+
+
+CREATE PROCEDURE `sub_table_segment_association_unified`()
+BEGIN
+# (Re)build 'derived_segment_association_unified' from 'derived_segment_association'. The light chain columns are
+# taken from the kappa locus if a kappa V segment is present and from the lambda locus otherwise (kappa precedence),
+# the column names are the ones of 'func.get.list.unified' in 'V-segment_association_heatmap.R'. The indexes allow
+# selections by donor, tissue and population and by V segments to read an index range instead of the full table.
+#
+DROP TABLE IF EXISTS derived_segment_association_unified;
+CREATE TABLE derived_segment_association_unified (
+	INDEX `event_id` (`event_id`),
+	INDEX `donor_tissue_population` (`donor_identifier`, `tissue`, `population`),
+	INDEX `tissue_population` (`tissue`, `population`),
+	INDEX `heavy_light_segment_v` (`heavy_segment_v`, `light_segment_v`),
+	INDEX `light_segment_v` (`light_segment_v`)
+) ENGINE=MYISAM AS
+	SELECT
+		event_id,
+		plate,
+		well,
+		donor_identifier,
+		tissue,
+		population,
+		antigen,
+		igh_segment_v											AS heavy_segment_v,
+		igh_segment_d											AS heavy_segment_d,
+		igh_segment_j											AS heavy_segment_j,
+		igh_cdr3												AS heavy_cdr3,
+		igh_segment_c											AS heavy_constant,
+		igh_shm													AS heavy_shm,
+		IF(igk_segment_v IS NOT NULL, 'K', 'L')					AS light_locus,
+		IF(igk_segment_v IS NOT NULL, igk_segment_v, igl_segment_v)	AS light_segment_v,
+		IF(igk_segment_v IS NOT NULL, igk_segment_j, igl_segment_j)	AS light_segment_j,
+		IF(igk_segment_v IS NOT NULL, igk_cdr3, igl_cdr3)		AS light_cdr3,
+		IF(igk_segment_v IS NOT NULL, igk_segment_c, igl_segment_c)	AS light_constant,
+		IF(igk_segment_v IS NOT NULL, igk_shm, igl_shm)			AS light_shm
+	FROM derived_segment_association
+	WHERE igk_segment_v IS NOT NULL
+		OR igl_segment_v IS NOT NULL;
+
+END$$
+
+
+CREATE PROCEDURE `sub_table_segment_association_unified_delta`()
+BEGIN
+# Replace the rows of all events in 'temp_table_delta_events' in 'derived_segment_association_unified' by the
+# current rows of 'derived_segment_association' (see 'sub_table_segment_association_unified'). The table is
+# built completely if it does not exist yet.
+#
+IF NOT EXISTS (
+	SELECT 1 FROM information_schema.tables
+	WHERE table_schema = DATABASE()
+		AND table_name = 'derived_segment_association_unified'
+) THEN
+	CALL sub_table_segment_association_unified;
+ELSE
+	DELETE derived_segment_association_unified
+	FROM derived_segment_association_unified
+	INNER JOIN temp_table_delta_events
+	ON derived_segment_association_unified.event_id = temp_table_delta_events.event_id;
+
+	INSERT INTO derived_segment_association_unified
+		SELECT
+			derived_segment_association.event_id,
+			plate,
+			well,
+			donor_identifier,
+			tissue,
+			population,
+			antigen,
+			igh_segment_v											AS heavy_segment_v,
+			igh_segment_d											AS heavy_segment_d,
+			igh_segment_j											AS heavy_segment_j,
+			igh_cdr3												AS heavy_cdr3,
+			igh_segment_c											AS heavy_constant,
+			igh_shm													AS heavy_shm,
+			IF(igk_segment_v IS NOT NULL, 'K', 'L')					AS light_locus,
+			IF(igk_segment_v IS NOT NULL, igk_segment_v, igl_segment_v)	AS light_segment_v,
+			IF(igk_segment_v IS NOT NULL, igk_segment_j, igl_segment_j)	AS light_segment_j,
+			IF(igk_segment_v IS NOT NULL, igk_cdr3, igl_cdr3)		AS light_cdr3,
+			IF(igk_segment_v IS NOT NULL, igk_segment_c, igl_segment_c)	AS light_constant,
+			IF(igk_segment_v IS NOT NULL, igk_shm, igl_shm)			AS light_shm
+		FROM derived_segment_association
+		INNER JOIN temp_table_delta_events
+		ON derived_segment_association.event_id = temp_table_delta_events.event_id
+		WHERE igk_segment_v IS NOT NULL
+			OR igl_segment_v IS NOT NULL;
+END IF;
+
+END$$
+
+
+CREATE PROCEDURE `update_segment_association`()
+BEGIN
+# Incremental counterpart of 'create_segment_association_linear'. The highest seq_id processed by the last
+# build is recorded in 'derived_watermark'. Since every newly loaded sequencing run adds sequences with
+# higher seq_ids, only events owning such sequences are recomputed and merged into 'derived_segment_association',
+# and only the new sequences are added to 'derived_mutations_replacement'. The V(D)J temporary tables are
+# restricted to the sequences of these events as well ('sub_temp_table_segment_association_delta'). Falls back to
+# a full build if no watermark exists. Changes to already loaded sequences
+# are not detected, run 'create_segment_association_linear' after such modifications.
+#
+
+CREATE TABLE IF NOT EXISTS derived_watermark (
+	`table_name` varchar(64) NOT NULL,
+	`max_seq_id` int(10) unsigned NOT NULL,
+	PRIMARY KEY (`table_name`)
+);
+
+SET @last_seq_id = (
+	SELECT max_seq_id FROM derived_watermark WHERE table_name='derived_segment_association'
+);
+SET @max_seq_id = (SELECT IFNULL(MAX(seq_id), 0) FROM sequences);
+
+IF @last_seq_id IS NULL THEN
+	CALL create_segment_association_linear;
+ELSEIF @max_seq_id > @last_seq_id THEN
+	DROP TEMPORARY TABLE IF EXISTS temp_table_delta_events;
+
+	CREATE TEMPORARY TABLE temp_table_delta_events (
+		PRIMARY KEY (`event_id`)
+	) AS
+	SELECT DISTINCT event_id
+	FROM sequences
+	WHERE seq_id > @last_seq_id
+		AND seq_id <= @max_seq_id
+		AND event_id IS NOT NULL;
+
+	CALL sub_table_v_segment_replacement_mutations_delta;
+	CALL sub_table_functional_cdr3_delta;
+	CALL sub_temp_table_segment_association_delta;
+
+	DELETE derived_segment_association
+	FROM derived_segment_association
+	INNER JOIN temp_table_delta_events
+	ON derived_segment_association.event_id = temp_table_delta_events.event_id;
+
+	INSERT INTO derived_segment_association
+		SELECT
+			`event`.event_id,
+			`event`.plate,
+			`event`.well,
+			donor.donor_identifier,
+			sample.tissue,
+			sort.population,
+			sort.antigen,
+			temp_associated.igh_segment_v,
+			temp_associated.igh_segment_d,
+			temp_associated.igh_segment_j,
+			temp_associated.igh_cdr3,
+			temp_associated.igh_segment_c,
+			temp_associated.igh_shm,
+			temp_associated.igk_segment_v,
+			temp_associated.igk_segment_j,
+			temp_associated.igk_cdr3,
+			temp_associated.igk_segment_c,
+			temp_associated.igk_shm,
+			temp_associated.igl_segment_v,
+			temp_associated.igl_segment_j,
+			temp_associated.igl_cdr3,
+			temp_associated.igl_segment_c,
+			temp_associated.igl_shm
+		FROM (
+			SELECT
+				temp_heavy.event_id			AS igh_segment_event_id,
+				temp_heavy.v_segment_name	AS igh_segment_v,
+				temp_heavy.d_segment_name	AS igh_segment_d,
+				temp_heavy.j_segment_name	AS igh_segment_j,
+				temp_heavy.CDR3				AS igh_cdr3,
+				temp_heavy.c_segment_name	AS igh_segment_c,
+				temp_heavy.repl_mutations	AS igh_shm,
+				temp_kappa.v_segment_name	AS igk_segment_v,
+				temp_kappa.j_segment_name	AS igk_segment_j,
+				temp_kappa.CDR3				AS igk_cdr3,
+				temp_kappa.c_segment_name	AS igk_segment_c,
+				temp_kappa.repl_mutations	AS igk_shm,
+				temp_lambda.v_segment_name	AS igl_segment_v,
+				temp_lambda.j_segment_name	AS igl_segment_j,
+				temp_lambda.CDR3			AS igl_cdr3,
+				temp_lambda.c_segment_name	AS igl_segment_c,
+				temp_lambda.repl_mutations	AS igl_shm
+			FROM (
+				SELECT
+					sequences.event_id,
+					temp_table_H_VDJ.v_segment_name,
+					temp_table_H_VDJ.d_segment_name,
+					temp_table_H_VDJ.j_segment_name,
+					CDR.prot_seq AS CDR3,
+					temp_table_H_VDJ.c_segment_name,
+					derived_mutations_replacement.repl_mutations
+				FROM temp_table_H_VDJ
+				INNER JOIN derived_functional_cdr3 AS CDR
+				INNER JOIN sequences
+				INNER JOIN derived_mutations_replacement
+				INNER JOIN temp_table_delta_events
+				ON temp_table_H_VDJ.seq_id = CDR.seq_id
+					AND CDR.locus = 'H'
+					AND temp_table_H_VDJ.seq_id = sequences.seq_id
+					AND temp_table_H_VDJ.seq_id = derived_mutations_replacement.seq_id
+					AND sequences.event_id = temp_table_delta_events.event_id
+			) AS temp_heavy
+			LEFT OUTER JOIN (
+				SELECT
+					sequences.event_id,
+					sequences.consensus_rank,
+					temp_table_K_VJ.v_segment_name,
+					temp_table_K_VJ.j_segment_name,
+					CDR.prot_seq AS CDR3,
+					temp_table_K_VJ.c_segment_name,
+					derived_mutations_replacement.repl_mutations
+				FROM temp_table_K_VJ
+				INNER JOIN derived_functional_cdr3 AS CDR
+				INNER JOIN sequences
+				INNER JOIN derived_mutations_replacement
+				ON temp_table_K_VJ.seq_id = CDR.seq_id
+					AND CDR.locus = 'K'
+					AND temp_table_K_VJ.seq_id = sequences.seq_id
+					AND temp_table_K_VJ.seq_id = derived_mutations_replacement.seq_id
+			) AS temp_kappa
+			ON temp_heavy.event_id = temp_kappa.event_id
+			LEFT OUTER JOIN (
+				SELECT
+					sequences.event_id,
+					sequences.consensus_rank,
+					temp_table_L_VJ.v_segment_name,
+					temp_table_L_VJ.j_segment_name,
+					CDR.prot_seq AS CDR3,
+					temp_table_L_VJ.c_segment_name,
+					derived_mutations_replacement.repl_mutations
+				FROM temp_table_L_VJ
+				INNER JOIN derived_functional_cdr3 AS CDR
+				INNER JOIN sequences
+				INNER JOIN derived_mutations_replacement
+				ON temp_table_L_VJ.seq_id = CDR.seq_id
+					AND CDR.locus = 'L'
+					AND temp_table_L_VJ.seq_id = sequences.seq_id
+					AND temp_table_L_VJ.seq_id = derived_mutations_replacement.seq_id
+			) AS temp_lambda
+			ON temp_heavy.event_id = temp_lambda.event_id
+			WHERE temp_kappa.v_segment_name IS NOT NULL
+				OR temp_lambda.v_segment_name IS NOT NULL
+		) AS temp_associated
+		INNER JOIN `event`
+		INNER JOIN sort
+		INNER JOIN sample
+		INNER JOIN donor
+		ON `event`.event_id = temp_associated.igh_segment_event_id
+			AND sample.donor_id = donor.donor_id
+			AND `event`.sort_id = sort.sort_id
+			AND sort.sample_id = sample.sample_id;
+
+	CALL sub_table_segment_association_unified_delta;
+
+	REPLACE INTO derived_watermark (table_name, max_seq_id)
+	VALUES ('derived_mutations_replacement', @max_seq_id), ('derived_segment_association', @max_seq_id);
+
+	DROP TEMPORARY TABLE IF EXISTS temp_table_delta_events;
+END IF;
+
 END$$
 
 DELIMITER ;
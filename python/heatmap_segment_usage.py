@@ -2,7 +2,6 @@
 
 import numpy as np
 import numpy.random as random
-import MySQLdb as mysql
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
@@ -10,235 +9,267 @@ import sys
 import colorsys
 import argparse
 import igdb_queries as igdbq
+import igdb_connection as igdbconn
 import igdb_plotting as igdbplt
+import igdb_snapshot as igdbsnap
+import igdb_cache as igdbcache
 
-parser = argparse.ArgumentParser()
-
-parser.add_argument("event_infile", 
-                    type = str, 
-                    help="File containing different SQL queries yielding a list of event_ids.")
-parser.add_argument("-d", "--database", 
-                    type = str, 
-                    help="manual input of database scheme")
-parser.add_argument("-l", "--locus", type=str, 
-                    help="locus H, K, L", 
-                    choices=['H','K','L'])
-# need to find out which channels to select. Take them from exemplary plate with barcode
-parser.add_argument("-r", "--resolve", type=str, 
-                    help="resolve: families, genes or VJ linkage",
-		    choices=['families','genes','VJ'])
-parser.add_argument("-t", "--segtype", type=str,
-		    help="for resolve options families/genes only: which segments to show",
-		    choices=["V","J"])
-parser.add_argument("-o", "--outputdir", type=str, 
-                    help="directory for pdf output") 
-args = parser.parse_args()
-
-db = args.database
-library = 'library_scireptor'
-print "Note: Using library %s. Do not use this script if this is not correct!" % (library)
-resolve = args.resolve
-locus = args.locus
-seg_type = args.segtype
-
-connection = mysql.connect(db=db,read_default_file="~/.my.cnf", read_default_group='mysql_igdb')
-cursor = connection.cursor()
-
-
-# Build heavy_light table if necessary
-
-igdbq.create_temp_heavy_light(cursor)
-
-# generate event list. Will later on be generated by another program and taken up by pickle (or called as module).
-
-event_names, event_statements = igdbq.read_eventfile(args.event_infile, db)
-
-def get_list_data (event_statement):
-    if resolve == 'families':
-        paired_statement = "SELECT \
-            COUNT(*) as cnt, H_VDJ.seg_family, KL_VDJ.seg_family \
-            FROM \
-            (SELECT seg_family, event_id FROM heavy_light \
-            JOIN VDJ_segments \
-            ON heavy_light.H_seq_id = VDJ_segments.seq_id \
-            JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
-            where igblast_rank=1 and VDJ_segments.type = '%s') as H_VDJ \
-            JOIN \
-            (SELECT seg_family, event_id FROM heavy_light \
-            JOIN VDJ_segments \
-            ON heavy_light.KL_seq_id = VDJ_segments.seq_id \
-            JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
-            where igblast_rank=1 and VDJ_segments.type = '%s') as KL_VDJ \
-            JOIN event ON event.event_id = H_VDJ.event_id \
-            AND event.event_id = KL_VDJ.event_id \
-            WHERE event.event_id IN (%s) \
-            GROUP BY CONCAT(H_VDJ.seg_family, KL_VDJ.seg_family) \
-            ORDER BY H_VDJ.seg_family, KL_VDJ.seg_family \
-            " % (library, seg_type, library, seg_type, event_statement)
-    elif resolve == 'genes':
-        paired_statement = "SELECT \
-            COUNT(*) as cnt, H_VDJ.seg_name, KL_VDJ.seg_name \
-            FROM \
-            (SELECT concat(seg_family, '-', seg_gene) as seg_name, event_id FROM heavy_light \
-            JOIN VDJ_segments \
-            ON heavy_light.H_seq_id = VDJ_segments.seq_id \
-            JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
-            where igblast_rank=1 and VDJ_segments.type = '%s') as H_VDJ \
-            JOIN \
-            (SELECT concat(seg_family, '-', seg_gene) as seg_name, event_id FROM heavy_light \
-            JOIN VDJ_segments \
-            ON heavy_light.KL_seq_id = VDJ_segments.seq_id \
-            JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
-            where igblast_rank=1 and VDJ_segments.type = '%s') as KL_VDJ \
-            JOIN event ON event.event_id = H_VDJ.event_id \
-            AND event.event_id = KL_VDJ.event_id \
-            WHERE event.event_id IN (%s) \
-            GROUP BY CONCAT(H_VDJ.seg_name, KL_VDJ.seg_name) \
-            ORDER BY H_VDJ.seg_name, KL_VDJ.seg_name \
-            " % (library,  seg_type, library, seg_type, event_statement)
-    elif resolve == 'VJ':
-        paired_statement = "SELECT \
-            COUNT(*) as cnt, J.seg_name, V.seg_name \
-            FROM \
-            (SELECT concat(seg_family, '-', seg_gene) as seg_name, event_id FROM heavy_light \
-            JOIN VDJ_segments \
-            ON heavy_light.H_seq_id = VDJ_segments.seq_id \
-            JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
-            where igblast_rank=1 and VDJ_segments.type = 'V') as V \
-            JOIN \
-            (SELECT seg_family as seg_name, event_id FROM heavy_light \
-            JOIN VDJ_segments \
-            ON heavy_light.H_seq_id = VDJ_segments.seq_id \
-            JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
-            where igblast_rank=1 and VDJ_segments.type = 'J') as J \
-            JOIN event ON event.event_id = V.event_id \
-            AND event.event_id = J.event_id \
-            WHERE event.event_id IN (%s) \
-            GROUP BY CONCAT(V.seg_name, J.seg_name) \
-            ORDER BY V.seg_name, J.seg_name \
-            " % (library, library, event_statement)
-            
-    cursor.execute(paired_statement)
-    gene_rows = cursor.fetchall()
+def get_parser ():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("event_infile", 
+                        type = str, 
+                        help="File containing different SQL queries yielding a list of event_ids.")
+    parser.add_argument("-d", "--database", 
+                        type = str, 
+                        help="manual input of database scheme")
+    parser.add_argument("-l", "--locus", type=str, 
+                        help="locus H, K, L", 
+                        choices=['H','K','L'])
+    # need to find out which channels to select. Take them from exemplary plate with barcode
+    parser.add_argument("-r", "--resolve", type=str, 
+                        help="resolve: families, genes or VJ linkage",
+    		    choices=['families','genes','VJ'])
+    parser.add_argument("-t", "--segtype", type=str,
+    		    help="for resolve options families/genes only: which segments to show",
+    		    choices=["V","J"])
+    parser.add_argument("-o", "--outputdir", type=str, 
+                        help="directory for pdf output") 
+    parser.add_argument("-s", "--snapshot", type=str,
+                        help="directory of a snapshot (igdb_snapshot.py) used instead of the database")
+    parser.add_argument("-C", "--cache", type=str, nargs='?', const=igdbcache.default_cache_dir,
+                        help="cache query results on disk (default directory ~/.igdb_cache)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of event groups queried in parallel")
+    parser.add_argument("--rebuild-heavy-light", action="store_true",
+                        help="rebuild the heavy_light table, needed after sequences were changed or deleted")
+    parser.add_argument("-x", "--explain", action="store_true",
+                        help="warn about queries whose plan reads a table by a full scan")
+    parser.add_argument("-Q", "--profile", type=str,
+                        help="write statistics of all SQL statements to this file at exit (.json or .csv)")
+    parser.add_argument("--profile-explain", action="store_true",
+                        help="include the EXPLAIN FORMAT=JSON plan of each SELECT in the profile")
+    return parser
+
+def get_count_tensor (list_data):
+    """
+    Args:
+    list_data   List of the rows (count, name1, name2) of each event group.
     
-    n_list1_list2_dict = {}
-    n_list2_list1_dict = {}
-    list1 = []
-    list2 = []
+    Returns:
+    count_tensor    Array (event groups x list1 names x list2 names) of counts.
+    list1_names     Sorted names of the first segment.
+    list2_names     Sorted names of the second segment.
+    """
+    group_codes = np.concatenate([np.zeros(0, dtype=int)] + 
+                                 [np.repeat(i, len(gene_rows)) for i, gene_rows in enumerate(list_data)])
+    all_rows = [row for gene_rows in list_data for row in gene_rows]
+    counts = np.array([row[0] for row in all_rows], dtype=float)
+    # map the names to integer codes once, np.unique returns them sorted
+    list1_names, list1_codes = np.unique(np.array([row[1] for row in all_rows], dtype=object), return_inverse=True)
+    list2_names, list2_codes = np.unique(np.array([row[2] for row in all_rows], dtype=object), return_inverse=True)
     
-    for row in gene_rows:
-        try:
-            n_list1_list2_dict[row[1]][row[2]] = row[0]
-        except KeyError:
-            n_list1_list2_dict[row[1]] = {}
-            n_list1_list2_dict[row[1]][row[2]] = row[0]
-        try:
-            n_list2_list1_dict[row[2]][row[1]] = row[0]
-        except KeyError:
-            n_list2_list1_dict[row[2]] = {}
-            n_list2_list1_dict[row[2]][row[1]] = row[0]
-        list1.append(row[1])
-        list2.append(row[2])
+    count_tensor = np.zeros((len(list_data), len(list1_names), len(list2_names)))
+    np.add.at(count_tensor, (group_codes, list1_codes, list2_codes), counts)
+    return count_tensor, list(list1_names), list(list2_names)
+
+def plot_heatmap_segment_usage (args, cursor=None, snapshot=None):
+    """
+    Plot the paired segment usage heatmaps of the event groups of args.event_infile.
     
-    return list1, list2, n_list1_list2_dict, n_list2_list1_dict
+    Args:
+    args        Options as parsed by get_parser.
+    cursor      Database cursor, not used if snapshot is given.
+    snapshot    Optional igdb_snapshot.Snapshot read instead of the database.
+    """
+    db = args.database
+    library = 'library_scireptor'
+    print "Note: Using library %s. Do not use this script if this is not correct!" % (library)
+    resolve = args.resolve
+    locus = args.locus
+    seg_type = args.segtype
+
+    # update the persistent heavy_light table with events added since the last run
+    if snapshot is None:
+        igdbq.refresh_heavy_light(cursor, rebuild=args.rebuild_heavy_light)
+
+    # generate event list. Will later on be generated by another program and taken up by pickle (or called as module).
 
-def get_heatmap_array (event_name, list1_names, list2_names, n_list1_list2_dict):
-    cols = len(list1_names)
-    rows = len(list2_names)
-    seg_usage_array = np.zeros((cols,rows))
+    event_names, event_statements = igdbq.read_eventfile(args.event_infile, db)
+    if snapshot is not None:
+        # event groups were resolved when the snapshot was exported
+        event_statements = snapshot.event_groups(event_names)
+    else:
+        # resolve each event group once into the indexed event_set_members table,
+        # the queries below join it by event_set_id
+        event_statements = igdbq.materialize_event_sets(event_names, event_statements, cursor)
+
+    # serve repeated queries from the on-disk result cache
+    cache_wrapper = None
+    if args.cache and cursor is not None:
+        cache_wrapper = igdbcache.QueryCache(db, args.cache).cursor
+        cursor = cache_wrapper(cursor)
+
+    def get_list_data (event_statement, cursor):
+        if snapshot is not None:
+            event_set = ""
+        else:
+            event_set = igdbq.event_set_join(event_statement, 'heavy_light.event_id')
+        if resolve == 'families':
+            paired_statement = "SELECT \
+                COUNT(*) as cnt, H_VDJ.seg_family, KL_VDJ.seg_family \
+                FROM \
+                (SELECT seg_family, heavy_light.event_id FROM heavy_light \
+                JOIN VDJ_segments \
+                ON heavy_light.H_seq_id = VDJ_segments.seq_id \
+                JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
+                %s \
+                where igblast_rank=1 and VDJ_segments.type = '%s') as H_VDJ \
+                JOIN \
+                (SELECT seg_family, heavy_light.event_id FROM heavy_light \
+                JOIN VDJ_segments \
+                ON heavy_light.KL_seq_id = VDJ_segments.seq_id \
+                JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
+                %s \
+                where igblast_rank=1 and VDJ_segments.type = '%s') as KL_VDJ \
+                ON KL_VDJ.event_id = H_VDJ.event_id \
+                GROUP BY CONCAT(H_VDJ.seg_family, KL_VDJ.seg_family) \
+                ORDER BY H_VDJ.seg_family, KL_VDJ.seg_family \
+                " % (library, event_set, seg_type, library, event_set, seg_type)
+        elif resolve == 'genes':
+            paired_statement = "SELECT \
+                COUNT(*) as cnt, H_VDJ.seg_name, KL_VDJ.seg_name \
+                FROM \
+                (SELECT concat(seg_family, '-', seg_gene) as seg_name, heavy_light.event_id FROM heavy_light \
+                JOIN VDJ_segments \
+                ON heavy_light.H_seq_id = VDJ_segments.seq_id \
+                JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
+                %s \
+                where igblast_rank=1 and VDJ_segments.type = '%s') as H_VDJ \
+                JOIN \
+                (SELECT concat(seg_family, '-', seg_gene) as seg_name, heavy_light.event_id FROM heavy_light \
+                JOIN VDJ_segments \
+                ON heavy_light.KL_seq_id = VDJ_segments.seq_id \
+                JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
+                %s \
+                where igblast_rank=1 and VDJ_segments.type = '%s') as KL_VDJ \
+                ON KL_VDJ.event_id = H_VDJ.event_id \
+                GROUP BY CONCAT(H_VDJ.seg_name, KL_VDJ.seg_name) \
+                ORDER BY H_VDJ.seg_name, KL_VDJ.seg_name \
+                " % (library, event_set, seg_type, library, event_set, seg_type)
+        elif resolve == 'VJ':
+            paired_statement = "SELECT \
+                COUNT(*) as cnt, J.seg_name, V.seg_name \
+                FROM \
+                (SELECT concat(seg_family, '-', seg_gene) as seg_name, heavy_light.event_id FROM heavy_light \
+                JOIN VDJ_segments \
+                ON heavy_light.H_seq_id = VDJ_segments.seq_id \
+                JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
+                %s \
+                where igblast_rank=1 and VDJ_segments.type = 'V') as V \
+                JOIN \
+                (SELECT seg_family as seg_name, heavy_light.event_id FROM heavy_light \
+                JOIN VDJ_segments \
+                ON heavy_light.H_seq_id = VDJ_segments.seq_id \
+                JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
+                %s \
+                where igblast_rank=1 and VDJ_segments.type = 'J') as J \
+                ON J.event_id = V.event_id \
+                GROUP BY CONCAT(V.seg_name, J.seg_name) \
+                ORDER BY V.seg_name, J.seg_name \
+                " % (library, event_set, library, event_set)
+            
+        if snapshot is not None:
+            gene_rows = snapshot.paired_rows(event_statement, resolve, seg_type)
+        else:
+            if args.explain:
+                igdbq.check_index_use(paired_statement, cursor)
+            cursor.execute(paired_statement)
+            gene_rows = cursor.fetchall()
     
-    for i, col_name in zip(range(cols), list1_names):
-        for j, row_name in zip(range(rows), list2_names):
-            try:
-                seg_usage_array[i][j] = n_list1_list2_dict[col_name][row_name]
-            except KeyError:
-                pass
-    number = np.sum(seg_usage_array)
-    # normalize
-    seg_usage_array = seg_usage_array/np.sum(seg_usage_array)
-    return seg_usage_array, number
+        return gene_rows
     
     
-list_data_event_dict = {}
-all_list1_names = []
-all_list2_names = []
-for event_name, event_st in zip(event_names, event_statements):
-    list_data_event_dict[event_name] = get_list_data(event_st)
-    all_list1_names.append(list_data_event_dict[event_name][0])
-    all_list2_names.append(list_data_event_dict[event_name][1])
-
-combined_list1 = []
-for item in all_list1_names:
-    combined_list1 += item
-list1_names = list(set(combined_list1))
-list1_names.sort()
-
-combined_list2 = []
-for item in all_list2_names:
-    combined_list2 += item
-list2_names = list(set(combined_list2))
-list2_names.sort()
-
-array_event_dict = {} 
-number_event_dict = {} 
-for event_name in event_names:
-    n_list1_list2_dict = list_data_event_dict[event_name][2]
-    array_event_dict[event_name], number_event_dict[event_name] = get_heatmap_array(event_name, list1_names, list2_names, n_list1_list2_dict)
-vmin = np.min(array_event_dict.values())
-vmax = np.max(array_event_dict.values())
-
-
-###
-# PLOTTING
-###
-
-# define size
-
-n_events = len(event_names)
-
-F = plt.figure(1, 
-               (0.4*n_events*len(list1_names)+0.05+0.04*len(list1_names), #width
-                0.4*len(list2_names))) #height
-F.clf()
-
-from mpl_toolkits.axes_grid1 import ImageGrid
-grid = ImageGrid(F, 111,
-          nrows_ncols = (1, n_events),
-          direction="row",
-          axes_pad = 0.05,
-          add_all=True,
-          share_all = True,
-          cbar_location="right",
-          cbar_mode="single",
-          cbar_size="10%",
-          cbar_pad=0.05,
-          )
-norm = mpl.colors.Normalize(vmax=vmax, vmin=vmin)
-
-for ax, event_name in zip(grid, event_names):
-    im = ax.imshow(array_event_dict[event_name].T, norm=norm,
-                   origin="upper",
-                   interpolation="none", cmap='binary')
-cbar = ax.cax.colorbar(im)
-ax.cax.toggle_label(True)
-cbar.set_label_text('Relative frequency')
-
-grid[0].set_yticks(range(len(list2_names)))
-grid[0].set_yticklabels(list2_names)  
-
-for ax, im_title in zip(grid, event_names):
-    ax.set_xlabel(im_title + "\n (n =  " + str(int(number_event_dict[im_title])) + ")")
-    ax.tick_params(labelbottom='off',labeltop='on',
-                   bottom ='off', top = 'off',
-                   right= 'off', left = 'off')
-    ax.set_xticks(range(len(list1_names)))
-    lbls=ax.set_xticklabels(list1_names, rotation=90)
+    # query all event groups, in parallel if requested
+    list_data = igdbq.map_event_groups(get_list_data, event_statements, db, args.jobs, cursor, cache_wrapper)
+
+    count_tensor, list1_names, list2_names = get_count_tensor(list_data)
+    # normalize each event group to relative frequencies
+    numbers = count_tensor.sum(axis=(1, 2))
+    seg_usage_tensor = count_tensor / numbers[:, np.newaxis, np.newaxis]
+    vmin = np.nanmin(seg_usage_tensor)
+    vmax = np.nanmax(seg_usage_tensor)
+
+
+    ###
+    # PLOTTING
+    ###
+
+    # define size
+
+    n_events = len(event_names)
+
+    F = plt.figure(1, 
+                   (0.4*n_events*len(list1_names)+0.05+0.04*len(list1_names), #width
+                    0.4*len(list2_names))) #height
+    F.clf()
+
+    from mpl_toolkits.axes_grid1 import ImageGrid
+    grid = ImageGrid(F, 111,
+              nrows_ncols = (1, n_events),
+              direction="row",
+              axes_pad = 0.05,
+              add_all=True,
+              share_all = True,
+              cbar_location="right",
+              cbar_mode="single",
+              cbar_size="10%",
+              cbar_pad=0.05,
+              )
+    norm = mpl.colors.Normalize(vmax=vmax, vmin=vmin)
+
+    for ax, seg_usage_array in zip(grid, seg_usage_tensor):
+        im = ax.imshow(seg_usage_array.T, norm=norm,
+                       origin="upper",
+                       interpolation="none", cmap='binary')
+    cbar = ax.cax.colorbar(im)
+    ax.cax.toggle_label(True)
+    cbar.set_label_text('Relative frequency')
+
+    grid[0].set_yticks(range(len(list2_names)))
+    grid[0].set_yticklabels(list2_names)  
+
+    for ax, im_title, number in zip(grid, event_names, numbers):
+        ax.set_xlabel(im_title + "\n (n =  " + str(int(number)) + ")")
+        ax.tick_params(labelbottom='off',labeltop='on',
+                       bottom ='off', top = 'off',
+                       right= 'off', left = 'off')
+        ax.set_xticks(range(len(list1_names)))
+        lbls=ax.set_xticklabels(list1_names, rotation=90)
    
 
-filename = '%s_%s_%s.pdf' % (db,resolve,seg_type)
+    filename = '%s_%s_%s.pdf' % (db,resolve,seg_type)
+
+    plt.tight_layout()
+    plt.savefig(args.outputdir + "/" + filename)      
+    plt.close(F)
+
+def run (args, argv=None):
+    """
+    Generate the plot of args with a pooled database connection or from the snapshot of args.
+    """
+    if args.profile:
+        igdbq.start_profile(args.profile, args.profile_explain)
+    if args.snapshot:
+        plot_heatmap_segment_usage(args, snapshot=igdbsnap.open_snapshot(args.snapshot))
+    else:
+        with igdbconn.get_pool(args.database).cursor() as cursor:
+            plot_heatmap_segment_usage(args, igdbq.instrument(cursor))
 
-plt.tight_layout()
-plt.savefig(args.outputdir + "/" + filename)      
+def main (argv=None):
+    if argv is None:
+        argv = sys.argv
+    run(get_parser().parse_args(argv[1:]), argv)
 
-# drop temporary table
-igdbq.drop_temp_heavy_light(cursor)
+if __name__ == '__main__':
+    main()
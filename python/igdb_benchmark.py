@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+igdb_benchmark.py
+
+Scaling benchmark of the stored procedures for segment and cluster analysis. For every scale
+(number of events) the benchmark database is reset with SQL/truncate_all.sql, filled with
+synthetic data and the procedures are timed. The timings are written as JSON, together with the
+scaling exponent of each procedure (slope of log(time) over log(events) between consecutive
+scales) and optionally plotted as scaling curve. A stored baseline is compared against the
+timings, procedures slower than the baseline by more than the tolerance are reported as
+regressions (exit status 1).
+
+The benchmark database needs the igdb schema and the stored procedures (option -i installs them
+from SQL/). Since all tables are truncated, the database name has to contain 'bench' unless
+--force is given.
+
+usage: igdb_benchmark.py [-h] -d DATABASE [-n SCALES] [-p PROCEDURES] [-r REPEAT]
+                         [-o OUTPUT] [-b BASELINE] [-t TOLERANCE] [-S] [-P PLOT]
+                         [-i] [--seed SEED] [--force]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -d DATABASE, --database DATABASE
+                        Benchmark database (will be truncated).
+  -n SCALES, --scales SCALES
+                        Comma separated numbers of events, default 1000,10000,100000.
+  -p PROCEDURES, --procedures PROCEDURES
+                        Comma separated procedures to time, default see default_procedures.
+  -r REPEAT, --repeat REPEAT
+                        Number of timed runs per procedure and scale, the minimum is reported.
+  -o OUTPUT, --output OUTPUT
+                        JSON file of the timings.
+  -b BASELINE, --baseline BASELINE
+                        JSON file of baseline timings to compare with.
+  -t TOLERANCE, --tolerance TOLERANCE
+                        Allowed slowdown relative to the baseline, default 0.25.
+  -S, --save-baseline   Write the timings to the baseline file.
+  -P PLOT, --plot PLOT  PDF file of the scaling curves.
+  -i, --install         Install the stored procedures of SQL/ before the benchmark.
+  --seed SEED           Seed of the synthetic data.
+  --force               Allow a database name without 'bench'.
+"""
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import argparse
+import igdb_connection as igdbconn
+
+sql_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'SQL')
+
+default_scales = [1000, 10000, 100000]
+
+# procedures in the order they are timed, each with the tables it creates
+default_procedures = ['sub_temp_table_v_segment_replacement_mutations', 'create_segment_association',
+                      'create_cluster']
+procedure_outputs = {
+    'sub_temp_table_v_segment_replacement_mutations': ['derived_mutations_replacement'],
+    'create_segment_association': ['derived_segment_association', 'derived_segment_association_unified',
+                                   'derived_mutations_replacement'],
+    'create_segment_association_linear': ['derived_segment_association', 'derived_segment_association_unified',
+                                          'derived_mutations_replacement', 'derived_functional_cdr3'],
+    'create_cluster': ['derived_cluster_meta', 'derived_cluster_comp', 'derived_cluster'],
+    'create_cluster_indexed': ['derived_cluster_meta', 'derived_cluster_comp', 'derived_cluster'],
+}
+
+# events generated and loaded at once
+chunk_size = 50000
+
+table_columns = {
+    'event': ['event_id', 'sort_id', 'plate', 'well', 'plate_barcode'],
+    'sequences': ['seq_id', 'event_id', 'locus', 'consensus_rank'],
+    'VDJ_segments': ['seq_id', 'type', 'locus', 'igblast_rank', 'name'],
+    'CDR_FWR': ['seq_id', 'region', 'start', 'end', 'prot_seq', 'prot_length', 'stop_codon'],
+    'igblast_alignment': ['seq_id', 'query_start', 'germline_start'],
+    'mutations': ['seq_id', 'position_codonstart_on_seq', 'replacement', 'silent', 'insertion', 'deletion',
+                  'stop_codon_germline'],
+    'constant_segments': ['seq_id', 'name'],
+}
+
+amino_acids = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+
+class SyntheticIgdb (object):
+    """
+    Generator of synthetic igdb content for n_events events. Every event has a heavy chain and a
+    kappa (60 %) or lambda light chain consensus sequence, 10 % of the events a second heavy chain
+    sequence of consensus rank 2. Every sequence has V, (D,) J and constant segments, FR3 and CDR3
+    regions (5 % of the CDR3 with stop codon), an igblast alignment and Poisson distributed mutations.
+    """
+
+    def __init__ (self, n_events, seed=0, n_donors=10, samples_per_donor=2, sorts_per_sample=2):
+        self.n_events = n_events
+        self.seed = seed
+        self.n_donors = n_donors
+        self.samples_per_donor = samples_per_donor
+        self.sorts_per_sample = sorts_per_sample
+        self.segments = {}
+        for locus, n_v, n_d, n_j in [('H', 50, 25, 6), ('K', 40, 0, 5), ('L', 30, 0, 5)]:
+            self.segments[(locus, 'V')] = ["IG%sV%d-%d*01" % (locus, i % 7 + 1, i + 1) for i in range(n_v)]
+            self.segments[(locus, 'D')] = ["IG%sD%d-%d*01" % (locus, i % 7 + 1, i + 1) for i in range(n_d)]
+            self.segments[(locus, 'J')] = ["IG%sJ%d*01" % (locus, i + 1) for i in range(n_j)]
+        self.constant = {'H': ['IGHM', 'IGHD', 'IGHG1', 'IGHG2', 'IGHA1'], 'K': ['IGKC'], 'L': ['IGLC2', 'IGLC3']}
+
+    def metadata (self):
+        """
+        Yields:
+        Tuples (table, columns, rows) of donor, sample and sort.
+        """
+        n_samples = self.n_donors * self.samples_per_donor
+        n_sorts = n_samples * self.sorts_per_sample
+        yield ('donor', ['donor_id', 'donor_identifier'],
+               [(i + 1, "BD%03d" % (i + 1)) for i in range(self.n_donors)])
+        yield ('sample', ['sample_id', 'donor_id', 'tissue'],
+               [(i + 1, i // self.samples_per_donor + 1, ['PBMC', 'BM'][i % 2]) for i in range(n_samples)])
+        yield ('sort', ['sort_id', 'sample_id', 'population', 'antigen'],
+               [(i + 1, i // self.sorts_per_sample + 1, ['naive', 'memory'][i % 2], 'CD19') for i in range(n_sorts)])
+
+    def chunks (self):
+        """
+        Yields:
+        Lists of tuples (table, columns, rows), each for up to chunk_size events.
+        """
+        random_state = np.random.RandomState(self.seed)
+        n_sorts = self.n_donors * self.samples_per_donor * self.sorts_per_sample
+        seq_id = 0
+        for first_event in range(0, self.n_events, chunk_size):
+            event_ids = np.arange(first_event + 1, min(first_event + chunk_size, self.n_events) + 1)
+            tables = dict((table, []) for table in ['event', 'sequences', 'VDJ_segments', 'CDR_FWR',
+                                                    'igblast_alignment', 'mutations', 'constant_segments'])
+            for event_id in event_ids:
+                well = (event_id - 1) % 384
+                tables['event'].append((int(event_id), int(random_state.randint(n_sorts)) + 1,
+                                        int((event_id - 1) // 384 + 1), int(well + 1),
+                                        "P%06d" % ((event_id - 1) // 384 + 1)))
+                light = 'K' if random_state.random_sample() < 0.6 else 'L'
+                chains = [('H', 1), (light, 1)]
+                if random_state.random_sample() < 0.1:
+                    chains.append(('H', 2))
+                for locus, consensus_rank in chains:
+                    seq_id += 1
+                    self.add_sequence(tables, random_state, seq_id, int(event_id), locus, consensus_rank)
+            yield [(table, table_columns[table], rows) for table, rows in tables.items()]
+
+    def add_sequence (self, tables, random_state, seq_id, event_id, locus, consensus_rank):
+        tables['sequences'].append((seq_id, event_id, locus, consensus_rank))
+        for segment_type in ['V', 'D', 'J']:
+            names = self.segments[(locus, segment_type)]
+            if names:
+                tables['VDJ_segments'].append((seq_id, segment_type, locus, 1,
+                                               names[random_state.randint(len(names))]))
+        constant = self.constant[locus]
+        tables['constant_segments'].append((seq_id, constant[random_state.randint(len(constant))]))
+
+        cdr3_length = random_state.randint(8, 21)
+        fwr3_end = 290 + random_state.randint(0, 12)
+        stop_codon = int(random_state.random_sample() < 0.05)
+        tables['CDR_FWR'].append((seq_id, 'FR3', fwr3_end - 114, fwr3_end, None, 38, 0))
+        tables['CDR_FWR'].append((seq_id, 'CDR3', fwr3_end + 1, fwr3_end + 3 * cdr3_length,
+                                  ''.join(amino_acids[random_state.randint(20, size=cdr3_length)]),
+                                  cdr3_length, stop_codon))
+        tables['igblast_alignment'].append((seq_id, int(random_state.randint(1, 30)), 1))
+
+        n_mutations = random_state.poisson(6)
+        positions = random_state.randint(1, fwr3_end + 3 * cdr3_length, size=n_mutations)
+        replacements = random_state.random_sample(n_mutations) < 0.7
+        for position, replacement in zip(positions, replacements):
+            tables['mutations'].append((seq_id, int(position), int(replacement), int(not replacement), 0, 0, 0))
+
+def insert_rows (cursor, table, columns, rows):
+    """
+    Bulk insert rows (multi-row INSERT of MySQLdb executemany). Columns of the igdb schema not
+    generated here get their default values.
+    """
+    statement = "INSERT IGNORE INTO `%s` (%s) VALUES (%s)" % (table, ", ".join("`%s`" % (column) for column in columns),
+                                                           ", ".join(["%s"] * len(columns)))
+    for i in range(0, len(rows), 10000):
+        cursor.executemany(statement, rows[i:i + 10000])
+
+def truncate_all (cursor):
+    """
+    Empty all igdb tables (SQL/truncate_all.sql) and drop the derived tables.
+    """
+    for statement in open(os.path.join(sql_dir, 'truncate_all.sql'), 'r').read().split(';'):
+        if statement.strip():
+            cursor.execute(statement)
+    drop_outputs(cursor, sorted(set(table for tables in procedure_outputs.values() for table in tables)))
+    # tables maintained incrementally by igdb_queries, stale after the truncation
+    cursor.execute("DROP TABLE IF EXISTS derived_watermark, heavy_light, heavy_light_watermark, \
+        event_sets, event_set_members;")
+
+def drop_outputs (cursor, tables):
+    cursor.execute("DROP TABLE IF EXISTS %s;" % (", ".join(tables)))
+
+def load_synthetic (cursor, n_events, seed=0):
+    """
+    Reset the database and load synthetic data of n_events events. Returns the load time.
+    """
+    start = time.time()
+    truncate_all(cursor)
+    synthetic = SyntheticIgdb(n_events, seed)
+    for table, columns, rows in synthetic.metadata():
+        insert_rows(cursor, table, columns, rows)
+    for chunk in synthetic.chunks():
+        for table, columns, rows in chunk:
+            insert_rows(cursor, table, columns, rows)
+        cursor.connection.commit()
+    return time.time() - start
+
+def install_procedures (cursor):
+    """
+    Create the stored procedures of the SQL files in SQL/, replacing existing ones.
+    """
+    for file_name in ['stored_procedures_segment_analysis.sql', 'stored_procedures_cluster_analysis.sql']:
+        content = open(os.path.join(sql_dir, file_name), 'r').read()
+        content = content[content.index('DELIMITER $$') + len('DELIMITER $$'):]
+        for definition in content.split('$$'):
+            definition = definition.strip()
+            if not definition.startswith('CREATE PROCEDURE'):
+                continue
+            name = definition.split('`')[1]
+            cursor.execute("DROP PROCEDURE IF EXISTS `%s`;" % (name))
+            cursor.execute(definition)
+
+def time_procedure (cursor, procedure):
+    """
+    Call procedure after dropping its output tables, returns the wall time in seconds.
+    """
+    if procedure in procedure_outputs:
+        drop_outputs(cursor, procedure_outputs[procedure])
+    start = time.time()
+    cursor.execute("CALL `%s`();" % (procedure))
+    while cursor.nextset():
+        pass
+    cursor.connection.commit()
+    return time.time() - start
+
+def run_benchmark (cursor, scales, procedures, repeat=1, seed=0):
+    """
+    Returns:
+    Dictionary of the results: events per scale, load time per scale and the minimal time of each
+    procedure per scale (lists ordered like scales).
+    """
+    results = {'scales': list(scales), 'load': [], 'procedures': dict((procedure, []) for procedure in procedures)}
+    for n_events in scales:
+        load_time = load_synthetic(cursor, n_events, seed)
+        results['load'].append(load_time)
+        print "%d events loaded in %.1f s" % (n_events, load_time)
+        for procedure in procedures:
+            timings = [time_procedure(cursor, procedure) for i in range(repeat)]
+            results['procedures'][procedure].append(min(timings))
+            print "    %-50s %10.2f s" % (procedure, min(timings))
+    results['exponents'] = scaling_exponents(results)
+    return results
+
+def scaling_exponents (results):
+    """
+    Slope of log(time) over log(events) between consecutive scales for each procedure. A slope of
+    1 means linear scaling, 2 quadratic.
+    """
+    log_scales = np.log(np.array(results['scales'], dtype=float))
+    exponents = {}
+    for procedure, timings in results['procedures'].items():
+        log_timings = np.log(np.maximum(np.array(timings, dtype=float), 1e-3))
+        exponents[procedure] = list(np.diff(log_timings) / np.diff(log_scales))
+    return exponents
+
+def compare_baseline (results, baseline, tolerance):
+    """
+    Returns:
+    List of regressions (procedure, events, time, baseline time), for all scales and procedures
+    present in both results and baseline.
+    """
+    regressions = []
+    for procedure, timings in results['procedures'].items():
+        if procedure not in baseline['procedures']:
+            continue
+        baseline_timings = dict(zip(baseline['scales'], baseline['procedures'][procedure]))
+        for n_events, timing in zip(results['scales'], timings):
+            if n_events in baseline_timings and timing > baseline_timings[n_events] * (1 + tolerance):
+                regressions.append((procedure, n_events, timing, baseline_timings[n_events]))
+    return regressions
+
+def plot_scaling (results, plot_file):
+    import matplotlib as mpl
+    mpl.use('Agg')
+    import matplotlib.pyplot as plt
+    plt.figure()
+    for procedure, timings in sorted(results['procedures'].items()):
+        plt.loglog(results['scales'], timings, marker='o', label=procedure)
+    plt.xlabel("Events")
+    plt.ylabel("Run time [s]")
+    plt.legend(loc='upper left', fontsize=8)
+    plt.savefig(plot_file, bbox_inches='tight')
+    plt.close()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--database", type=str, required=True,
+                        help="benchmark database, all its tables are truncated")
+    parser.add_argument("-n", "--scales", type=str, default=",".join(str(scale) for scale in default_scales),
+                        help="comma separated numbers of events")
+    parser.add_argument("-p", "--procedures", type=str, default=",".join(default_procedures),
+                        help="comma separated stored procedures to time")
+    parser.add_argument("-r", "--repeat", type=int, default=1,
+                        help="timed runs per procedure and scale, the minimum is reported")
+    parser.add_argument("-o", "--output", type=str,
+                        help="JSON file of the timings")
+    parser.add_argument("-b", "--baseline", type=str,
+                        help="JSON file of baseline timings")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.25,
+                        help="allowed slowdown relative to the baseline")
+    parser.add_argument("-S", "--save-baseline", action="store_true",
+                        help="write the timings to the baseline file")
+    parser.add_argument("-P", "--plot", type=str,
+                        help="PDF file of the scaling curves")
+    parser.add_argument("-i", "--install", action="store_true",
+                        help="install the stored procedures of SQL/ first")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the synthetic data")
+    parser.add_argument("--force", action="store_true",
+                        help="allow a database name without 'bench'")
+    args = parser.parse_args()
+
+    if 'bench' not in args.database and not args.force:
+        print "Refusing to truncate %s, use a database named *bench* or --force." % (args.database)
+        sys.exit(2)
+
+    scales = [int(scale) for scale in args.scales.split(',')]
+    procedures = args.procedures.split(',')
+
+    with igdbconn.get_pool(args.database).cursor() as cursor:
+        if args.install:
+            install_procedures(cursor)
+        results = run_benchmark(cursor, scales, procedures, args.repeat, args.seed)
+
+    for procedure, exponents in sorted(results['exponents'].items()):
+        print "%-50s scaling exponents %s" % (procedure, ", ".join("%.2f" % (exponent) for exponent in exponents))
+    if args.output:
+        json.dump(results, open(args.output, 'w'), indent=2)
+    if args.plot:
+        plot_scaling(results, args.plot)
+
+    if args.baseline and args.save_baseline:
+        json.dump(results, open(args.baseline, 'w'), indent=2)
+    elif args.baseline:
+        regressions = compare_baseline(results, json.load(open(args.baseline, 'r')), args.tolerance)
+        for procedure, n_events, timing, baseline_timing in regressions:
+            print "REGRESSION %s at %d events: %.2f s (baseline %.2f s)" % (procedure, n_events, timing, baseline_timing)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+igdb_cache.py
+
+Module for an on-disk cache of query results. Results of SELECT statements are stored per
+(database, statement, schema version, event sets), where the schema version is derived from the
+highest primary key and the update time of the igdb tables read by the plotting scripts and of
+log_table, and from the row count of log_table. Loading a new sequencing run therefore
+invalidates all cached results. Statements
+joining event_set_members are further keyed by the member checksums of their event sets (see
+igdb_queries.materialize_event_sets), since the members can change while the statement does not.
+The cache is limited in size, least recently used entries are removed first.
+
+Usage:
+    cache = QueryCache(db)
+    cursor = cache.cursor(connection.cursor())
+"""
+
+import os
+import re
+import hashlib
+import threading
+import cPickle as pickle
+
+default_cache_dir = os.path.expanduser('~/.igdb_cache')
+default_max_size = 512 * 1024 * 1024
+
+# tables whose highest primary key and update time define the schema version
+version_tables = ['sequences', 'VDJ_segments', 'CDR_FWR', 'constant_segments', 'mutations',
+    'consensus_stats', 'flow', 'flow_meta', 'event', 'sort', 'sample', 'donor', 'heavy_light',
+    'log_table']
+
+# version of tables without primary key: (table read by the statement, statement)
+version_statements = {
+    'heavy_light': ('heavy_light_watermark', "SELECT MAX(max_seq_id) FROM heavy_light_watermark"),
+}
+
+# tables whose exact row count is part of the schema version, small enough for COUNT(*);
+# catches deletes below the highest key where the server does not record the update time
+count_tables = ['log_table']
+
+# event set ids of a statement, as written by igdb_queries.event_set_join and event_list_sql
+event_set_pattern = re.compile(r"event_set_id\s*(?:=\s*(\d+)|IN\s*\(([\d,\s]+)\))", re.IGNORECASE)
+
+# SELECTs whose result depends on the session or has side effects, never cached
+session_function_pattern = re.compile(r"\b(GET_LOCK|RELEASE_LOCK|IS_FREE_LOCK|IS_USED_LOCK|DATABASE|"
+                                      r"CONNECTION_ID|LAST_INSERT_ID|FOUND_ROWS|ROW_COUNT|NOW|RAND|UUID)\s*\(",
+                                      re.IGNORECASE)
+from_pattern = re.compile(r"\bFROM\b", re.IGNORECASE)
+
+# bookkeeping tables probed before and while they are refreshed (watermarks, checksums), never cached
+bookkeeping_pattern = re.compile(r"\b(information_schema|heavy_light_watermark|event_sets)\b", re.IGNORECASE)
+
+def cacheable (statement):
+    """
+    Return whether the result of statement can be served from the cache: a SELECT reading
+    tables (with a FROM clause) without lock or session functions, and not reading bookkeeping tables.
+    """
+    return (statement.lstrip().upper().startswith('SELECT') and from_pattern.search(statement) is not None
+            and session_function_pattern.search(statement) is None
+            and bookkeeping_pattern.search(statement) is None)
+
+class QueryCache (object):
+    """
+    On-disk result cache of one database. Entries are pickled (rows, description) tuples in
+    path, named by the SHA1 of database, schema version and statement.
+    """
+
+    def __init__ (self, db, path=default_cache_dir, max_size=default_max_size):
+        self.db = db
+        self.path = path
+        self.max_size = max_size
+        self.schema_version = None
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def version (self, db_cursor):
+        """
+        Return the schema version, computed on first use from the highest primary key (an index
+        lookup, unlike COUNT(*) on InnoDB) and the update time of version_tables, and the row count
+        of count_tables. The update time catches changes that keep the highest key where the server
+        records it (it is NULL for InnoDB before MySQL 5.7), the row counts catch loads and deletes
+        logged in log_table.
+        """
+        with self.lock:
+            if self.schema_version is None:
+                tables = version_tables + [source for source, statement in version_statements.values()]
+                table_list = ", ".join("'%s'" % (table) for table in tables)
+                db_cursor.execute("SELECT table_name, update_time FROM information_schema.tables \
+                    WHERE table_schema = DATABASE() AND table_name IN (%s);" % (table_list))
+                update_times = dict((row[0], row[1]) for row in db_cursor.fetchall())
+                db_cursor.execute("SELECT table_name, column_name FROM information_schema.key_column_usage \
+                    WHERE table_schema = DATABASE() AND constraint_name = 'PRIMARY' AND ordinal_position = 1 \
+                    AND table_name IN (%s);" % (table_list))
+                primary_keys = dict((row[0], row[1]) for row in db_cursor.fetchall())
+                versions = []
+                for table in version_tables:
+                    if table not in update_times:
+                        continue
+                    if table in primary_keys:
+                        db_cursor.execute("SELECT MAX(`%s`) FROM `%s`;" % (primary_keys[table], table))
+                        highest = db_cursor.fetchall()[0][0]
+                    elif table in version_statements and version_statements[table][0] in update_times:
+                        db_cursor.execute(version_statements[table][1])
+                        highest = db_cursor.fetchall()[0][0]
+                    else:
+                        highest = None
+                    versions.append("%s:%s:%s" % (table, highest, update_times[table]))
+                for table in count_tables:
+                    if table in update_times:
+                        db_cursor.execute("SELECT COUNT(*) FROM `%s`;" % (table))
+                        versions.append("%s:%s" % (table, db_cursor.fetchall()[0][0]))
+                self.schema_version = hashlib.sha1(",".join(versions)).hexdigest()
+            return self.schema_version
+
+    def event_set_checksums (self, statement, db_cursor):
+        """
+        Return the member checksums of the event sets joined by statement, empty if there are none.
+        """
+        event_set_ids = set()
+        for single_id, listed_ids in event_set_pattern.findall(statement):
+            for event_set_id in (single_id + "," + listed_ids).split(","):
+                if event_set_id.strip():
+                    event_set_ids.add(int(event_set_id))
+        if not event_set_ids:
+            return ""
+        db_cursor.execute("SELECT event_set_id, members_checksum FROM event_sets \
+            WHERE event_set_id IN (%s) ORDER BY event_set_id;" % (", ".join(str(i) for i in sorted(event_set_ids))))
+        return ",".join("%s:%s" % (row[0], row[1]) for row in db_cursor.fetchall())
+
+    def key (self, statement, db_cursor):
+        return hashlib.sha1("\0".join([str(self.db), self.version(db_cursor),
+                                       self.event_set_checksums(statement, db_cursor), statement])).hexdigest()
+
+    def get (self, key):
+        """
+        Return the cached (rows, description) or None. A hit marks the entry as recently used.
+        """
+        entry_path = os.path.join(self.path, key + '.pickle')
+        try:
+            entry_file = open(entry_path, 'rb')
+        except IOError:
+            return None
+        try:
+            entry = pickle.load(entry_file)
+        except (EOFError, pickle.UnpicklingError):
+            entry = None
+        entry_file.close()
+        if entry is not None:
+            os.utime(entry_path, None)
+        return entry
+
+    def put (self, key, rows, description):
+        entry_path = os.path.join(self.path, key + '.pickle')
+        temp_path = "%s.%d.%d.tmp" % (entry_path, os.getpid(), threading.current_thread().ident)
+        entry_file = open(temp_path, 'wb')
+        pickle.dump((rows, description), entry_file, pickle.HIGHEST_PROTOCOL)
+        entry_file.close()
+        os.rename(temp_path, entry_path)
+        self.evict()
+
+    def evict (self):
+        """
+        Remove the least recently used entries until the cache is smaller than max_size.
+        """
+        entries = []
+        total_size = 0
+        for file_name in os.listdir(self.path):
+            if file_name.endswith('.pickle'):
+                try:
+                    entry_stat = os.stat(os.path.join(self.path, file_name))
+                except OSError:
+                    continue
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, file_name))
+                total_size += entry_stat.st_size
+        entries.sort()
+        for mtime, size, file_name in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, file_name))
+            except OSError:
+                pass
+            total_size -= size
+
+    def cursor (self, db_cursor):
+        return CachedCursor(db_cursor, self)
+
+class CachedCursor (object):
+    """
+    Wrapper of a database cursor, which serves SELECT statements from a QueryCache. All other
+    statements (and SELECTs that are not cacheable) and attributes are passed to the wrapped cursor.
+    """
+
+    def __init__ (self, db_cursor, cache):
+        self.db_cursor = db_cursor
+        self.cache = cache
+        self.rows = None
+        self.position = 0
+        self.description = None
+
+    def __getattr__ (self, name):
+        return getattr(self.db_cursor, name)
+
+    def execute (self, statement, args=None):
+        if args is not None:
+            statement = statement % self.db_cursor.connection.literal(args)
+        if not cacheable(statement):
+            self.rows = None
+            result = self.db_cursor.execute(statement)
+            self.description = self.db_cursor.description
+            return result
+        key = self.cache.key(statement, self.db_cursor)
+        entry = self.cache.get(key)
+        if entry is None:
+            self.db_cursor.execute(statement)
+            entry = (tuple(self.db_cursor.fetchall()), self.db_cursor.description)
+            self.cache.put(key, entry[0], entry[1])
+        self.rows, self.description = entry
+        self.position = 0
+        return len(self.rows)
+
+    @property
+    def rowcount (self):
+        if self.rows is None:
+            return self.db_cursor.rowcount
+        return len(self.rows)
+
+    def fetchall (self):
+        if self.rows is None:
+            return self.db_cursor.fetchall()
+        rows = self.rows[self.position:]
+        self.position = len(self.rows)
+        return rows
+
+    def fetchmany (self, size=None):
+        if self.rows is None:
+            return self.db_cursor.fetchmany(size)
+        if size is None:
+            size = self.db_cursor.arraysize
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+    def fetchone (self):
+        if self.rows is None:
+            return self.db_cursor.fetchone()
+        if self.position >= len(self.rows):
+            return None
+        self.position += 1
+        return self.rows[self.position - 1]
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+igdb_clustering.py
+
+Module for clonotype clustering of the events in derived_segment_association. The exact
+clustering reproduces the cluster assignment of the stored procedure 'create_cluster'
+(identical donor, V, J and CDR3 length per locus) in a single pass over the table and
+writes the derived_cluster_meta, derived_cluster_comp and derived_cluster tables.
+The similarity clustering further splits each (donor, V, J, CDR3 length) bucket into groups
+of CDR3 amino acid sequences connected by a minimal identity (single linkage on the Hamming
+distance), writing the same tables.
+
+usage: igdb_clustering.py [-h] [-d DATABASE] [-i IDENTITY] [-w]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -d DATABASE, --database DATABASE
+                        Database containing the derived_segment_association table.
+  -i IDENTITY, --identity IDENTITY
+                        Cluster by CDR3 similarity, minimal fraction of identical amino acids.
+  -w, --write           Replace the derived_cluster tables with the computed clusters.
+"""
+
+import numpy as np
+import MySQLdb.cursors
+import igdb_connection as igdbconn
+import itertools as itt
+import argparse
+
+LOCI = ['H', 'K', 'L']
+
+association_statement = "SELECT event_id, donor_identifier, \
+    igh_segment_v, igh_segment_j, igh_cdr3, \
+    igk_segment_v, igk_segment_j, igk_cdr3, \
+    igl_segment_v, igl_segment_j, igl_cdr3 \
+    FROM derived_segment_association"
+
+# rows of the distance matrix computed at once, limits memory to block_size x n x CDR3 length bytes
+block_size = 256
+
+def iter_segment_association (cursor, donor=None, batch_size=10000):
+    """
+    Args:
+    cursor      Database cursor.
+    donor       Optional donor_identifier to restrict the events to.
+    batch_size  Number of rows fetched at once.
+
+    Yields:
+    Rows (event_id, donor_identifier, (v, j, cdr3) for H, K and L) of derived_segment_association.
+    """
+    statement = association_statement
+    if donor is not None:
+        statement = statement + " WHERE donor_identifier = '%s'" % (donor)
+    # ordered by donor, so that the similarity clustering can process one donor at a time
+    statement = statement + " ORDER BY donor_identifier, event_id"
+    cursor.execute(statement)
+    rows = cursor.fetchmany(batch_size)
+    while rows:
+        for row in rows:
+            yield (int(row[0]), row[1], [tuple(row[2+3*i:5+3*i]) for i in range(len(LOCI))])
+        rows = cursor.fetchmany(batch_size)
+
+def clonotype_key (donor, locus, segments):
+    """
+    Return the clonotype key (donor, locus, V, J, CDR3 length) of one locus of an event.
+    """
+    v_segment, j_segment, cdr3 = segments
+    if cdr3 is None:
+        cdr3_length = None
+    else:
+        cdr3_length = len(cdr3)
+    return (donor, locus, v_segment, j_segment, cdr3_length)
+
+def cluster_exact (rows):
+    """
+    Args:
+    rows        Iterable of rows as yielded by iter_segment_association.
+
+    Returns:
+    meta        List of (cluster_comp_id, nodes, donor_identifier, locus, segment_v, segment_j, cdr3_length).
+    comp        List of (cluster_id, nodes, cluster_comp_heavy_id, cluster_comp_kappa_id, cluster_comp_lambda_id).
+    cluster     List of (event_id, cluster_id).
+
+    The rows are consumed in one pass. Like 'create_cluster', clonotypes with a NULL component are listed
+    in meta, but never assigned to an event, and events without heavy chain clonotype are not clustered.
+    Ids are assigned in order of first occurrence.
+    """
+    meta_ids = {}
+    meta_events = []
+    event_comps = []
+
+    for event_id, donor, locus_segments in rows:
+        comp_ids = []
+        for locus, segments in zip(LOCI, locus_segments):
+            key = clonotype_key(donor, locus, segments)
+            try:
+                meta_id = meta_ids[key]
+            except KeyError:
+                meta_id = len(meta_events) + 1
+                meta_ids[key] = meta_id
+                meta_events.append(set())
+            meta_events[meta_id - 1].add(event_id)
+            if None in key:
+                comp_ids.append(None)
+            else:
+                comp_ids.append(meta_id)
+        if comp_ids[0] is not None:
+            event_comps.append((event_id, tuple(comp_ids)))
+
+    meta = [None] * len(meta_ids)
+    for key, meta_id in meta_ids.items():
+        meta[meta_id - 1] = (meta_id, len(meta_events[meta_id - 1])) + key
+
+    comp, cluster = group_components(event_comps)
+    return meta, comp, cluster
+
+def group_components (event_comps):
+    """
+    Args:
+    event_comps     List of (event_id, (heavy, kappa, lambda) cluster component ids).
+
+    Returns:
+    comp, cluster as in cluster_exact.
+    """
+    comp_ids = {}
+    comp_events = []
+    cluster = []
+    for event_id, comp_key in event_comps:
+        try:
+            cluster_id = comp_ids[comp_key]
+        except KeyError:
+            cluster_id = len(comp_events) + 1
+            comp_ids[comp_key] = cluster_id
+            comp_events.append(set())
+        comp_events[cluster_id - 1].add(event_id)
+        cluster.append((event_id, cluster_id))
+
+    comp = [None] * len(comp_ids)
+    for comp_key, cluster_id in comp_ids.items():
+        comp[cluster_id - 1] = (cluster_id, len(comp_events[cluster_id - 1])) + comp_key
+    return comp, cluster
+
+def find_root (parents, node):
+    """
+    Root of node in the union-find forest parents, halving the path on the way.
+    """
+    while parents[node] != node:
+        parents[node] = parents[parents[node]]
+        node = parents[node]
+    return node
+
+def hamming_components (cdr3_matrix, max_distance):
+    """
+    Args:
+    cdr3_matrix     NumPy uint8 array (sequences x positions) of CDR3 amino acids of identical length.
+    max_distance    Maximal number of differing positions for two sequences to be linked.
+
+    Returns:
+    labels          NumPy array of component labels (0..k-1) per sequence, connected components of
+                    the sequences linked by max_distance (single linkage).
+
+    The distances are computed block_size rows at a time and only the linked pairs of each block
+    are merged into a union-find forest, the n x n distance matrix is never built.
+    """
+    n = len(cdr3_matrix)
+    if n < 2:
+        return np.zeros(n, dtype=int)
+    parents = list(range(n))
+    for start in range(0, n, block_size):
+        block = cdr3_matrix[start:start+block_size]
+        distance = (block[:, np.newaxis, :] != cdr3_matrix[np.newaxis, :, :]).sum(axis=2)
+        rows, columns = np.nonzero(distance <= max_distance)
+        rows += start
+        # every pair once, the diagonal links a sequence to itself
+        upper = columns > rows
+        for row, column in zip(rows[upper].tolist(), columns[upper].tolist()):
+            row_root = find_root(parents, row)
+            column_root = find_root(parents, column)
+            if row_root != column_root:
+                parents[max(row_root, column_root)] = min(row_root, column_root)
+    roots = np.array([find_root(parents, node) for node in range(n)])
+    return np.unique(roots, return_inverse=True)[1]
+
+def cdr3_array (cdr3s, cdr3_length):
+    """
+    Returns:
+    NumPy uint8 array (sequences x positions) of the CDR3 amino acid sequences. Byte and unicode
+    strings are accepted, amino acids must be ASCII letters.
+    """
+    try:
+        cdr3_bytes = ''.join(cdr3s).encode('ascii')
+    except UnicodeError:
+        raise ValueError("CDR3 sequences contain non-ASCII characters")
+    return np.frombuffer(cdr3_bytes, dtype=np.uint8).reshape(len(cdr3s), cdr3_length)
+
+def cluster_similarity (rows, identity):
+    """
+    Args:
+    rows        Iterable of rows as yielded by iter_segment_association, ordered by donor.
+    identity    Minimal fraction of identical CDR3 amino acids for two events to be linked.
+
+    Returns:
+    meta, comp, cluster as in cluster_exact. Several cluster components (meta) can share the same
+    (donor, locus, V, J, CDR3 length).
+
+    Events are processed donor by donor. Within each (donor, locus, V, J, CDR3 length) bucket the
+    CDR3 sequences are compared as a NumPy array, comparisons across buckets are never made.
+    """
+    meta = []
+    event_comps = []
+
+    for donor, donor_rows in itt.groupby(rows, key=lambda row: row[1]):
+        bucket_keys = []
+        buckets = {}
+        donor_events = []
+        for event_id, donor, locus_segments in donor_rows:
+            event_keys = []
+            for locus, segments in zip(LOCI, locus_segments):
+                key = clonotype_key(donor, locus, segments)
+                if key not in buckets:
+                    buckets[key] = ([], [])
+                    bucket_keys.append(key)
+                buckets[key][0].append(event_id)
+                buckets[key][1].append(segments[2])
+                event_keys.append((key, len(buckets[key][0]) - 1))
+            donor_events.append((event_id, event_keys))
+
+        # component id of every bucket member
+        bucket_comp_ids = {}
+        for key in bucket_keys:
+            event_ids, cdr3s = buckets[key]
+            if None in key:
+                labels = np.zeros(len(event_ids), dtype=int)
+            else:
+                cdr3_length = key[4]
+                cdr3_matrix = cdr3_array(cdr3s, cdr3_length)
+                max_distance = int(np.floor((1 - identity) * cdr3_length + 1e-9))
+                labels = hamming_components(cdr3_matrix, max_distance)
+            first_id = len(meta) + 1
+            # distinct events per component: count the (label, event_id) pairs once after sorting
+            event_array = np.array(event_ids)
+            order = np.lexsort((event_array, labels))
+            sorted_labels = labels[order]
+            sorted_events = event_array[order]
+            distinct = np.ones(len(order), dtype=bool)
+            distinct[1:] = (sorted_labels[1:] != sorted_labels[:-1]) | (sorted_events[1:] != sorted_events[:-1])
+            component_nodes = np.bincount(sorted_labels[distinct], minlength=labels.max() + 1 if len(labels) else 0)
+            for nodes in component_nodes:
+                meta.append((len(meta) + 1, int(nodes)) + key)
+            bucket_comp_ids[key] = first_id + labels
+
+        for event_id, event_keys in donor_events:
+            comp_ids = []
+            for key, index in event_keys:
+                if None in key:
+                    comp_ids.append(None)
+                else:
+                    comp_ids.append(int(bucket_comp_ids[key][index]))
+            if comp_ids[0] is not None:
+                event_comps.append((event_id, tuple(comp_ids)))
+
+    comp, cluster = group_components(event_comps)
+    return meta, comp, cluster
+
+def write_cluster_tables (cursor, meta, comp, cluster):
+    """
+    Replace derived_cluster_meta, derived_cluster_comp and derived_cluster with the given clusters.
+    The table definitions are the ones used by 'create_cluster'.
+    """
+    cursor.execute("DROP TABLE IF EXISTS derived_cluster_meta, derived_cluster_comp, derived_cluster;")
+    cursor.execute("CREATE TABLE derived_cluster_meta ( \
+        `cluster_comp_id` int(10) unsigned NOT NULL AUTO_INCREMENT, \
+        `nodes` int(10) unsigned NOT NULL, \
+        `donor_identifier` varchar(45) NOT NULL, \
+        `locus` char(1) NOT NULL, \
+        `segment_v` varchar(20), \
+        `segment_j` varchar(20), \
+        `cdr3_length` int(10) unsigned, \
+        UNIQUE KEY `cluster_comp_id_UNIQUE` (`cluster_comp_id`) \
+        );")
+    cursor.execute("CREATE TABLE derived_cluster_comp ( \
+        `cluster_id` int(10) unsigned NOT NULL AUTO_INCREMENT, \
+        `nodes` int(10) unsigned NOT NULL, \
+        `cluster_comp_heavy_id` int(10) unsigned NOT NULL, \
+        `cluster_comp_kappa_id` int(10) unsigned, \
+        `cluster_comp_lambda_id` int(10) unsigned, \
+        UNIQUE KEY `cluster_id_UNIQUE` (`cluster_id`), \
+        KEY `cluster_comp` (`cluster_comp_heavy_id`, `cluster_comp_kappa_id`, `cluster_comp_lambda_id`) \
+        );")
+    cursor.execute("CREATE TABLE derived_cluster ( \
+        `event_id` int(10) unsigned NOT NULL, \
+        `cluster_id` int(10) unsigned NOT NULL \
+        );")
+    cursor.executemany("INSERT INTO derived_cluster_meta \
+        (cluster_comp_id, nodes, donor_identifier, locus, segment_v, segment_j, cdr3_length) \
+        VALUES (%s, %s, %s, %s, %s, %s, %s)", meta)
+    cursor.executemany("INSERT INTO derived_cluster_comp \
+        (cluster_id, nodes, cluster_comp_heavy_id, cluster_comp_kappa_id, cluster_comp_lambda_id) \
+        VALUES (%s, %s, %s, %s, %s)", comp)
+    cursor.executemany("INSERT INTO derived_cluster (event_id, cluster_id) VALUES (%s, %s)", cluster)
+    cursor.connection.commit()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--database",
+                        type = str,
+                        help="manual input of database scheme")
+    parser.add_argument("-w", "--write",
+                        help="replace the derived_cluster tables",
+                        action="store_true")
+    parser.add_argument("-i", "--identity",
+                        type = float,
+                        help="cluster by CDR3 similarity with minimal identity (0-1)")
+    args = parser.parse_args()
+
+    # connect to database via ~/.my.conf settings
+    connection = igdbconn.connect(args.database)
+    cursor = connection.cursor()
+
+    # server side cursor, rows are streamed instead of buffered
+    stream_cursor = connection.cursor(MySQLdb.cursors.SSCursor)
+    if args.identity is None:
+        meta, comp, cluster = cluster_exact(iter_segment_association(stream_cursor))
+    else:
+        meta, comp, cluster = cluster_similarity(iter_segment_association(stream_cursor), args.identity)
+    stream_cursor.close()
+    print "%d clonotypes, %d clusters, %d clustered events" % (len(meta), len(comp), len(cluster))
+
+    if args.write:
+        write_cluster_tables(cursor, meta, comp, cluster)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+igdb_connection.py
+
+Module for the database connections of the igdb scripts. Connections are created lazily on first
+use with the settings of ~/.my.cnf (group mysql_igdb) and kept in a pool per database, so that
+several plots generated in one process reuse a few connections instead of connecting once each.
+Server side timeouts of the session can be set per pool.
+
+Usage:
+    pool = get_pool(db)
+    with pool.cursor() as cursor:
+        cursor.execute(statement)
+        rows = cursor.fetchall()
+"""
+
+import MySQLdb as mysql
+import threading
+import atexit
+from contextlib import contextmanager
+
+default_config_file = "~/.my.cnf"
+default_config_group = 'mysql_igdb'
+default_pool_size = 4
+
+# pools of this process by (db, config group)
+pools = {}
+pools_lock = threading.Lock()
+
+class ConnectionPool (object):
+    """
+    Pool of up to size connections to one database. Connections are opened on demand, returned
+    connections are reused after a ping. If all connections are in use, acquire waits.
+
+    Timeouts (in seconds) are set for each new session:
+    wait_timeout        Idle time after which the server closes the connection.
+    net_read_timeout    Time the server waits for data from the client.
+    max_execution_time  Maximal run time of a SELECT statement (MySQL 5.7.8 or later).
+    """
+
+    def __init__ (self, db=None, size=default_pool_size, config_file=default_config_file,
+                  config_group=default_config_group, connect_timeout=None, wait_timeout=None,
+                  net_read_timeout=None, max_execution_time=None):
+        self.db = db
+        self.size = size
+        self.config_file = config_file
+        self.config_group = config_group
+        self.connect_timeout = connect_timeout
+        self.session_settings = []
+        if wait_timeout is not None:
+            self.session_settings.append("wait_timeout = %d" % (wait_timeout))
+        if net_read_timeout is not None:
+            self.session_settings.append("net_read_timeout = %d" % (net_read_timeout))
+        if max_execution_time is not None:
+            self.session_settings.append("max_execution_time = %d" % (max_execution_time * 1000))
+        self.idle = []
+        self.n_open = 0
+        self.condition = threading.Condition()
+
+    def grow (self, size):
+        """
+        Allow at least size connections, e.g. for size parallel workers.
+        """
+        with self.condition:
+            if size > self.size:
+                self.size = size
+                self.condition.notify_all()
+
+    def connect (self):
+        connect_args = {'read_default_file': self.config_file, 'read_default_group': self.config_group}
+        if self.db is not None:
+            connect_args['db'] = self.db
+        if self.connect_timeout is not None:
+            connect_args['connect_timeout'] = self.connect_timeout
+        connection = mysql.connect(**connect_args)
+        if self.session_settings:
+            cursor = connection.cursor()
+            cursor.execute("SET SESSION " + ", ".join(self.session_settings) + ";")
+            cursor.close()
+        return connection
+
+    def acquire (self):
+        """
+        Return a connection of the pool, opened if no idle connection is left.
+        """
+        with self.condition:
+            while not self.idle and self.n_open >= self.size:
+                self.condition.wait()
+            if self.idle:
+                connection = self.idle.pop()
+            else:
+                connection = None
+                self.n_open += 1
+        if connection is not None:
+            try:
+                connection.ping()
+                return connection
+            except mysql.OperationalError:
+                # closed by the server in the meantime (wait_timeout), replaced by a new one
+                pass
+        try:
+            return self.connect()
+        except:
+            with self.condition:
+                self.n_open -= 1
+                self.condition.notify()
+            raise
+
+    def release (self, connection, close=False):
+        """
+        Return a connection to the pool. Uncommitted changes are rolled back.
+        """
+        try:
+            if close:
+                connection.close()
+            else:
+                connection.rollback()
+        except mysql.Error:
+            close = True
+        with self.condition:
+            if close:
+                self.n_open -= 1
+            else:
+                self.idle.append(connection)
+            self.condition.notify()
+
+    @contextmanager
+    def connection (self):
+        """
+        Context manager of a pooled connection. Changes are committed when the block ends
+        without exception.
+        """
+        connection = self.acquire()
+        try:
+            yield connection
+            connection.commit()
+        except mysql.OperationalError:
+            self.release(connection, close=True)
+            raise
+        except:
+            self.release(connection)
+            raise
+        else:
+            self.release(connection)
+
+    @contextmanager
+    def cursor (self, cursor_class=None):
+        """
+        Context manager of a cursor on a pooled connection. cursor_class may be
+        MySQLdb.cursors.SSCursor for results streamed from the server.
+        """
+        with self.connection() as connection:
+            if cursor_class is None:
+                cursor = connection.cursor()
+            else:
+                cursor = connection.cursor(cursor_class)
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def close (self):
+        """
+        Close all idle connections of the pool.
+        """
+        with self.condition:
+            idle = self.idle
+            self.idle = []
+            self.n_open -= len(idle)
+        for connection in idle:
+            try:
+                connection.close()
+            except mysql.Error:
+                pass
+
+def get_pool (db=None, config_group=default_config_group, **settings):
+    """
+    Return the pool of db, created on first use with settings (see ConnectionPool).
+    Settings of later calls for the same db are ignored.
+    """
+    with pools_lock:
+        if (db, config_group) not in pools:
+            pools[(db, config_group)] = ConnectionPool(db, config_group=config_group, **settings)
+        return pools[(db, config_group)]
+
+def connect (db=None, **settings):
+    """
+    Return a connection of the pool of db for use until the end of the script. Scripts that are
+    run from a batch driver should prefer the context managers of the pool.
+    """
+    return get_pool(db, **settings).acquire()
+
+def close_pools ():
+    with pools_lock:
+        for pool in pools.values():
+            pool.close()
+
+atexit.register(close_pools)
@@ -5,16 +5,27 @@ bcelldb_plotting.py
 Module that contains standard funtions for plotting data from the igdb.
 """
 
-import bcelldb_init as bcelldb
 import matplotlib as mpl
 mpl.use('Agg')
 import numpy as np
 import numpy.random as random
+import os
 import sys
+import zlib
 import colorsys
 from datetime import datetime as dt
 
-conf = bcelldb.get_config()
+conf = None
+
+def get_config ():
+    """
+    Return the bcelldb configuration, read on first use.
+    """
+    global conf
+    if conf is None:
+        import bcelldb_init as bcelldb
+        conf = bcelldb.get_config()
+    return conf
 
 # Get log information for a plot
 # date, user, database, software version
@@ -47,30 +58,39 @@ def plot_log (object_name, args, db, short='T'):
 
 
 # Define colors
+# The color table is read on first use from the directory of this module. HLS values are
+# converted to RGB once when the table is read.
 
-colortxt = 'seg_families_colors.txt'
-color_file = open(colortxt, 'r').readlines()
+colortxt = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'seg_families_colors.txt')
 
-color_dict = {}
+color_dict = None
 
-for line in color_file:
-    if (line != "\n" and line[0] != '#'):
-        entries = line[:-1].split(',')
-        try:
-            color_dict[entries[0]] = colorsys.hls_to_rgb(float(entries[1]), float(entries[2]), float(entries[3])) 
-        except ValueError:
-            next
+def load_colors ():
+    global color_dict
+    if color_dict is None:
+        colors = {}
+        for line in open(colortxt, 'r'):
+            if (line != "\n" and line[0] != '#'):
+                entries = line.rstrip('\r\n').split(',')
+                try:
+                    colors[entries[0]] = colorsys.hls_to_rgb(float(entries[1]), float(entries[2]), float(entries[3])) 
+                except (ValueError, IndexError):
+                    continue
+        color_dict = colors
+    return color_dict
 
 def get_color (name):
+    colors = load_colors()
     try:
-        return color_dict[name]
+        return colors[name]
     except KeyError:
         try:
             print "WARNING COLOR CODE"
             print name + " does not have a color definition in " + colortxt
             print "Assigning random color to " + name
-            color_dict[name] = random_colors(1)[0]
-            return color_dict[name]
+            # seeded by the name, so that a name gets the same color in every plot
+            colors[name] = random_colors(1, zlib.crc32(name) & 0xffffffff)[0]
+            return colors[name]
         except TypeError:
             print 'None Type for one of the coloridentifiers. Choosing black color.'
             return 'black'
@@ -81,10 +101,15 @@ def hex_to_rgb(value):
     lv = len(value)
     return tuple(int(value[i:i + lv // 3], 16)/255 for i in range(0, lv, lv // 3))
 
-# N random colors
-def random_colors (N):
-    colors = []
-    for n in range(N):
-        rgb = tuple(random.random_sample(3))
-        colors.append(rgb)
-    return colors
+# N random colors, memoized by (N, seed)
+random_colors_cache = {}
+
+def random_colors (N, seed=0):
+    """
+    Return N random RGB colors. The colors are determined by seed, repeated calls return the
+    same (cached) list.
+    """
+    if (N, seed) not in random_colors_cache:
+        random_state = random.RandomState(seed)
+        random_colors_cache[(N, seed)] = [tuple(rgb) for rgb in random_state.random_sample((N, 3))]
+    return list(random_colors_cache[(N, seed)])
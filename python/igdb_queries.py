@@ -5,15 +5,77 @@ Module for common igdb database queries, functions for standardized reading of d
 @author: katharina
 """
 
-def read_eventfile (eventfile, db):
+import numpy as np
+import MySQLdb as mysql
+import MySQLdb.cursors
+from MySQLdb.constants import FIELD_TYPE
+import os
+import re
+import csv
+import json
+import time
+import atexit
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+import igdb_connection as igdbconn
+
+# parsed event files by (path, modification time), event_id arrays by (db, statement hash)
+# and event sets materialized by this process by (db, statement hash)
+eventfile_cache = {}
+event_id_cache = {}
+event_set_id_cache = {}
+
+def parse_eventfile (eventfile):
     """
     Args:
     eventfile   File containing event names and event queries in the following format:
                 +>event_name1
                 event_query1
+                +>event_name2
+                event_query2
+    
+    Returns:
+    event_names         List of names given to each set of events.
+    raw_statements      List of event queries with their database placeholders not yet filled in.
+    
+    The file is parsed only once as long as it is not modified.
+    """
+    key = (os.path.abspath(eventfile), os.path.getmtime(eventfile))
+    if key not in eventfile_cache:
+        event_names = []
+        raw_statements = []
+        infile = open(eventfile, 'r')
+        for line in infile:
+            if line[:2] == '+>':
+                event_names.append(line[2:].rstrip('\r\n'))
+                raw_statements.append('')
+            elif line.strip() and raw_statements:
+                raw_statements[-1] = raw_statements[-1] + line
+        infile.close()
+        eventfile_cache[key] = (event_names, raw_statements)
+    event_names, raw_statements = eventfile_cache[key]
+    return list(event_names), list(raw_statements)
+
+def fill_placeholders (statement, db):
+    """
+    Fill in the database of an event query. Named placeholders %(db)s and any number of
+    positional placeholders %s are supported, %% stands for a literal %.
+    """
+    if '%(' in statement:
+        return statement % {'db': db}
+    n_placeholders = len(re.findall(r'%s', statement.replace('%%', '')))
+    return statement % ((db,) * n_placeholders)
+
+def read_eventfile (eventfile, db):
+    """
+    Args:
+    eventfile   File containing event names and event queries in the following format:
                 +>event_name1
                 event_query1
-                Event query is completed by %(db,db,db,db)                
+                +>event_name2
+                event_query2
+                The database is filled in for %(db)s or for every %s.
     db          Database.
     
     Returns:
@@ -21,88 +83,772 @@ def read_eventfile (eventfile, db):
     event_statements    List of database query command for each set of events.
     
     """
-    infile = open(eventfile, 'r').readlines()
-    event_names = []
-    event_statements = []
-    event_statement = ''
-
-    for line in infile:
-        if line[:2] == '+>':
-            event_names.append(line[2:-1])
-            # update the event statement list, when new event comes in, but only from second identifier on
-            if not len(event_names) == 1:
-                event_statement = event_statement % (db,db,db,db)
-                event_statements.append(event_statement)
-                event_statement = ''
-        elif line != '\n':
-            event_statement = event_statement + line
-    # add last event statement
-    event_statement = event_statement % (db,db,db,db)
-    event_statements.append(event_statement)
+    event_names, raw_statements = parse_eventfile(eventfile)
+    event_statements = [fill_placeholders(statement, db) for statement in raw_statements]
     
     return event_names, event_statements
+
+def read_event_sets (eventfile, db):
+    """
+    Return the event groups of an event file as list of EventSet.
+    """
+    event_names, event_statements = read_eventfile(eventfile, db)
+    return [EventSet(event_name, event_statement, db) for event_name, event_statement in zip(event_names, event_statements)]
+
+class EventSet (object):
+    """
+    Named group of events, defined by an event statement or by an array of event_ids.
+    
+    The event_ids of a statement are fetched once per (db, statement hash) and kept in
+    event_id_cache as sorted array. Passing a cursor of igdb_cache.QueryCache keeps them on
+    disk across runs. Union (|), intersection (&) and difference (-) of sets are computed
+    on these arrays without further queries.
+    """
+    
+    def __init__ (self, name, statement, db, event_ids=None):
+        self.name = name
+        self.db = db
+        if statement is None:
+            event_ids = np.unique(np.asarray(event_ids, dtype=np.int64))
+            statement = "SELECT event_id FROM %s.event WHERE event_id IN (%s)" % (db, event_list_sql(list(event_ids)))
+        self.statement = statement
+        self.hash = hashlib.sha1(statement).hexdigest()
+        if event_ids is not None:
+            event_id_cache[(db, self.hash)] = event_ids
+    
+    def __repr__ (self):
+        return "EventSet(%r, db=%r, hash=%s)" % (self.name, self.db, self.hash[:8])
+    
+    def is_loaded (self):
+        return (self.db, self.hash) in event_id_cache
+    
+    def event_ids (self, db_cursor=None):
+        """
+        Return the sorted array of event_ids, queried through db_cursor on first use.
+        """
+        key = (self.db, self.hash)
+        if key not in event_id_cache:
+            if db_cursor is None:
+                raise ValueError("event set %s is not loaded yet, a database cursor is required" % (self.name))
+            db_cursor.execute(self.statement)
+            event_ids = np.array([row[0] for row in db_cursor.fetchall()], dtype=np.int64)
+            event_id_cache[key] = np.unique(event_ids)
+        return event_id_cache[key]
+    
+    def __len__ (self):
+        return len(self.event_ids())
+    
+    def __contains__ (self, event_id):
+        event_ids = self.event_ids()
+        position = np.searchsorted(event_ids, event_id)
+        return position < len(event_ids) and event_ids[position] == event_id
+    
+    def combine (self, other, operation, function):
+        if self.db != other.db:
+            raise ValueError("event sets %s and %s refer to different databases" % (self.name, other.name))
+        return EventSet("(%s %s %s)" % (self.name, operation, other.name), None, self.db,
+                        function(self.event_ids(), other.event_ids()))
+    
+    def union (self, other):
+        return self.combine(other, '|', np.union1d)
+    
+    def intersection (self, other):
+        return self.combine(other, '&', lambda a, b: np.intersect1d(a, b, assume_unique=True))
+    
+    def difference (self, other):
+        return self.combine(other, '-', lambda a, b: np.setdiff1d(a, b, assume_unique=True))
+    
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+# seconds materialize_event_sets waits for a concurrent run refreshing the event sets
+event_set_lock_timeout = 600
+
+def materialize_event_sets (event_names, event_statements, db_cursor):
+    """
+    Args:
+    event_names         List of names given to each set of events.
+    event_statements    List of event statements as returned by read_eventfile.
+    db_cursor           Database cursor.
+    
+    Returns:
+    event_set_ids       List of event_set_id, one per event statement.
+    
+    Resolves every event statement once into the indexed table event_set_members, so that
+    downstream queries join this table (see event_set_join) instead of repeating the statement
+    as IN (subquery). Name, size, SHA1 of the statement and a checksum of the members are
+    recorded in event_sets. The event_set_id of a statement stays the same across runs.
+    The statement is evaluated once per process into a temporary table, and the stored members
+    are only replaced if their checksum differs. The replacement is done in one transaction while
+    holding a named lock (GET_LOCK), so that concurrent runs never see a partial set.
+    The statements have to return a column named event_id.
+    """
+    db_cursor.execute("SELECT DATABASE();")
+    database = db_cursor.fetchall()[0][0]
+    if all((database, hashlib.sha1(event_statement).hexdigest()) in event_set_id_cache
+           for event_statement in event_statements):
+        return [event_set_id_cache[(database, hashlib.sha1(event_statement).hexdigest())]
+                for event_statement in event_statements]
+    
+    db_cursor.execute("CREATE TABLE IF NOT EXISTS event_sets ( \
+        event_set_id int(10) unsigned NOT NULL AUTO_INCREMENT, \
+        name varchar(255) NOT NULL, \
+        statement_hash char(40) NOT NULL, \
+        size int(10) unsigned NOT NULL, \
+        members_checksum varchar(64), \
+        created datetime, \
+        PRIMARY KEY (event_set_id), \
+        UNIQUE KEY statement_hash (statement_hash) \
+        );")
+    db_cursor.execute("SHOW COLUMNS FROM event_sets LIKE 'members_checksum';")
+    if not db_cursor.fetchall():
+        # event_sets created before the checksum was recorded
+        db_cursor.execute("ALTER TABLE event_sets ADD COLUMN members_checksum varchar(64) AFTER size;")
+    db_cursor.execute("CREATE TABLE IF NOT EXISTS event_set_members ( \
+        event_set_id int(10) unsigned NOT NULL, \
+        event_id int(10) unsigned NOT NULL, \
+        PRIMARY KEY (event_set_id, event_id), \
+        KEY event_id (event_id) \
+        );")
+    
+    lock_name = "%s.event_sets" % (database)
+    db_cursor.execute("SELECT GET_LOCK(%s, %s);", (lock_name, event_set_lock_timeout))
+    if db_cursor.fetchall()[0][0] != 1:
+        raise RuntimeError("Timeout waiting for the lock %s held by a concurrent run" % (lock_name))
+    try:
+        event_set_ids = []
+        for event_name, event_statement in zip(event_names, event_statements):
+            statement_hash = hashlib.sha1(event_statement).hexdigest()
+            db_cursor.execute("DROP TEMPORARY TABLE IF EXISTS temp_event_set;")
+            db_cursor.execute("CREATE TEMPORARY TABLE temp_event_set ( \
+                event_id int(10) unsigned NOT NULL, \
+                PRIMARY KEY (event_id) \
+                );")
+            db_cursor.execute("INSERT IGNORE INTO temp_event_set (event_id) \
+                SELECT event_id FROM (%s) AS event_statement;" % (event_statement.strip().rstrip(';')))
+            db_cursor.execute("SELECT COUNT(*), IFNULL(SUM(event_id), 0), IFNULL(BIT_XOR(CRC32(event_id)), 0) \
+                FROM temp_event_set;")
+            size, id_sum, id_crc = db_cursor.fetchall()[0]
+            members_checksum = "%d:%d:%d" % (size, id_sum, id_crc)
+            
+            db_cursor.execute("SELECT event_set_id, members_checksum FROM event_sets WHERE statement_hash = %s;",
+                              (statement_hash,))
+            rows = db_cursor.fetchall()
+            if rows:
+                event_set_id = int(rows[0][0])
+                replace = rows[0][1] != members_checksum
+            else:
+                db_cursor.execute("INSERT INTO event_sets (name, statement_hash, size) VALUES (%s, %s, 0);",
+                                  (event_name, statement_hash))
+                event_set_id = int(db_cursor.lastrowid)
+                replace = True
+            if replace:
+                db_cursor.execute("DELETE FROM event_set_members WHERE event_set_id = %d;" % (event_set_id))
+                db_cursor.execute("INSERT INTO event_set_members (event_set_id, event_id) \
+                    SELECT %d, event_id FROM temp_event_set;" % (event_set_id))
+                db_cursor.execute("UPDATE event_sets SET name = %s, created = NOW(), size = %s, members_checksum = %s \
+                    WHERE event_set_id = %s;", (event_name, size, members_checksum, event_set_id))
+            db_cursor.connection.commit()
+            event_set_ids.append(event_set_id)
+            event_set_id_cache[(database, statement_hash)] = event_set_id
+        db_cursor.execute("DROP TEMPORARY TABLE IF EXISTS temp_event_set;")
+    except:
+        db_cursor.connection.rollback()
+        raise
+    finally:
+        db_cursor.execute("SELECT RELEASE_LOCK(%s);", (lock_name,))
+        db_cursor.fetchall()
+    
+    return event_set_ids
+
+def event_set_groups (event_set_ids):
+    """
+    Return a dictionary mapping each event_set_id to the indices of all event groups resolved
+    to it. Event groups with the same statement share one event_set_id.
+    """
+    group_indices = {}
+    for group_index, event_set_id in enumerate(event_set_ids):
+        group_indices.setdefault(event_set_id, []).append(group_index)
+    return group_indices
+
+def event_set_join (event_set_id, column, db=None):
+    """
+    Return the JOIN clause restricting column (an event_id column) to the members of an event set.
+    """
+    if db is None:
+        table = "event_set_members"
+    else:
+        table = "%s.event_set_members" % (db)
+    return "JOIN %s AS event_set ON event_set.event_id = %s AND event_set.event_set_id = %d" % (table, column, event_set_id)
+
+def event_set_statement (event_set_id):
+    """
+    Return an SQL statement yielding the event_ids of an event set, for functions expecting an event statement.
+    """
+    return "SELECT event_id FROM event_set_members WHERE event_set_id = %d" % (event_set_id)
+
+def check_index_use (statement, db_cursor):
+    """
+    Run EXPLAIN on statement and print a warning for every table read by a full table scan.
+    
+    Returns:
+    List of the tables read by a full table scan.
+    """
+    db_cursor.execute("EXPLAIN " + statement)
+    columns = [description[0] for description in db_cursor.description]
+    full_scans = []
+    for row in db_cursor.fetchall():
+        plan = dict(zip(columns, row))
+        if plan.get('type') == 'ALL':
+            full_scans.append(plan.get('table'))
+    for table in full_scans:
+        print "WARNING: query plan reads %s by a full table scan:" % (table)
+        print " ".join(statement.split())
+    return full_scans
+
+# active query profile, see start_profile
+query_profile = None
+
+def statement_fingerprint (statement):
+    """
+    Normalize statement for the aggregation of profiles: whitespace is collapsed, string and
+    number literals are replaced by ? and lists of literals by (?+).
+    """
+    fingerprint = " ".join(statement.split())
+    fingerprint = re.sub(r"'(?:[^'\\]|\\.)*'", "?", fingerprint)
+    fingerprint = re.sub(r'"(?:[^"\\]|\\.)*"', "?", fingerprint)
+    fingerprint = re.sub(r"\b\d+(?:\.\d+)?\b", "?", fingerprint)
+    fingerprint = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?+)", fingerprint)
+    return fingerprint.rstrip(';').rstrip()
+
+def plan_full_scans (plan):
+    """
+    Return the tables read by a full table scan (access_type ALL) in an EXPLAIN FORMAT=JSON plan.
+    """
+    full_scans = []
+    if isinstance(plan, dict):
+        if plan.get('access_type') == 'ALL':
+            full_scans.append(plan.get('table_name'))
+        for value in plan.values():
+            full_scans += plan_full_scans(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            full_scans += plan_full_scans(value)
+    return full_scans
+
+class QueryProfile (object):
+    """
+    Statistics of the executed statements aggregated by fingerprint: number of calls, wall time
+    (execute and fetch), rows and bytes fetched and, if explain is set, the EXPLAIN FORMAT=JSON
+    plan of the first call of each SELECT fingerprint with the tables read by full scans.
+    """
+    
+    def __init__ (self, explain=False):
+        self.explain = explain
+        self.stats = {}
+        self.lock = threading.Lock()
+    
+    def entry (self, fingerprint):
+        with self.lock:
+            if fingerprint not in self.stats:
+                self.stats[fingerprint] = {'calls': 0, 'time': 0., 'max_time': 0., 'rows': 0, 'bytes': 0,
+                                           'plan': None, 'full_scans': []}
+            return self.stats[fingerprint]
+    
+    def record (self, fingerprint, calls=0, seconds=0., rows=0, n_bytes=0):
+        entry = self.entry(fingerprint)
+        with self.lock:
+            entry['calls'] += calls
+            entry['time'] += seconds
+            entry['max_time'] = max(entry['max_time'], seconds)
+            entry['rows'] += rows
+            entry['bytes'] += n_bytes
+    
+    def needs_plan (self, fingerprint):
+        return self.explain and self.entry(fingerprint)['plan'] is None
+    
+    def set_plan (self, fingerprint, plan):
+        entry = self.entry(fingerprint)
+        with self.lock:
+            entry['plan'] = plan
+            entry['full_scans'] = sorted(set(plan_full_scans(plan)))
+    
+    def rows (self):
+        """
+        Aggregated statistics, ordered by total time.
+        """
+        with self.lock:
+            rows = [dict(entry, fingerprint=fingerprint, id=hashlib.sha1(fingerprint).hexdigest()[:12])
+                    for fingerprint, entry in self.stats.items()]
+        rows.sort(key=lambda row: -row['time'])
+        return rows
+    
+    def write (self, path):
+        """
+        Write the profile as JSON (path ending with .json) or CSV.
+        """
+        rows = self.rows()
+        out = open(path, 'w')
+        if path.endswith('.json'):
+            json.dump(rows, out, indent=2)
+        else:
+            writer = csv.writer(out)
+            writer.writerow(['id', 'calls', 'time', 'mean_time', 'max_time', 'rows', 'bytes', 'full_scans', 'fingerprint'])
+            for row in rows:
+                writer.writerow([row['id'], row['calls'], "%.6f" % (row['time']), "%.6f" % (row['time'] / max(row['calls'], 1)),
+                                 "%.6f" % (row['max_time']), row['rows'], row['bytes'], " ".join(str(table) for table in row['full_scans']),
+                                 row['fingerprint']])
+        out.close()
+
+def start_profile (path, explain=False):
+    """
+    Profile all cursors passed through instrument from now on and write the profile to path
+    at exit. Returns the active profile, an already started profile is kept.
+    """
+    global query_profile
+    if query_profile is None:
+        query_profile = QueryProfile(explain)
+        atexit.register(query_profile.write, path)
+    return query_profile
+
+def instrument (db_cursor):
+    """
+    Return db_cursor wrapped by a ProfiledCursor if a profile was started, db_cursor otherwise.
+    """
+    if query_profile is None or db_cursor is None:
+        return db_cursor
+    return ProfiledCursor(db_cursor, query_profile)
+
+def row_bytes (rows):
+    """
+    Estimated size of fetched rows: length of strings, 8 bytes for other values.
+    """
+    n_bytes = 0
+    for row in rows:
+        for value in row:
+            if isinstance(value, basestring):
+                n_bytes += len(value)
+            elif value is not None:
+                n_bytes += 8
+    return n_bytes
+
+class ProfiledCursor (object):
+    """
+    Wrapper of a database cursor recording every statement in a QueryProfile. All other
+    attributes are passed to the wrapped cursor.
+    """
+    
+    def __init__ (self, db_cursor, profile):
+        self.db_cursor = db_cursor
+        self.profile = profile
+        self.fingerprint = None
+    
+    def __getattr__ (self, name):
+        return getattr(self.db_cursor, name)
+    
+    def execute (self, statement, args=None):
+        if args is not None:
+            statement = statement % self.db_cursor.connection.literal(args)
+        self.fingerprint = statement_fingerprint(statement)
+        if self.profile.needs_plan(self.fingerprint) and statement.lstrip().upper().startswith('SELECT'):
+            try:
+                self.db_cursor.execute("EXPLAIN FORMAT=JSON " + statement)
+                self.profile.set_plan(self.fingerprint, json.loads(self.db_cursor.fetchall()[0][0]))
+            except (mysql.Error, ValueError):
+                # servers without FORMAT=JSON
+                self.profile.set_plan(self.fingerprint, {})
+        start = time.time()
+        result = self.db_cursor.execute(statement)
+        self.profile.record(self.fingerprint, calls=1, seconds=time.time() - start)
+        return result
+    
+    def fetched (self, rows, seconds):
+        if self.fingerprint is not None:
+            self.profile.record(self.fingerprint, seconds=seconds, rows=len(rows), n_bytes=row_bytes(rows))
+        return rows
     
+    def fetchall (self):
+        start = time.time()
+        rows = self.db_cursor.fetchall()
+        return self.fetched(rows, time.time() - start)
+    
+    def fetchmany (self, size=None):
+        start = time.time()
+        if size is None:
+            rows = self.db_cursor.fetchmany()
+        else:
+            rows = self.db_cursor.fetchmany(size)
+        return self.fetched(rows, time.time() - start)
+    
+    def fetchone (self):
+        start = time.time()
+        row = self.db_cursor.fetchone()
+        if row is not None:
+            self.fetched([row], time.time() - start)
+        return row
+
+def map_event_groups (function, event_statements, db, jobs=1, db_cursor=None, cursor_wrapper=None):
+    """
+    Args:
+    function            Function called as function(event_statement, cursor) for each event group.
+    event_statements    List of event statements as returned by read_eventfile.
+    db                  Database.
+    jobs                Number of event groups queried in parallel.
+    db_cursor           Cursor used if jobs is 1.
+    cursor_wrapper      Optional function applied to the cursors of the worker threads
+                        (e.g. QueryCache.cursor).
+    
+    Returns:
+    List of the results of function, in the order of event_statements.
+    
+    With more than one job, the event groups are dispatched over a thread pool. Every call
+    takes its own connection from the connection pool of db (igdb_connection), so that the
+    server processes several queries at once.
+    """
+    if jobs is None or jobs <= 1 or len(event_statements) <= 1:
+        return [function(event_statement, db_cursor) for event_statement in event_statements]
+    
+    connection_pool = igdbconn.get_pool(db)
+    # one connection per worker in addition to the one of the calling script
+    connection_pool.grow(jobs + 1)
+    
+    def call (event_statement):
+        with connection_pool.cursor() as cursor:
+            cursor = instrument(cursor)
+            if cursor_wrapper is not None:
+                cursor = cursor_wrapper(cursor)
+            return function(event_statement, cursor)
+    
+    pool = ThreadPool(min(jobs, len(event_statements)))
+    try:
+        results = pool.map(call, event_statements)
+    finally:
+        pool.close()
+        pool.join()
+    return results
 
+# seconds refresh_heavy_light waits for a concurrent run refreshing heavy_light
+heavy_light_lock_timeout = 600
+
+def refresh_heavy_light (db_cursor, rebuild=False):
+    """
+    Args:
+    db_cursor   Database cursor.
+    rebuild     Drop and rebuild the complete table.
+    
+    Maintains the persistent table heavy_light, which pairs the consensus rank 1 heavy chain
+    of each event with its light chain (K or L) of highest n_seq. The highest seq_id already
+    processed is kept in heavy_light_watermark, so that a refresh only processes events
+    with sequences added since the last refresh.
+    Sequences changed or deleted below the watermark (e.g. a new consensus_rank or
+    consensus_stats.n_seq) are not noticed, run with rebuild=True after such edits.
+    The light chain is selected by a group-wise maximum (GROUP BY event_id) instead of a self
+    anti-join, ties in n_seq are resolved by the lower seq_id.
+    The refresh holds a named lock (GET_LOCK) and reads the watermark after taking it, so that
+    concurrent runs never insert the same events twice.
+    """
+    db_cursor.execute("SELECT DATABASE();")
+    lock_name = "%s.heavy_light" % (db_cursor.fetchall()[0][0])
+    db_cursor.execute("SELECT GET_LOCK(%s, %s);", (lock_name, heavy_light_lock_timeout))
+    if db_cursor.fetchall()[0][0] != 1:
+        raise RuntimeError("Timeout waiting for the lock %s held by a concurrent run" % (lock_name))
+    try:
+        db_cursor.execute("SHOW TABLES LIKE 'heavy_light_watermark';")
+        if rebuild or not db_cursor.fetchall():
+            db_cursor.execute("DROP TABLE IF EXISTS heavy_light, heavy_light_watermark;")
+    
+        db_cursor.execute("CREATE TABLE IF NOT EXISTS heavy_light ( \
+            event_id int(10) unsigned NOT NULL, \
+            H_seq_id int(10) unsigned NOT NULL, \
+            H_locus char(1) NOT NULL, \
+            KL_seq_id int(10) unsigned NOT NULL, \
+            KL_locus char(1) NOT NULL, \
+            KEY event_id (event_id), \
+            KEY H_seq_id (H_seq_id), \
+            KEY KL_seq_id (KL_seq_id) \
+            );")
+        db_cursor.execute("CREATE TABLE IF NOT EXISTS heavy_light_watermark ( \
+            max_seq_id int(10) unsigned NOT NULL \
+            );")
+    
+        db_cursor.execute("SELECT IFNULL(MAX(max_seq_id), 0) FROM heavy_light_watermark;")
+        last_seq_id = int(db_cursor.fetchall()[0][0])
+        db_cursor.execute("SELECT IFNULL(MAX(seq_id), 0) FROM sequences;")
+        max_seq_id = int(db_cursor.fetchall()[0][0])
+        if max_seq_id <= last_seq_id:
+            return
+    
+        # events touched since the last refresh
+        db_cursor.execute("DROP TEMPORARY TABLE IF EXISTS temp_heavy_light_events, temp_heavy_light_max;")
+        db_cursor.execute("CREATE TEMPORARY TABLE temp_heavy_light_events (PRIMARY KEY (event_id)) AS \
+            SELECT DISTINCT event_id FROM sequences \
+            WHERE seq_id > %d AND seq_id <= %d AND event_id IS NOT NULL;" % (last_seq_id, max_seq_id))
+    
+        # highest n_seq of the light chains per event
+        db_cursor.execute("CREATE TEMPORARY TABLE temp_heavy_light_max (PRIMARY KEY (event_id)) AS \
+            SELECT sequences.event_id, MAX(n_seq) AS n_seq FROM sequences \
+            JOIN temp_heavy_light_events ON temp_heavy_light_events.event_id = sequences.event_id \
+            JOIN consensus_stats ON consensus_stats.sequences_seq_id = sequences.seq_id \
+            WHERE (sequences.locus = 'K' OR sequences.locus = 'L') \
+            AND sequences.consensus_rank = 1 \
+            GROUP BY sequences.event_id;")
+    
+        db_cursor.execute("DELETE heavy_light FROM heavy_light \
+            JOIN temp_heavy_light_events ON temp_heavy_light_events.event_id = heavy_light.event_id;")
+        db_cursor.execute("INSERT INTO heavy_light (event_id, H_seq_id, H_locus, KL_seq_id, KL_locus) \
+            SELECT sequences.event_id, sequences.seq_id, sequences.locus, \
+            light.seq_id, light.locus \
+            FROM \
+            (SELECT sequences.event_id, MIN(sequences.seq_id) AS seq_id FROM sequences \
+            JOIN consensus_stats ON consensus_stats.sequences_seq_id = sequences.seq_id \
+            JOIN temp_heavy_light_max ON temp_heavy_light_max.event_id = sequences.event_id \
+            AND temp_heavy_light_max.n_seq = consensus_stats.n_seq \
+            WHERE (sequences.locus = 'K' OR sequences.locus = 'L') \
+            AND sequences.consensus_rank = 1 \
+            GROUP BY sequences.event_id) AS max_light \
+            JOIN sequences AS light ON light.seq_id = max_light.seq_id \
+            JOIN sequences ON sequences.event_id = max_light.event_id \
+            AND sequences.locus = 'H' AND sequences.consensus_rank = 1;")
+    
+        db_cursor.execute("DELETE FROM heavy_light_watermark;")
+        db_cursor.execute("INSERT INTO heavy_light_watermark (max_seq_id) VALUES (%d);" % (max_seq_id))
+        db_cursor.execute("DROP TEMPORARY TABLE IF EXISTS temp_heavy_light_events, temp_heavy_light_max;")
+        db_cursor.connection.commit()
+    except:
+        db_cursor.connection.rollback()
+        raise
+    finally:
+        db_cursor.execute("SELECT RELEASE_LOCK(%s);", (lock_name,))
+        db_cursor.fetchall()
 
 def create_temp_heavy_light (db_cursor):
-    create_statement = "CREATE TABLE IF NOT EXISTS heavy_light AS ( \
-        SELECT sequences.event_id, sequences.seq_id as H_seq_id, sequences.locus as H_locus, \
-        max_light.seq_id as KL_seq_id, max_light.locus as KL_locus \
-        FROM \
-        (SELECT s1.event_id, s1.locus, s1.seq_id FROM \
-        (SELECT sequences.event_id, sequences.locus, sequences.seq_id, n_seq FROM sequences \
-        JOIN consensus_stats \
-        ON consensus_stats.sequences_seq_id = sequences.seq_id \
-        AND (sequences.locus = 'K' OR sequences.locus = 'L') \
-        AND sequences.consensus_rank = 1) as s1 \
-        LEFT JOIN \
-        (SELECT sequences.event_id, sequences.locus, sequences.seq_id, n_seq FROM sequences \
-        JOIN consensus_stats \
-        ON consensus_stats.sequences_seq_id = sequences.seq_id \
-        AND (sequences.locus = 'K' OR sequences.locus = 'L') \
-        AND sequences.consensus_rank = 1) as s2 \
-        ON s1.event_id = s2.event_id \
-        AND s1.n_seq < s2.n_seq \
-        WHERE s2.event_id is NULL \
-        ) as max_light \
-        JOIN sequences ON sequences.event_id = max_light.event_id \
-        AND sequences.locus = 'H' AND sequences.consensus_rank = 1 \
-        );"
-    db_cursor.execute(create_statement)
+    # kept for compatibility, the table is now persistent and refreshed incrementally
+    refresh_heavy_light(db_cursor)
     
 def drop_temp_heavy_light (db_cursor):
-    drop_statement = "DROP TABLE heavy_light;"
-    db_cursor.execute(drop_statement)
+    # kept for compatibility, the persistent table is kept for the next incremental refresh;
+    # use reset_heavy_light to discard it
+    pass
 
-def get_H_isotype (event_id, db_cursor):
-    isotype_statement = "SELECT constant_segments.name FROM constant_segments \
+def reset_heavy_light (db_cursor):
+    """
+    Drop heavy_light and its watermark, the next refresh_heavy_light rebuilds the complete table.
+    """
+    db_cursor.execute("DROP TABLE IF EXISTS heavy_light, heavy_light_watermark;")
+
+def event_list_sql (events):
+    """
+    Return the SQL fragment for an IN (...) clause from either an SQL statement
+    yielding event_ids (or seq_ids) or a list/array of ids.
+    """
+    if isinstance(events, basestring):
+        return events
+    ids = ", ".join("%d" % (int(event_id)) for event_id in events)
+    if not ids:
+        # IN () is invalid SQL, NULL matches nothing
+        ids = "NULL"
+    return ids
+
+def get_H_isotypes (events, db_cursor):
+    """
+    Args:
+    events      SQL statement yielding event_ids or list of event_ids.
+    db_cursor   Database cursor.
+    
+    Returns:
+    isotypes    Dictionary event_id -> name of the heavy chain constant segment.
+                Events without constant segment are missing.
+    """
+    isotype_statement = "SELECT sequences.event_id, constant_segments.name FROM constant_segments \
         JOIN sequences ON sequences.seq_id = constant_segments.seq_id \
-        WHERE locus = 'H' AND consensus_rank = 1 AND event_id = %d;" % (event_id)
+        WHERE locus = 'H' AND consensus_rank = 1 AND sequences.event_id IN (%s) \
+        ORDER BY constant_segments.seq_id;" % (event_list_sql(events))
     db_cursor.execute(isotype_statement)
-    isotype = db_cursor.fetchall()
-    return isotype
+    isotypes = {}
+    for event_id, name in db_cursor.fetchall():
+        isotypes.setdefault(int(event_id), name)
+    return isotypes
 
-def get_mutation_count (event_id, cursor):
-    mutation_statement = "SELECT sum(replacement) + sum(silent) \
-        FROM mutations\
+def get_mutation_counts (events, cursor):
+    """
+    Args:
+    events      SQL statement yielding event_ids or list of event_ids.
+    cursor      Database cursor.
+    
+    Returns:
+    mutations   Dictionary event_id -> number of mutations of the consensus rank 1 sequences.
+                Events without mutations are missing.
+    """
+    mutation_statement = "SELECT sequences.event_id, sum(replacement) + sum(silent) \
+        FROM mutations \
         JOIN sequences ON sequences.seq_id = mutations.seq_id AND sequences.consensus_rank = 1 \
-        WHERE event_id = %d;" % (event_id)
+        WHERE sequences.event_id IN (%s) \
+        GROUP BY sequences.event_id;" % (event_list_sql(events))
     cursor.execute(mutation_statement)
-    try:
-        mutation = cursor.fetchall()[0][0]
-    except IndexError:
-        mutation = 0
-    return int(mutation)
+    return dict((int(event_id), int(mutation)) for event_id, mutation in cursor.fetchall())
 
-def get_mutation_count_seqid (seq_id, cursor):
-    mutation_statement = "SELECT sum(replacement) + sum(silent) \
+def get_mutation_counts_seqid (seq_ids, cursor):
+    """
+    Args:
+    seq_ids     SQL statement yielding seq_ids or list of seq_ids.
+    cursor      Database cursor.
+    
+    Returns:
+    mutations   Dictionary seq_id -> number of mutations. Sequences without mutations are missing.
+    """
+    mutation_statement = "SELECT mutations.seq_id, sum(replacement) + sum(silent) \
         FROM mutations \
-        JOIN sequences ON sequences.seq_id = mutations.seq_id \
-        WHERE sequences.seq_id = %d;" % (seq_id)
+        WHERE mutations.seq_id IN (%s) \
+        GROUP BY mutations.seq_id;" % (event_list_sql(seq_ids))
     cursor.execute(mutation_statement)
-    try:
-        mutation = cursor.fetchall()[0][0]
-        return int(mutation)
-    except TypeError:
-        return 0
-    
\ No newline at end of file
+    return dict((int(seq_id), int(mutation)) for seq_id, mutation in cursor.fetchall())
+
+def get_H_isotype (event_id, db_cursor):
+    isotypes = get_H_isotypes([event_id], db_cursor)
+    if event_id in isotypes:
+        return ((isotypes[event_id],),)
+    return ()
+
+def get_mutation_count (event_id, cursor):
+    return get_mutation_counts([event_id], cursor).get(event_id, 0)
+
+def get_mutation_count_seqid (seq_id, cursor):
+    return get_mutation_counts_seqid([seq_id], cursor).get(seq_id, 0)
+
+# rows per batch of the streaming fetch functions
+default_batch_size = 100000
+
+integer_field_types = set([FIELD_TYPE.TINY, FIELD_TYPE.SHORT, FIELD_TYPE.LONG, FIELD_TYPE.LONGLONG,
+    FIELD_TYPE.INT24, FIELD_TYPE.YEAR])
+float_field_types = set([FIELD_TYPE.FLOAT, FIELD_TYPE.DOUBLE, FIELD_TYPE.DECIMAL, FIELD_TYPE.NEWDECIMAL])
+
+def stream_cursor (connection):
+    """
+    Return a server side cursor (SSCursor) of connection. Its rows are transferred while they
+    are fetched instead of being buffered at execute. All rows of a statement have to be fetched
+    (or the cursor closed) before the connection can be used for the next statement.
+    """
+    return connection.cursor(MySQLdb.cursors.SSCursor)
+
+def column_dtypes (description):
+    """
+    NumPy dtypes of the columns of a cursor description: int64 for integer, float for floating
+    point and decimal columns and str for all others.
+    """
+    dtypes = []
+    for column in description:
+        if column[1] in integer_field_types:
+            dtypes.append(np.int64)
+        elif column[1] in float_field_types:
+            dtypes.append(float)
+        else:
+            dtypes.append(str)
+    return dtypes
+
+def batch_arrays (rows, dtypes):
+    """
+    Convert rows into one NumPy array per column. NULL becomes -1 in integer columns,
+    NaN in float columns and the empty string in string columns.
+    """
+    arrays = []
+    for i, dtype in enumerate(dtypes):
+        kind = np.dtype(dtype).kind
+        if kind in 'iu':
+            fill = -1
+        elif kind == 'f':
+            fill = np.nan
+        else:
+            fill = ''
+        arrays.append(np.array([fill if row[i] is None else row[i] for row in rows], dtype=dtype))
+    return arrays
+
+def iter_array_batches (statement, db_cursor, dtypes=None, batch_size=default_batch_size):
+    """
+    Args:
+    statement   SQL statement.
+    db_cursor   Database cursor, preferably a stream_cursor to keep the memory use bounded.
+    dtypes      NumPy dtypes of the columns, taken from the cursor description if not given.
+    batch_size  Maximal number of rows per batch.
+    
+    Yields:
+    List of NumPy arrays, one per column, of up to batch_size rows.
+    """
+    db_cursor.execute(statement)
+    if dtypes is None:
+        dtypes = column_dtypes(db_cursor.description)
+    rows = db_cursor.fetchmany(batch_size)
+    while rows:
+        yield batch_arrays(rows, dtypes)
+        rows = db_cursor.fetchmany(batch_size)
+
+def fetch_arrays (statement, db_cursor, dtypes=None, batch_size=default_batch_size):
+    """
+    Fetch the complete result of statement batchwise, as list of NumPy arrays (one per column).
+    Only the typed arrays are kept, not the rows.
+    """
+    batches = list(iter_array_batches(statement, db_cursor, dtypes, batch_size))
+    if dtypes is None:
+        dtypes = column_dtypes(db_cursor.description)
+    if not batches:
+        return [np.array([], dtype=dtype) for dtype in dtypes]
+    return [np.concatenate([batch[i] for batch in batches]) for i in range(len(dtypes))]
+
+def get_flow_matrix (event_statement, channel_names, db_cursor, batch_size=default_batch_size):
+    """
+    Args:
+    event_statement     SQL statement yielding a list of event_ids or list of event_ids.
+    channel_names       List of marker names (flow_meta.marker_name) to load.
+    db_cursor           Database cursor, a stream_cursor keeps the memory use bounded.
+    batch_size          Number of rows fetched at once.
+    
+    Returns:
+    event_ids, flow_matrix as in flow_matrix_from_rows.
+    
+    All values are fetched by a single query instead of one query per event and channel.
+    The rows are converted batchwise into typed arrays, marker names into column indexes.
+    """
+    channel_index = dict((name, i) for i, name in enumerate(channel_names))
+    marker_list = ", ".join("'%s'" % (name) for name in channel_names)
+    flow_statement = "SELECT flow.event_id, marker_name, value FROM flow \
+        JOIN flow_meta ON flow.channel_id = flow_meta.channel_id \
+        WHERE flow.event_id IN (%s) AND marker_name IN (%s);" % (event_list_sql(event_statement), marker_list)
+    
+    event_id_batches = [np.zeros(0, dtype=np.int64)]
+    col_batches = [np.zeros(0, dtype=int)]
+    value_batches = [np.zeros(0, dtype=float)]
+    for event_ids, marker_names, values in iter_array_batches(flow_statement, db_cursor, 
+                                                              [np.int64, object, float], batch_size):
+        markers, marker_codes = np.unique(marker_names, return_inverse=True)
+        event_id_batches.append(event_ids)
+        col_batches.append(np.array([channel_index[marker] for marker in markers], dtype=int)[marker_codes])
+        value_batches.append(values)
+    
+    event_ids, rows = np.unique(np.concatenate(event_id_batches), return_inverse=True)
+    flow_matrix = np.empty((len(event_ids), len(channel_names)))
+    flow_matrix.fill(np.nan)
+    flow_matrix[rows, np.concatenate(col_batches)] = np.concatenate(value_batches)
+    
+    return event_ids, flow_matrix
+
+def flow_matrix_from_rows (flow_rows, channel_names):
+    """
+    Args:
+    flow_rows           Rows (event_id, marker_name, value).
+    channel_names       List of marker names, defines the column order.
+    
+    Returns:
+    event_ids           Sorted NumPy array of all event_ids with at least one flow value.
+    flow_matrix         NumPy array (events x channels) of flow values, ordered like
+                        event_ids and channel_names. Missing values are NaN.
+    """
+    channel_index = dict((name, i) for i, name in enumerate(channel_names))
+    event_ids = np.unique(np.array([row[0] for row in flow_rows], dtype=np.int64))
+    flow_matrix = np.empty((len(event_ids), len(channel_names)))
+    flow_matrix.fill(np.nan)
+    if len(flow_rows) > 0:
+        rows = np.searchsorted(event_ids, np.array([row[0] for row in flow_rows], dtype=np.int64))
+        cols = np.array([channel_index[row[1]] for row in flow_rows])
+        flow_matrix[rows, cols] = np.array([row[2] for row in flow_rows], dtype=float)
+    
+    return event_ids, flow_matrix
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+igdb_report.py
+
+Batch runner generating the plots of a report in one process. The plotting scripts are imported
+as modules and run one after another, so that they share the interpreter, the connection pool
+of igdb_connection, the event sets materialized by igdb_queries and opened snapshots.
+
+The manifest lists one plot job per line: the name of the plotting script followed by its
+command line arguments. Empty lines and lines starting with # are ignored, e.g.
+
+    # V gene usage of the heavy chain
+    segment_usage.py healthy_donors.events -d igdb -l H -g V -p stacked -o report
+    region_lengths.py healthy_donors.events -d igdb -l H -r CDR3 -o report
+    shm_distribution.py healthy_donors.events -d igdb -l H -o report
+
+usage: igdb_report.py [-h] [-k] [-Q PROFILE] [--profile-explain] manifest
+
+positional arguments:
+  manifest              File listing the plot jobs.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -k, --keep-going      Continue with the next job if a job fails.
+  -Q PROFILE, --profile PROFILE
+                        Write the SQL statement profile of all jobs to PROFILE at exit.
+  --profile-explain     Add the EXPLAIN FORMAT=JSON plan of each SELECT to the profile.
+"""
+
+import argparse
+import importlib
+import shlex
+import sys
+import traceback
+import igdb_queries as igdbq
+from datetime import datetime as dt
+
+# plotting scripts that can be run from a manifest
+report_scripts = ['segment_usage', 'region_lengths', 'heatmap_segment_usage', 'plot_index_data',
+                  'shm_distribution']
+
+def read_manifest (manifest):
+    """
+    Returns:
+    List of jobs (script name, argument list) of the manifest.
+    """
+    jobs = []
+    for line in open(manifest, 'r'):
+        if not line.strip() or line.lstrip()[0] == '#':
+            continue
+        words = shlex.split(line)
+        script = words[0]
+        if script.endswith('.py'):
+            script = script[:-3]
+        if script not in report_scripts:
+            raise ValueError("%s is not a plotting script (%s)" % (words[0], ", ".join(report_scripts)))
+        jobs.append((script, words[1:]))
+    return jobs
+
+def run_job (script, job_args):
+    """
+    Run one plotting script in this process, as if called with job_args on the command line.
+    """
+    module = importlib.import_module(script)
+    argv = [script + '.py'] + job_args
+    module.run(module.get_parser().parse_args(job_args), argv)
+
+def run_report (jobs, keep_going=False):
+    """
+    Run all jobs in order. Returns the list of failed jobs.
+    """
+    failed = []
+    for i, (script, job_args) in enumerate(jobs):
+        start = dt.now()
+        print "[%d/%d] %s %s" % (i + 1, len(jobs), script, " ".join(job_args))
+        try:
+            run_job(script, job_args)
+        except (Exception, SystemExit):
+            # SystemExit of argparse for invalid job arguments
+            if not keep_going:
+                raise
+            traceback.print_exc()
+            failed.append((script, job_args))
+        print "        done in %.1f s" % ((dt.now() - start).total_seconds())
+    return failed
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("manifest",
+                        type = str,
+                        help="file listing the plot jobs, one script with its arguments per line")
+    parser.add_argument("-k", "--keep-going",
+                        help="continue with the next job if a job fails",
+                        action="store_true")
+    parser.add_argument("-Q", "--profile", type=str,
+                        help="write statistics of the SQL statements of all jobs to this file at exit (.json or .csv)")
+    parser.add_argument("--profile-explain", action="store_true",
+                        help="include the EXPLAIN FORMAT=JSON plan of each SELECT in the profile")
+    args = parser.parse_args()
+
+    if args.profile:
+        igdbq.start_profile(args.profile, args.profile_explain)
+    failed = run_report(read_manifest(args.manifest), args.keep_going)
+    if failed:
+        print "%d of the jobs failed:" % (len(failed))
+        for script, job_args in failed:
+            print "    %s %s" % (script, " ".join(job_args))
+        sys.exit(1)
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+igdb_snapshot.py
+
+Module to export the consensus rank 1 subset of the igdb tables used by the plotting scripts
+into a local columnar snapshot and to run the aggregations of the plotting scripts on it.
+
+A snapshot is a directory with one subdirectory per table and one NumPy .npy file per column,
+which are opened memory-mapped. The event groups of the event file are resolved at export time
+and stored as table event_groups, since the event statements need the database server.
+The plotting scripts use a snapshot instead of the server with the option -s/--snapshot.
+
+usage: igdb_snapshot.py [-h] [-d DATABASE] [-o OUTPUTDIR] event_infile
+
+positional arguments:
+  event_infile          File containing different SQL queries yielding a list of event_ids.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -d DATABASE, --database DATABASE
+                        Database to export.
+  -o OUTPUTDIR, --outputdir OUTPUTDIR
+                        Directory of the snapshot.
+"""
+
+import numpy as np
+import decimal
+import os
+import argparse
+from datetime import datetime as dt
+import igdb_queries as igdbq
+import igdb_connection as igdbconn
+
+lib = 'library_scireptor'
+
+# exported tables, the statements are completed by the library scheme where needed
+export_statements = {
+    'sequences': "SELECT seq_id, event_id, locus FROM sequences WHERE consensus_rank = 1",
+    'VDJ_segments': "SELECT VDJ_segments.seq_id, VDJ_segments.type, VDJ_segments.locus, \
+        seg_family, seg_gene FROM VDJ_segments \
+        JOIN sequences ON sequences.seq_id = VDJ_segments.seq_id AND sequences.consensus_rank = 1 \
+        JOIN %(lib)s.VDJ_library ON VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
+        WHERE igblast_rank = 1",
+    'CDR_FWR': "SELECT CDR_FWR.seq_id, region, prot_length FROM CDR_FWR \
+        JOIN sequences ON sequences.seq_id = CDR_FWR.seq_id AND sequences.consensus_rank = 1",
+    'constant_segments': "SELECT constant_segments.seq_id, name FROM constant_segments \
+        JOIN sequences ON sequences.seq_id = constant_segments.seq_id AND sequences.consensus_rank = 1",
+    'mutations': "SELECT mutations.seq_id, sum(replacement) + sum(silent) AS mutations FROM mutations \
+        JOIN sequences ON sequences.seq_id = mutations.seq_id AND sequences.consensus_rank = 1 \
+        GROUP BY mutations.seq_id",
+    'flow': "SELECT flow.event_id, marker_name, value FROM flow \
+        JOIN flow_meta ON flow.channel_id = flow_meta.channel_id",
+    'heavy_light': "SELECT event_id, H_seq_id, KL_seq_id FROM heavy_light",
+    'event': "SELECT event_id, sort_id, plate_barcode FROM event",
+    'sort': "SELECT sort_id, sample_id, population FROM sort",
+    'sample': "SELECT sample_id, donor_id, tissue FROM sample",
+    'donor': "SELECT donor_id, donor_identifier FROM donor",
+}
+
+def column_array (values):
+    """
+    Convert a list of database values into a NumPy array. Integer columns use -1 for NULL,
+    float columns NaN and string columns the empty string.
+    """
+    non_null = [value for value in values if value is not None]
+    numeric = all(isinstance(value, (int, long, float, decimal.Decimal)) for value in non_null)
+    if non_null and numeric and all(int(value) == value for value in non_null):
+        return np.array([-1 if value is None else int(value) for value in values], dtype=np.int64)
+    if non_null and numeric:
+        return np.array([np.nan if value is None else float(value) for value in values], dtype=float)
+    return np.array(['' if value is None else str(value) for value in values], dtype=str)
+
+def null_strings (values):
+    """
+    Map the empty strings stored for NULL in string columns back to None.
+    """
+    return [None if value == '' else value for value in values]
+
+def write_table (path, name, columns, rows):
+    write_arrays(path, name, columns, [column_array([row[i] for row in rows]) for i in range(len(columns))])
+
+def write_arrays (path, name, columns, arrays):
+    table_path = os.path.join(path, name)
+    if not os.path.isdir(table_path):
+        os.makedirs(table_path)
+    for column, array in zip(columns, arrays):
+        np.save(os.path.join(table_path, column + '.npy'), array)
+
+def export_snapshot (path, db, event_names, event_statements, cursor):
+    """
+    Args:
+    path                Directory of the snapshot.
+    db                  Database.
+    event_names         Names of the event groups.
+    event_statements    Event statements of the event groups.
+    cursor              Database cursor.
+    
+    The tables are streamed by a server side cursor and converted batchwise into typed
+    column arrays (see igdb_queries.fetch_arrays), the rows are never held in memory at once.
+    """
+    igdbq.refresh_heavy_light(cursor)
+    stream_cursor = igdbq.stream_cursor(cursor.connection)
+    for name, statement in export_statements.items():
+        arrays = igdbq.fetch_arrays(statement % {'lib': lib}, stream_cursor)
+        columns = [description[0] for description in stream_cursor.description]
+        write_arrays(path, name, columns, arrays)
+    stream_cursor.close()
+
+    group_rows = []
+    for event_name, event_statement in zip(event_names, event_statements):
+        cursor.execute(event_statement)
+        group_rows += [(event_name, row[0]) for row in cursor.fetchall()]
+    write_table(path, 'event_groups', ['group_name', 'event_id'], group_rows)
+
+    info = open(os.path.join(path, 'snapshot.txt'), 'w')
+    info.write("Snapshot of database %s generated on %s.\n" % (db, dt.now().strftime('%Y-%m-%d %H:%M:%S')))
+    info.close()
+
+# opened snapshots by path, shared by the plots generated in one process
+snapshots = {}
+
+def open_snapshot (path):
+    """
+    Return the Snapshot of path, opened once per process.
+    """
+    path = os.path.abspath(path)
+    if path not in snapshots:
+        snapshots[path] = Snapshot(path)
+    return snapshots[path]
+
+class Snapshot (object):
+    """
+    Read access to a snapshot. Tables are loaded on first use as dictionaries of memory-mapped
+    column arrays. The query functions return rows in the format of the corresponding SQL
+    statements of the plotting scripts.
+    """
+
+    def __init__ (self, path):
+        self.path = path
+        self.tables = {}
+        self.seq_index = None
+
+    def table (self, name):
+        if name not in self.tables:
+            table_path = os.path.join(self.path, name)
+            table = {}
+            for file_name in os.listdir(table_path):
+                if file_name.endswith('.npy'):
+                    table[file_name[:-4]] = np.load(os.path.join(table_path, file_name), mmap_mode='r')
+            self.tables[name] = table
+        return self.tables[name]
+
+    def event_groups (self, event_names):
+        """
+        Return the event_id arrays of the given event groups.
+        """
+        groups = self.table('event_groups')
+        event_groups = []
+        for event_name in event_names:
+            mask = groups['group_name'] == event_name
+            if not mask.any():
+                raise KeyError("Event group %s not found in snapshot %s" % (event_name, self.path))
+            event_groups.append(np.unique(groups['event_id'][mask]))
+        return event_groups
+
+    def seq_ids (self, event_ids, locus=None):
+        """
+        Return the consensus rank 1 seq_ids of the given events, optionally restricted to a locus.
+        """
+        sequences = self.table('sequences')
+        mask = np.in1d(sequences['event_id'], event_ids)
+        if locus is not None:
+            mask &= sequences['locus'] == locus
+        return sequences['seq_id'][mask]
+
+    def segment_rows (self, event_ids, resolve, segment, locus, order):
+        """
+        Rows of the segment usage query of segment_usage.py (count first), ordered by count
+        (order 'cnt') or by name (order 'name').
+        """
+        if resolve == 'constant':
+            constant = self.table('constant_segments')
+            mask = np.in1d(constant['seq_id'], self.seq_ids(event_ids, locus))
+            keys = [(name,) for name in null_strings(constant['name'][mask])]
+        else:
+            vdj = self.table('VDJ_segments')
+            mask = np.in1d(vdj['seq_id'], self.seq_ids(event_ids)) & (vdj['type'] == segment) & (vdj['locus'] == locus)
+            if resolve == 'genes':
+                keys = zip(null_strings(vdj['seg_family'][mask]), null_strings(vdj['seg_gene'][mask]))
+            else:
+                keys = [(family,) for family in null_strings(vdj['seg_family'][mask])]
+        counts = {}
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+        rows = [(count,) + key for key, count in counts.items()]
+        if order == 'cnt':
+            rows.sort(key=lambda row: (-row[0], row[1:]))
+        else:
+            rows.sort(key=lambda row: row[1:])
+        return rows
+
+    def region_length_rows (self, event_ids, region, locus):
+        """
+        Rows (count of sequences, prot_length) of region_lengths.py, ordered by length. Sequences
+        without length are counted in a row with length None, like the NULL group of the query.
+        """
+        cdr_fwr = self.table('CDR_FWR')
+        mask = np.in1d(cdr_fwr['seq_id'], self.seq_ids(event_ids, locus)) & (cdr_fwr['region'] == region)
+        pairs = set(zip(cdr_fwr['seq_id'][mask], cdr_fwr['prot_length'][mask]))
+        lengths, counts = np.unique(np.array([length for seq_id, length in pairs], dtype=np.int64), return_counts=True)
+        rows = [(int(count), int(length)) for count, length in zip(counts, lengths) if length >= 0]
+        if len(lengths) and lengths[0] < 0:
+            rows.insert(0, (int(counts[0]), None))
+        return rows
+
+    def segment_names (self, seg_type, resolve):
+        """
+        Dictionary seq_id -> segment family or family-gene name of the given segment type. Names
+        with a missing part are None, like the NULL result of CONCAT in the query.
+        """
+        vdj = self.table('VDJ_segments')
+        mask = vdj['type'] == seg_type
+        if resolve == 'families':
+            names = null_strings(vdj['seg_family'][mask])
+        else:
+            families = vdj['seg_family'][mask]
+            genes = vdj['seg_gene'][mask]
+            names = np.char.add(np.char.add(families, '-'), genes).astype(object)
+            names[(families == '') | (genes == '')] = None
+        return dict(zip(vdj['seq_id'][mask], names))
+
+    def paired_rows (self, event_ids, resolve, seg_type):
+        """
+        Rows (count, name1, name2) of heatmap_segment_usage.py, ordered by the names.
+        """
+        heavy_light = self.table('heavy_light')
+        mask = np.in1d(heavy_light['event_id'], event_ids)
+        if resolve == 'VJ':
+            v_names = self.segment_names('V', 'genes')
+            j_names = self.segment_names('J', 'families')
+            first_names, first_seq_ids = j_names, heavy_light['H_seq_id'][mask]
+            second_names, second_seq_ids = v_names, heavy_light['H_seq_id'][mask]
+        else:
+            names = self.segment_names(seg_type, resolve)
+            first_names, first_seq_ids = names, heavy_light['H_seq_id'][mask]
+            second_names, second_seq_ids = names, heavy_light['KL_seq_id'][mask]
+        counts = {}
+        for first, second in zip(first_seq_ids, second_seq_ids):
+            if first in first_names and second in second_names:
+                key = (first_names[first], second_names[second])
+                counts[key] = counts.get(key, 0) + 1
+        rows = [(count,) + key for key, count in counts.items()]
+        if resolve == 'VJ':
+            rows.sort(key=lambda row: (row[2], row[1]))
+        else:
+            rows.sort(key=lambda row: row[1:])
+        return rows
+
+    def channel_rows (self, plate_barcode):
+        """
+        Rows (marker_name,) of all channels measured on the given plate.
+        """
+        event = self.table('event')
+        flow = self.table('flow')
+        plate_events = event['event_id'][event['plate_barcode'] == plate_barcode]
+        mask = np.in1d(flow['event_id'], plate_events) & (flow['marker_name'] != 'None')
+        return [(marker,) for marker in np.unique(flow['marker_name'][mask])]
+
+    def flow_rows (self, event_ids, channel_names):
+        """
+        Rows (event_id, marker_name, value) of the given events and channels.
+        """
+        flow = self.table('flow')
+        mask = np.in1d(flow['event_id'], event_ids) & np.in1d(flow['marker_name'], channel_names)
+        return zip(flow['event_id'][mask], flow['marker_name'][mask], flow['value'][mask])
+
+    def positive_event_rows (self, event_ids):
+        """
+        Rows (event_id,) of the given events with paired heavy and light chain.
+        """
+        heavy_light = self.table('heavy_light')
+        return [(event_id,) for event_id in heavy_light['event_id'][np.in1d(heavy_light['event_id'], event_ids)]]
+
+    def event_of_seq (self, seq_ids):
+        """
+        Return the event_ids of the given seq_ids. The sorted seq_id index is built once per snapshot.
+        """
+        if self.seq_index is None:
+            sequences = self.table('sequences')
+            order = np.argsort(sequences['seq_id'], kind='mergesort')
+            self.seq_index = (sequences['seq_id'][order], sequences['event_id'][order])
+        sorted_seq_ids, sorted_event_ids = self.seq_index
+        return sorted_event_ids[np.searchsorted(sorted_seq_ids, seq_ids)]
+
+    def H_isotypes (self, event_ids):
+        """
+        Dictionary event_id -> heavy chain constant segment, as igdb_queries.get_H_isotypes.
+        """
+        constant = self.table('constant_segments')
+        order = np.argsort(constant['seq_id'], kind='mergesort')
+        mask = np.in1d(constant['seq_id'][order], self.seq_ids(event_ids, 'H'))
+        isotype_seq_ids = constant['seq_id'][order][mask]
+        isotypes = {}
+        for event_id, name in zip(self.event_of_seq(isotype_seq_ids), null_strings(constant['name'][order][mask])):
+            isotypes.setdefault(int(event_id), name)
+        return isotypes
+
+    def mutation_counts (self, event_ids):
+        """
+        Dictionary event_id -> number of mutations, as igdb_queries.get_mutation_counts.
+        """
+        mutations = self.table('mutations')
+        mask = np.in1d(mutations['seq_id'], self.seq_ids(event_ids))
+        counts = {}
+        for event_id, count in zip(self.event_of_seq(mutations['seq_id'][mask]), mutations['mutations'][mask]):
+            counts[int(event_id)] = counts.get(int(event_id), 0) + int(count)
+        return counts
+
+    def event_mutation_arrays (self, event_ids, locus):
+        """
+        Number of mutations of every given event with a sequence of locus, as arrays
+        (event_ids, counts). Events without mutations have count 0.
+        """
+        sequences = self.table('sequences')
+        mask = np.in1d(sequences['event_id'], event_ids) & (sequences['locus'] == locus)
+        events, event_codes = np.unique(sequences['event_id'][mask], return_inverse=True)
+        seq_ids = sequences['seq_id'][mask]
+        order = np.argsort(seq_ids)
+        mutations = self.table('mutations')
+        mutation_mask = np.in1d(mutations['seq_id'], seq_ids)
+        positions = order[np.searchsorted(seq_ids, mutations['seq_id'][mutation_mask], sorter=order)]
+        counts = np.bincount(event_codes[positions], weights=mutations['mutations'][mutation_mask],
+                             minlength=len(events))
+        return events, counts.astype(np.int64)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("event_infile",
+                        type = str,
+                        help="File containing different SQL queries yielding a list of event_ids.")
+    parser.add_argument("-d", "--database",
+                        type = str,
+                        help="manual input of database scheme")
+    parser.add_argument("-o", "--outputdir", type=str,
+                        help="directory of the snapshot")
+    args = parser.parse_args()
+
+    db = args.database
+
+    # connect to database via ~/.my.conf settings
+    connection = igdbconn.connect(db)
+    cursor = connection.cursor()
+
+    event_names, event_statements = igdbq.read_eventfile(args.event_infile, db)
+    export_snapshot(args.outputdir, db, event_names, event_statements, cursor)
@@ -4,88 +4,76 @@ import numpy as np
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
-import MySQLdb as mysql
 from datetime import datetime as dt
 import itertools as itt
+import multiprocessing
 import igdb_queries as igdbq
+import igdb_connection as igdbconn
 import igdb_plotting as igdbplt
+import igdb_snapshot as igdbsnap
+import igdb_cache as igdbcache
 from mpl_toolkits.axes_grid1 import ImageGrid
+from matplotlib.backends.backend_pdf import PdfPages
 import argparse
+import sys
 
-# parse arguments
+def get_parser ():
+    parser = argparse.ArgumentParser()
 
-parser = argparse.ArgumentParser()
+    parser.add_argument("event_infile", 
+                        type = str, 
+                        help="File containing different SQL queries yielding a list of event_ids.")
+    parser.add_argument("-d", "--database", 
+                        type = str, 
+                        help="manual input of database scheme")
+    parser.add_argument("-l", "--locus", type=str, 
+                        help="locus H, K, L", 
+                        choices=['H','K','L'])
+    # need to find out which channels to select. Take them from exemplary plate with barcode
+    parser.add_argument("-pb", "--platebarcode", type=str, 
+                        help="plate barcode to select channels that will be displayed")
+    parser.add_argument("-o", "--outputdir", type=str, 
+                        help="directory for pdf output") 
+    parser.add_argument("-m", "--mutation", 
+                       help="Size according to mutation count",
+                       action="store_true")
+    parser.add_argument("-b", "--background", type=str, default='scatter',
+                        help="draw all events as scatter, rasterized scatter or 2D histogram (density)",
+                        choices=['scatter','raster','density'])
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes rendering the channel pair figures")
+    parser.add_argument("--rebuild-heavy-light", action="store_true",
+                        help="rebuild the heavy_light table, needed after sequences were changed or deleted")
+    parser.add_argument("-P", "--multipage",
+                        help="write all channel pairs into one multi-page PDF",
+                        action="store_true")
+    parser.add_argument("-s", "--snapshot", type=str,
+                        help="directory of a snapshot (igdb_snapshot.py) used instead of the database")
+    parser.add_argument("-C", "--cache", type=str, nargs='?', const=igdbcache.default_cache_dir,
+                        help="cache query results on disk (default directory ~/.igdb_cache)")
+    parser.add_argument("-Q", "--profile", type=str,
+                        help="write statistics of all SQL statements to this file at exit (.json or .csv)")
+    parser.add_argument("--profile-explain", action="store_true",
+                        help="include the EXPLAIN FORMAT=JSON plan of each SELECT in the profile")
+    return parser
 
-parser.add_argument("event_infile", 
-                    type = str, 
-                    help="File containing different SQL queries yielding a list of event_ids.")
-parser.add_argument("-d", "--database", 
-                    type = str, 
-                    help="manual input of database scheme")
-parser.add_argument("-l", "--locus", type=str, 
-                    help="locus H, K, L", 
-                    choices=['H','K','L'])
-# need to find out which channels to select. Take them from exemplary plate with barcode
-parser.add_argument("-pb", "--platebarcode", type=str, 
-                    help="plate barcode to select channels that will be displayed")
-parser.add_argument("-o", "--outputdir", type=str, 
-                    help="directory for pdf output") 
-parser.add_argument("-m", "--mutation", 
-                   help="Size according to mutation count",
-                   action="store_true")
-
-args = parser.parse_args()
-
-db = args.database
-locus = args.locus
-plate_barcode = args.platebarcode
-event_infile = args.event_infile
-
-# connect to database via ~/.my.conf settings
-dab = mysql.connect(db=db,read_default_file="~/.my.cnf", read_default_group='mysql_igdb')
-cursor = dab.cursor()
-
-# generate heavy_light table
-igdbq.create_temp_heavy_light(cursor)
-
-# read in event file
-event_names, event_statements = igdbq.read_eventfile(event_infile, db)
-
-def get_null_events (event_statement):
-    # get all the events from one experiment
-    null_events_statement = event_statement
-    cursor.execute(null_events_statement)
-    null_events = cursor.fetchall()
-    return null_events
-
-def get_positive_events (event_statement):
-    # get the event_ids where sequences where amplified
-    events_statement = "SELECT heavy_light.event_id FROM heavy_light \
-        WHERE event_id in (%s) " % (event_statement)   
-    cursor.execute(events_statement)
-    events = cursor.fetchall()
-    return events
-
-def get_channels (plate_barcode):
-    channel_statement = "SELECT marker_name FROM flow \
-        JOIN flow_meta \
-        ON flow.channel_id = flow_meta.channel_id \
-        JOIN event ON event.event_id = flow.event_id \
-        WHERE plate_barcode = '%s' and marker_name != 'None' GROUP BY marker_name;" % (plate_barcode)
-    cursor.execute(channel_statement)
-    channels = cursor.fetchall()
-    return channels
-    
 def arcsinh_fct (x):
     x = np.array(x)
     y = np.arcsinh(x/10.)
     return y
 
-channels = get_channels(plate_barcode)
+axis_limits = arcsinh_fct([-10**2, 10**5])
 
-for combi in itt.combinations(channels, 2):
-    # INITIATE PLOTTING INSTANCE
-    F = plt.figure(1,(9.5, 5.5))
+def plot_channel_pair (combi, figure_data):
+    """
+    Draw the figure of one channel pair (indices into channel_names) for all event groups.
+    figure_data is the dictionary of the flow data of the event groups set up by plot_index_data.
+    """
+    event_names = figure_data['event_names']
+    channel_names = figure_data['channel_names']
+    group_data = figure_data['group_data']
+    # INITIATE PLOTTING INSTANCE, a new figure per channel pair
+    F = plt.figure(figsize=(9.5, 5.5))
     
     grid = ImageGrid(F, 111,
               nrows_ncols = (1, len(event_names)),
@@ -94,112 +82,212 @@ for combi in itt.combinations(channels, 2):
               add_all=True,
               share_all = True,
               )
-    channel1, channel2 = combi
-    grid[0].set_ylabel(channel2[0])
+    index1, index2 = combi
+    channel1, channel2 = channel_names[index1], channel_names[index2]
+    grid[0].set_ylabel(channel2)
     
-    for event_name, event_statement, ax in zip(event_names, event_statements, grid):
+    for event_name, (flow_matrix, positive_mask, colors, sizes), ax in zip(event_names, group_data, grid):
         
-        null_events = get_null_events(event_statement)
+        x_values = flow_matrix[:, index1]
+        y_values = flow_matrix[:, index2]
+        # only events with values in both channels are shown
+        valid = ~np.isnan(x_values) & ~np.isnan(y_values)
         
-        value_channel_dict = {}
-        null_value_channel_dict = {}
+        # plot all events (grey)
+        if figure_data['background'] == 'density':
+            counts, x_edges, y_edges = np.histogram2d(x_values[valid], y_values[valid],
+                                                      bins=100, range=[axis_limits, axis_limits])
+            ax.imshow(np.ma.masked_equal(counts.T, 0), origin='lower', cmap='Greys',
+                      extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]),
+                      aspect='auto', interpolation='none', alpha=0.5)
+        else:
+            ax.scatter(x_values[valid], y_values[valid], color = 'lightgrey', s = 70, alpha=0.3,
+                       rasterized = (figure_data['background'] == 'raster'))
         
-        # plot all events (grey)    
-        for event in null_events:
-            for channel in [channel1[0],channel2[0]]:
-                try:
-                    query_statement = "SELECT value FROM flow \
-                    JOIN flow_meta \
-                    ON flow.channel_id = flow_meta.channel_id \
-                    WHERE event_id = %d and marker_name='%s';" % (int(event[0]),channel)
-                    cursor.execute(query_statement)
-                    value = cursor.fetchall()
-                    value = value[0][0]
-                    
-                    try:
-                        null_value_channel_dict[channel].append(value)
-                    except KeyError:
-                        null_value_channel_dict[channel] = []
-                        null_value_channel_dict[channel].append(value)
-        
-                except IndexError:
-                    next
-        
-        events = get_positive_events(event_statement)        
-        
-        for event in events:
-            for channel in [channel1[0],channel2[0]]:
-                try:
-                    query_statement = "SELECT value FROM flow \
-                    JOIN flow_meta \
-                    ON flow.channel_id = flow_meta.channel_id \
-                    WHERE event_id = %d and marker_name='%s';" % (int(event[0]),channel)
-                    cursor.execute(query_statement)
-                    value = cursor.fetchall()
-                    value = value[0][0]
-                    
-                    try:
-                        value_channel_dict[channel].append(value)
-                    except KeyError:
-                        value_channel_dict[channel] = []
-                        value_channel_dict[channel].append(value)
-                        
-                    # determine corresponding isotype
-                    if channel == channel1[0]:
-                        isotype = igdbq.get_H_isotype(int(event[0]), cursor)
-                        if isotype:
-                            isotype = isotype[0][0]
-                            try:
-                                color = igdbplt.get_color(isotype)
-                                # some are IGKC???
-                            except KeyError:
-                                    color = 'black'
-                        else: color = 'white'
-                            
-                        try:
-                            value_channel_dict['color'].append(color)
-                        except KeyError:
-                            value_channel_dict['color'] = []
-                            value_channel_dict['color'].append(color)
-                        
-                        factor = 1
-                        if args.mutation == True:
-                            factor = igdbq.get_mutation_count(int(event[0]), cursor)
-                            try:
-                                value_channel_dict['size'].append(factor)
-                            except KeyError:
-                                value_channel_dict['size'] = []
-                                value_channel_dict['size'].append(factor)
-                    
-                
-                except IndexError:
-                    next
-        
-        for x,y in zip(null_value_channel_dict[channel1[0]], null_value_channel_dict[channel2[0]]):
-            #if (x>=0 and y>=0):
-    		ax.scatter(arcsinh_fct(x), arcsinh_fct(y), color = 'lightgrey', s = 70, alpha=0.3)
-        
-        
-        
-        for x,y,c,s in zip(value_channel_dict[channel1[0]], value_channel_dict[channel2[0]], value_channel_dict['color'], value_channel_dict['size']):
-            #if (x>=0 and y>=0):	
-            ax.scatter(arcsinh_fct(x), arcsinh_fct(y), color = c, s = s/len(event_names))
-        ax.set_xlabel(channel1[0] + "\n" + event_name)
+        positive_valid = valid[positive_mask]
+        ax.scatter(x_values[positive_mask & valid], y_values[positive_mask & valid],
+                   color = colors[positive_valid], s = sizes[positive_valid]/len(event_names))
+        ax.set_xlabel(channel1 + "\n" + event_name)
         ticks = [-100, 0,10, 100, 10**3,10**4,10**5]
         tick_labels = ["-1E+02","0","1E+01","1E+02","1E+03", "1E+04", "1E+05"]
         ax.set_xticks(arcsinh_fct(ticks))
         ax.set_xticklabels(tick_labels, size = 7, rotation = 90)
         ax.set_yticks(arcsinh_fct(ticks))
         ax.set_yticklabels(tick_labels, size = 7)
-        ax.set_xlim(arcsinh_fct(-10**2),arcsinh_fct(10**5))
-        ax.set_ylim(arcsinh_fct(-10**2),arcsinh_fct(10**5))
-        plt.show()
+        ax.set_xlim(axis_limits)
+        ax.set_ylim(axis_limits)
+
+    plt.tight_layout()
+    return F
 
-    plt.tight_layout()    
-    plt.savefig(args.outputdir + '/flow_'+args.event_infile[:-7] + '_' +channel1[0]+'_'+channel2[0]+'.pdf')
+# data of the figures currently rendered, read by save_channel_pair in the forked worker processes
+figure_data = {}
+
+def save_channel_pair (combi):
+    F = plot_channel_pair(combi, figure_data)
+    channel1, channel2 = figure_data['channel_names'][combi[0]], figure_data['channel_names'][combi[1]]
+    F.savefig(figure_data['outputdir'] + '/flow_'+figure_data['event_infile'][:-7] + '_' +channel1+'_'+channel2+'.pdf')
+    plt.close(F)
+
+def plot_index_data (args, cursor=None, snapshot=None, flow_cursor=None):
+    """
+    Plot the index sort data of the event groups of args.event_infile for all channel pairs.
+    
+    Args:
+    args        Options as parsed by get_parser.
+    cursor      Database cursor, not used if snapshot is given.
+    snapshot    Optional igdb_snapshot.Snapshot read instead of the database.
+    flow_cursor Optional cursor for the flow values, e.g. igdb_queries.stream_cursor.
+    """
+    db = args.database
+    locus = args.locus
+    plate_barcode = args.platebarcode
+    event_infile = args.event_infile
+    
+    if snapshot is None:
+        # update the persistent heavy_light table with events added since the last run
+        igdbq.refresh_heavy_light(cursor, rebuild=args.rebuild_heavy_light)
+    
+    # read in event file
+    event_names, event_statements = igdbq.read_eventfile(event_infile, db)
+    if snapshot is not None:
+        # event groups were resolved when the snapshot was exported
+        event_statements = snapshot.event_groups(event_names)
+    else:
+        # resolve each event group once into the indexed event_set_members table,
+        # the queries below read the group by its primary key instead of rerunning the statement
+        event_set_ids = igdbq.materialize_event_sets(event_names, event_statements, cursor)
+        event_statements = [igdbq.event_set_statement(event_set_id) for event_set_id in event_set_ids]
+    
+    # serve repeated queries from the on-disk result cache
+    if args.cache and cursor is not None:
+        cursor = igdbcache.QueryCache(db, args.cache).cursor(cursor)
+    if flow_cursor is None:
+        flow_cursor = cursor
+    
+    def get_positive_events (event_statement):
+        # get the event_ids where sequences where amplified
+        if snapshot is not None:
+            return snapshot.positive_event_rows(event_statement)
+        events_statement = "SELECT heavy_light.event_id FROM heavy_light \
+            WHERE event_id in (%s) " % (event_statement)   
+        cursor.execute(events_statement)
+        events = cursor.fetchall()
+        return events
+
+    def get_channels (plate_barcode):
+        if snapshot is not None:
+            return snapshot.channel_rows(plate_barcode)
+        channel_statement = "SELECT marker_name FROM flow \
+            JOIN flow_meta \
+            ON flow.channel_id = flow_meta.channel_id \
+            JOIN event ON event.event_id = flow.event_id \
+            WHERE plate_barcode = '%s' and marker_name != 'None' GROUP BY marker_name;" % (plate_barcode)
+        cursor.execute(channel_statement)
+        channels = cursor.fetchall()
+        return channels
+    
+    channels = get_channels(plate_barcode)
+    channel_names = [channel[0] for channel in channels]
+    
+    # load the flow values of all events once per event group, every channel pair is sliced from these matrices
+    group_data = []
+    for event_name, event_statement in zip(event_names, event_statements):
+    
+        if snapshot is not None:
+            event_ids, flow_matrix = igdbq.flow_matrix_from_rows(snapshot.flow_rows(event_statement, channel_names), channel_names)
+        else:
+            event_ids, flow_matrix = igdbq.get_flow_matrix(event_statement, channel_names, flow_cursor)
+    
+        # events where sequences where amplified
+        positive_ids = np.array([int(event[0]) for event in get_positive_events(event_statement)], dtype=np.int64)
+        positive_mask = np.in1d(event_ids, positive_ids)
+    
+        # isotypes and mutation counts of the whole group in one query each
+        if snapshot is not None:
+            isotypes = snapshot.H_isotypes(event_statement)
+        else:
+            isotypes = igdbq.get_H_isotypes(event_statement, cursor)
+        if args.mutation == True:
+            if snapshot is not None:
+                mutations = snapshot.mutation_counts(event_statement)
+            else:
+                mutations = igdbq.get_mutation_counts(event_statement, cursor)
+    
+        colors = []
+        sizes = []
+        for event_id in event_ids[positive_mask]:
+            # determine corresponding isotype
+            isotype = isotypes.get(int(event_id))
+            if isotype:
+                try:
+                    color = igdbplt.get_color(isotype)
+                    # some are IGKC???
+                except KeyError:
+                    color = 'black'
+            else: color = 'white'
+            colors.append(color)
         
-    plt.close()
+            factor = 1
+            if args.mutation == True:
+                factor = mutations.get(int(event_id), 0)
+            sizes.append(factor)
+    
+        # transform all channels at once, colors are converted to an RGBA array for a single collection
+        group_data.append((arcsinh_fct(flow_matrix), positive_mask,
+                           mpl.colors.colorConverter.to_rgba_array(colors).reshape(-1, 4),
+                           np.array(sizes, dtype=float)))
+    
+    figure_data.clear()
+    figure_data.update(event_names=event_names, channel_names=channel_names, group_data=group_data,
+                       background=args.background, outputdir=args.outputdir, event_infile=event_infile)
+    combis = list(itt.combinations(range(len(channel_names)), 2))
+    
+    if args.multipage:
+        # all channel pairs as pages of one PDF, rendered in this process
+        pdf = PdfPages(args.outputdir + '/flow_'+event_infile[:-7] + '.pdf')
+        for combi in combis:
+            F = plot_channel_pair(combi, figure_data)
+            pdf.savefig(F)
+            plt.close(F)
+        pdf.close()
+    elif args.jobs > 1:
+        # figures are independent, render them in forked worker processes with their own pyplot state
+        pool = multiprocessing.Pool(args.jobs)
+        try:
+            pool.map(save_channel_pair, combis)
+        except:
+            # do not leave running workers behind, e.g. for the next job of igdb_report -k
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+    else:
+        for combi in combis:
+            save_channel_pair(combi)
+
+def run (args, argv=None):
+    """
+    Generate the plots of args with a pooled database connection or from the snapshot of args.
+    """
+    if args.profile:
+        igdbq.start_profile(args.profile, args.profile_explain)
+    if args.snapshot:
+        plot_index_data(args, snapshot=igdbsnap.open_snapshot(args.snapshot))
+    else:
+        with igdbconn.get_pool(args.database).connection() as connection:
+            # flow values are streamed by a server side cursor, unless they are served from the cache
+            flow_cursor = None
+            if not args.cache:
+                flow_cursor = igdbq.instrument(igdbq.stream_cursor(connection))
+            plot_index_data(args, igdbq.instrument(connection.cursor()), flow_cursor=flow_cursor)
 
-# drop temporary heavy_light table
-igdbq.drop_temp_heavy_light(cursor)
+def main (argv=None):
+    if argv is None:
+        argv = sys.argv
+    run(get_parser().parse_args(argv[1:]), argv)
 
+if __name__ == '__main__':
+    main()
@@ -1,88 +1,242 @@
 # -*- coding: utf-8 -*-
 import igdb_plotting as igplt
 import numpy as np
-import MySQLdb as mysql
 import matplotlib.pyplot as plt
 import sys
 import argparse
 import igdb_queries as igdbq
+import igdb_connection as igdbconn
+import igdb_snapshot as igdbsnap
+import igdb_cache as igdbcache
 
-parser = argparse.ArgumentParser()
-parser.add_argument("event_infile", 
-                    type = str, 
-                    help="File containing different SQL queries yielding a list of event_ids.")
-parser.add_argument("-d", "--database", 
-                    type = str, 
-                    help="optional manual input of database, otherwise taken from config")
-parser.add_argument("-n", "--normalize", 
-                    help="normalization to total count", 
-                    action="store_true")
-parser.add_argument("-r", "--region", type=str, 
-                    help="Region of interest. Thought for CDR3, but also others can be plotted.", 
-                    choices=['CDR1','CDR2','CDR3','FR1','FR2','FR3'])
-parser.add_argument("-l", "--locus", type=str, 
-                    help="locus H, K, L", 
-                    choices=['H','K','L'])
-parser.add_argument("-c", "--cumulative",
-                    help="Show cumulative frequencies", 
-                    action="store_true")
-parser.add_argument("-o", "--outputdir", type=str, 
-                    help="directory for pdf output") 
+def get_parser ():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("event_infile", 
+                        type = str, 
+                        help="File containing different SQL queries yielding a list of event_ids.")
+    parser.add_argument("-d", "--database", 
+                        type = str, 
+                        help="optional manual input of database, otherwise taken from config")
+    parser.add_argument("-n", "--normalize", 
+                        help="normalization to total count", 
+                        action="store_true")
+    parser.add_argument("-r", "--region", type=str, 
+                        help="Region of interest. Thought for CDR3, but also others can be plotted.", 
+                        choices=['CDR1','CDR2','CDR3','FR1','FR2','FR3'])
+    parser.add_argument("-l", "--locus", type=str, 
+                        help="locus H, K, L", 
+                        choices=['H','K','L'])
+    parser.add_argument("-c", "--cumulative",
+                        help="Show cumulative frequencies", 
+                        action="store_true")
+    parser.add_argument("-o", "--outputdir", type=str, 
+                        help="directory for pdf output") 
+    parser.add_argument("-s", "--snapshot", type=str,
+                        help="directory of a snapshot (igdb_snapshot.py) used instead of the database")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="accepted for compatibility, has no effect since all event groups are counted by one query")
+    parser.add_argument("-C", "--cache", type=str, nargs='?', const=igdbcache.default_cache_dir,
+                        help="cache query results on disk (default directory ~/.igdb_cache)")
+    parser.add_argument("-a", "--all", action="store_true",
+                        help="plot all regions and loci (or the ones given by -r/-l) as panels of one figure")
+    parser.add_argument("-x", "--explain", action="store_true",
+                        help="warn about queries whose plan reads a table by a full scan")
+    parser.add_argument("-Q", "--profile", type=str,
+                        help="write statistics of all SQL statements to this file at exit (.json or .csv)")
+    parser.add_argument("--profile-explain", action="store_true",
+                        help="include the EXPLAIN FORMAT=JSON plan of each SELECT in the profile")
+    return parser
 
-args = parser.parse_args()
+# regions of CDR_FWR in sequence order and the loci, the panels of --all
+regions = ['FR1', 'CDR1', 'FR2', 'CDR2', 'FR3', 'CDR3']
+loci = ['H', 'K', 'L']
 
-db = args.database
-
-
-# connect to database via ~/.my.conf settings
-connection = mysql.connect(db=db,read_default_file="~/.my.cnf", read_default_group='mysql_igdb')
-cursor = connection.cursor()
+def get_length_cube (event_statements, region_list, locus_list, db, cursor=None, snapshot=None, explain=False):
+    """
+    Count the consensus sequences of all event groups per region, locus and region length
+    with a single scan of CDR_FWR.
+    
+    Args:
+    event_statements    event_set_ids of the event groups, or event_id arrays of a snapshot.
+    region_list         Regions to count.
+    locus_list          Loci to count.
+    
+    Returns:
+    length_cube     Array (event groups x regions x loci x lengths) of counts, the last axis
+                    is indexed by the region length in amino acids.
+    """
+    if snapshot is not None:
+        # the snapshot is evaluated per group in memory, rows are prefixed by the group index
+        cube_rows = []
+        for group_index, event_ids in enumerate(event_statements):
+            for region in region_list:
+                for locus in locus_list:
+                    for count, length in snapshot.region_length_rows(event_ids, region, locus):
+                        cube_rows.append((group_index, region, locus, length, count))
+        group_index_dict = dict((group_index, [group_index]) for group_index in range(len(event_statements)))
+    else:
+        # every event is tagged with its group by the event_set_members join, one scan counts all groups
+        cube_statement = "SELECT event_set.event_set_id, CDR_FWR.region, sequences.locus, CDR_FWR.prot_length, \
+                COUNT(DISTINCT sequences.seq_id) as cnt \
+                FROM %s.CDR_FWR \
+                JOIN %s.sequences ON sequences.seq_id = CDR_FWR.seq_id \
+                AND sequences.consensus_rank = 1 \
+                JOIN %s.event_set_members AS event_set ON event_set.event_id = sequences.event_id \
+                AND event_set.event_set_id IN (%s) \
+                WHERE CDR_FWR.region IN (%s) and sequences.locus IN (%s) \
+                GROUP BY event_set.event_set_id, CDR_FWR.region, sequences.locus, CDR_FWR.prot_length" % (db, db, db, 
+                igdbq.event_list_sql(event_statements), ", ".join("'%s'" % (region) for region in region_list),
+                ", ".join("'%s'" % (locus) for locus in locus_list))
+        if explain:
+            igdbq.check_index_use(cube_statement, cursor)
+        cursor.execute(cube_statement)
+        cube_rows = cursor.fetchall()
+        group_index_dict = igdbq.event_set_groups(event_statements)
+    
+    # sequences without length (NULL, or -1 in columnar data) are not counted
+    cube_rows = [row for row in cube_rows if row[3] is not None and row[3] >= 0]
+    # groups with the same statement share an event_set_id, its rows are counted for each of them
+    cube_rows = [(group_index,) + tuple(row[1:]) for row in cube_rows for group_index in group_index_dict[row[0]]]
+    region_index_dict = dict((region, region_index) for region_index, region in enumerate(region_list))
+    locus_index_dict = dict((locus, locus_index) for locus_index, locus in enumerate(locus_list))
+    group_codes = np.array([row[0] for row in cube_rows], dtype=int)
+    region_codes = np.array([region_index_dict[row[1]] for row in cube_rows], dtype=int)
+    locus_codes = np.array([locus_index_dict[row[2]] for row in cube_rows], dtype=int)
+    length_codes = np.array([row[3] for row in cube_rows], dtype=int)
+    counts = np.array([row[4] for row in cube_rows], dtype=float)
+    
+    n_lengths = length_codes.max() + 1 if len(cube_rows) else 0
+    length_cube = np.zeros((len(event_statements), len(region_list), len(locus_list), n_lengths))
+    np.add.at(length_cube, (group_codes, region_codes, locus_codes, length_codes), counts)
+    return length_cube
 
-# generate event list. Will later on be generated by another program and taken up by pickle (or called as module).
+def length_heights (length_cube, normalize=False, cumulative=False):
+    """
+    Returns:
+    Heights of the length distributions of length_cube, normalized to the total count of each
+    distribution and/or cumulated over the lengths.
+    """
+    heights = length_cube
+    if normalize:
+        totals = heights.sum(axis=-1)[..., np.newaxis]
+        heights = heights / np.maximum(totals, 1)
+    if cumulative:
+        heights = np.cumsum(heights, axis=-1)
+    return heights
 
-event_names, event_statements = igdbq.read_eventfile(args.event_infile, db)
+def plot_length_panel (axes, heights, observed, event_names):
+    """
+    Plot the length distributions (event groups x lengths) of one region and locus over the
+    range of lengths observed in any group.
+    """
+    observed_lengths = np.flatnonzero(observed)
+    if len(observed_lengths) == 0:
+        return
+    lengths = np.arange(observed_lengths[0], observed_lengths[-1] + 1)
+    for event_name, group_heights in zip(event_names, heights):
+        axes.plot(lengths, group_heights[lengths], label = event_name)
 
-def get_region_lengths (event_statement):
+def plot_region_lengths (args, cursor=None, snapshot=None, argv=None):
+    """
+    Plot the region length distributions of the event groups of args.event_infile. With
+    args.all, the distributions of all selected regions and loci are plotted as panels
+    (loci x regions) of one figure.
     
-    region_statement = "SELECT COUNT(DISTINCT sequences.seq_id) as cnt, prot_length \
-            FROM %s.CDR_FWR \
-            JOIN %s.sequences ON sequences.seq_id = CDR_FWR.seq_id \
-            AND sequences.consensus_rank = 1 \
-            JOIN %s.event ON event.event_id = sequences.event_id \
-            WHERE CDR_FWR.region = '%s' and sequences.locus = '%s' \
-            AND event.event_id IN (%s) \
-            GROUP BY prot_length \
-            ORDER BY prot_length ASC" % (db, db, db, args.region, args.locus, event_statement)
-   
-    cursor.execute(region_statement)
-    length_rows = cursor.fetchall()
-
-    length_heights = []
-    lengths = []
+    Args:
+    args        Options as parsed by get_parser.
+    cursor      Database cursor, not used if snapshot is given.
+    snapshot    Optional igdb_snapshot.Snapshot read instead of the database.
+    argv        Command line logged in the plot title, sys.argv if not given.
+    """
+    if argv is None:
+        argv = sys.argv
+    db = args.database
+    if args.all:
+        region_list = [args.region] if args.region else regions
+        locus_list = [args.locus] if args.locus else loci
+    elif args.region and args.locus:
+        region_list = [args.region]
+        locus_list = [args.locus]
+    else:
+        raise ValueError("--region and --locus are required unless --all is given")
+    
+    # generate event list. Will later on be generated by another program and taken up by pickle (or called as module).
+    
+    event_names, event_statements = igdbq.read_eventfile(args.event_infile, db)
+    if snapshot is not None:
+        # event groups were resolved when the snapshot was exported
+        event_statements = snapshot.event_groups(event_names)
+    else:
+        # resolve each event group once into the indexed event_set_members table,
+        # the query below joins it by event_set_id
+        event_statements = igdbq.materialize_event_sets(event_names, event_statements, cursor)
+    
+    # serve repeated queries from the on-disk result cache
+    if args.cache and cursor is not None:
+        cursor = igdbcache.QueryCache(db, args.cache).cursor(cursor)
+    
+    length_cube = get_length_cube(event_statements, region_list, locus_list, db, cursor, snapshot, args.explain)
+    heights = length_heights(length_cube, args.normalize, args.cumulative)
+    observed = length_cube.sum(axis=0) > 0
     
-    for length in length_rows:
-        length_heights.append(length[0])
-        lengths.append(length[1])
-  
-    return length_heights, lengths
-
-#plt.figure()
-for event_name, event_statement in zip(event_names, event_statements):
-    heights,lengths = get_region_lengths(event_statement)
-    if args.normalize:
-        heights = [height/float(sum(heights)) for height in heights]
     if args.cumulative:
-        heights = [sum(heights[:i]) for i in range(len(heights))]
-    plt.plot(lengths, heights, label = event_name)
-plt.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-plt.xlabel("Length of " + args.region + " region in amino acids")
-if args.cumulative:
-    title = "Cumulative frequency"
-else:
-    title = "Observed frequency"
-if args.normalize:
-    title = title + " (normalized)"
+        title = "Cumulative frequency"
+    else:
+        title = "Observed frequency"
+    if args.normalize:
+        title = title + " (normalized)"
     
-plt.ylabel(title)
-ttl = plt.title(igplt.plot_log(args.region + ' region length distribution', sys.argv, db))
-plt.savefig(args.outputdir + "/%s_%s_%s_%s" % (args.event_infile, args.locus, args.region, title) + '.pdf', bbox_extra_artists=(ttl,), bbox_inches='tight')
+    if not args.all:
+        plt.figure()
+        plot_length_panel(plt.gca(), heights[:, 0, 0], observed[0, 0], event_names)
+        plt.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+        plt.xlabel("Length of " + args.region + " region in amino acids")
+        plt.ylabel(title)
+        ttl = plt.title(igplt.plot_log(args.region + ' region length distribution', argv, db))
+        plt.savefig(args.outputdir + "/%s_%s_%s_%s" % (args.event_infile, args.locus, args.region, title) + '.pdf', bbox_extra_artists=(ttl,), bbox_inches='tight')
+        plt.close()
+        return
+    
+    figure, axes = plt.subplots(len(locus_list), len(region_list), squeeze=False, sharey=args.normalize,
+                                figsize=(3.5*len(region_list), 3*len(locus_list)))
+    for locus_index, locus in enumerate(locus_list):
+        for region_index, region in enumerate(region_list):
+            panel = axes[locus_index, region_index]
+            plot_length_panel(panel, heights[:, region_index, locus_index], observed[region_index, locus_index], event_names)
+            panel.set_title("%s %s" % (locus, region))
+            if locus_index == len(locus_list) - 1:
+                panel.set_xlabel("Length in amino acids")
+            if region_index == 0:
+                panel.set_ylabel(title)
+    # legend of the first panel with data, all panels share the groups
+    handles, labels = [], []
+    for panel in axes.flat:
+        if panel.get_lines():
+            handles, labels = panel.get_legend_handles_labels()
+            break
+    lgd = figure.legend(handles, labels, loc='center left', bbox_to_anchor=(1, 0.5))
+    ttl = figure.suptitle(igplt.plot_log('Region length distributions', argv, db), y=1.02)
+    figure.tight_layout()
+    figure.savefig(args.outputdir + "/%s_%s_%s_%s" % (args.event_infile, "".join(locus_list), "-".join(region_list), title) + '.pdf', 
+                   bbox_extra_artists=(lgd, ttl), bbox_inches='tight')
+    plt.close(figure)
+
+def run (args, argv=None):
+    """
+    Generate the plot of args with a pooled database connection or from the snapshot of args.
+    """
+    if args.profile:
+        igdbq.start_profile(args.profile, args.profile_explain)
+    if args.snapshot:
+        plot_region_lengths(args, snapshot=igdbsnap.open_snapshot(args.snapshot), argv=argv)
+    else:
+        with igdbconn.get_pool(args.database).cursor() as cursor:
+            plot_region_lengths(args, igdbq.instrument(cursor), argv=argv)
+
+def main (argv=None):
+    if argv is None:
+        argv = sys.argv
+    run(get_parser().parse_args(argv[1:]), argv)
+
+if __name__ == '__main__':
+    main()
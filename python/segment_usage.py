@@ -41,12 +41,18 @@ optional arguments:
                         Group data by families of a given segment type V or J.
   -g {V,J}, --genes {V,J}
                         Group data by families of a given segment type V or J.
+  -s SNAPSHOT, --snapshot SNAPSHOT
+                        Read the data from a local snapshot created by igdb_snapshot.py.
+  -x, --explain         Check the query plans with EXPLAIN and warn about full table scans.
+  -Q PROFILE, --profile PROFILE
+                        Write time, rows and bytes of every SQL statement, aggregated by
+                        statement fingerprint, to PROFILE (.json or .csv) at exit.
+  --profile-explain     Add the EXPLAIN FORMAT=JSON plan of each SELECT to the profile.
                         
 """
 
 import numpy as np
 import numpy.random as random
-import MySQLdb as mysql
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
@@ -54,198 +60,242 @@ import sys
 import colorsys
 import argparse
 import igdb_queries as igdbq
+import igdb_connection as igdbconn
+import igdb_snapshot as igdbsnap
+import igdb_cache as igdbcache
 import igdb_plotting as igplt
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("event_infile", 
-                    type = str, 
-                    help="File containing different SQL queries yielding a list of event_ids.")
-parser.add_argument("-d", "--database", 
-                    type = str, 
-                    help="optional manual input of database, otherwise taken from config")
-parser.add_argument("-n", "--normalize", 
-                    help="normalization to total count", 
-                    action="store_true")
-parser.add_argument("-p", "--plotstyle", type=str, 
-                    help="plot stacked or hist", 
-                    choices=['stacked','hist'])
-parser.add_argument("-l", "--locus", type=str, 
-                    help="locus H, K, L", 
-                    choices=['H','K','L'])
-group = parser.add_mutually_exclusive_group()
-group.add_argument("-c", "--constant", 
-                   help="resolve constant segments",
-                   action="store_true")
-group.add_argument("-f", "--families", type=str, 
-                   help="resolve families V or J", 
-                   choices=['V','J'])
-group.add_argument("-g", "--genes", type=str, 
-                   help="resolve genes V or J", 
-                   choices=['V','J'])
-parser.add_argument("-o", "--outputdir", type=str, 
-                    help="directory for pdf output") 
-
-args = parser.parse_args()
-
-# get variables
-db = args.database
-
-lib = 'library_scireptor'
-print "Using library scheme %s. Do not use this script if this is not correct." % (lib)
-if args.constant:
-    resolve = 'constant'
-    segment = ""
-elif args.families:
-    resolve = 'families'
-    segment = args.families
-elif args.genes:
-    resolve = 'genes'
-    segment = args.genes
-
-
-# connect to database via ~/.my.conf settings
-connection = mysql.connect(db=db,read_default_file="~/.my.cnf", read_default_group='mysql_igdb')
-cursor = connection.cursor()
-
-# generate event list. Will later on be generated by another program and taken up by pickle (or called as module).
-
-event_names, event_statements = igdbq.read_eventfile(args.event_infile, db)
-
-def get_gene_list (event_statement):
-    if resolve == 'genes':
-        
-        if args.plotstyle == 'hist':
-            order = "ORDER BY cnt DESC;"
-        elif args.plotstyle == 'stacked':
-            order = "ORDER BY seg_family, seg_gene ASC;"
-        
-        gene_statement = "SELECT COUNT(seg_family) as cnt, seg_family, seg_gene \
-            FROM %s.VDJ_segments \
-            JOIN %s.sequences ON sequences.seq_id = VDJ_segments.seq_id \
-            AND sequences.consensus_rank = 1 \
-            JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
-            JOIN %s.event ON event.event_id = sequences.event_id \
-            where igblast_rank=1 and VDJ_segments.type = '%s' AND VDJ_segments.locus = '%s' \
-            AND event.event_id IN (%s) \
-            GROUP BY concat(seg_family, seg_gene) " % (db, db, lib, db, segment, args.locus, event_statement)
-        gene_statement = gene_statement + order            
-        
-            
-    elif resolve == 'families':
+def get_parser ():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("event_infile", 
+                        type = str, 
+                        help="File containing different SQL queries yielding a list of event_ids.")
+    parser.add_argument("-d", "--database", 
+                        type = str, 
+                        help="optional manual input of database, otherwise taken from config")
+    parser.add_argument("-n", "--normalize", 
+                        help="normalization to total count", 
+                        action="store_true")
+    parser.add_argument("-p", "--plotstyle", type=str, 
+                        help="plot stacked or hist", 
+                        choices=['stacked','hist'])
+    parser.add_argument("-l", "--locus", type=str, 
+                        help="locus H, K, L", 
+                        choices=['H','K','L'])
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-c", "--constant", 
+                       help="resolve constant segments",
+                       action="store_true")
+    group.add_argument("-f", "--families", type=str, 
+                       help="resolve families V or J", 
+                       choices=['V','J'])
+    group.add_argument("-g", "--genes", type=str, 
+                       help="resolve genes V or J", 
+                       choices=['V','J'])
+    parser.add_argument("-o", "--outputdir", type=str, 
+                        help="directory for pdf output") 
+    parser.add_argument("-s", "--snapshot", type=str,
+                        help="directory of a snapshot (igdb_snapshot.py) used instead of the database")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="accepted for compatibility, has no effect since all event groups are counted by one query")
+    parser.add_argument("-C", "--cache", type=str, nargs='?', const=igdbcache.default_cache_dir,
+                        help="cache query results on disk (default directory ~/.igdb_cache)")
+    parser.add_argument("-x", "--explain", action="store_true",
+                        help="warn about queries whose plan reads a table by a full scan")
+    parser.add_argument("-Q", "--profile", type=str,
+                        help="write statistics of all SQL statements to this file at exit (.json or .csv)")
+    parser.add_argument("--profile-explain", action="store_true",
+                        help="include the EXPLAIN FORMAT=JSON plan of each SELECT in the profile")
+    return parser
 
-        if args.plotstyle == 'hist':
-            order = "ORDER BY cnt DESC;"
-        elif args.plotstyle == 'stacked':
-            order = "ORDER BY seg_family ASC;"        
-        
-        gene_statement = "SELECT COUNT(seg_family) as cnt, seg_family \
-            FROM %s.VDJ_segments \
-            JOIN %s.sequences ON sequences.seq_id = VDJ_segments.seq_id \
-            AND sequences.consensus_rank = 1 \
-            JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
-            JOIN %s.event ON event.event_id = sequences.event_id \
-            where igblast_rank=1 and VDJ_segments.type = '%s' AND VDJ_segments.locus = '%s' \
-            AND event.event_id IN (%s) \
-            GROUP BY seg_family " % (db, db, lib, db,segment, args.locus, event_statement)
-        gene_statement = gene_statement + order  
-            
-    elif resolve == 'constant':
-
-        if args.plotstyle == 'hist':
-            order = "ORDER BY cnt DESC;"
-        elif args.plotstyle == 'stacked':
-            order = "ORDER BY constant_segments.name ASC;"         
-        
-        gene_statement = "SELECT COUNT(constant_segments.name) as cnt, constant_segments.name \
-            FROM %s.constant_segments \
-            JOIN %s.sequences ON sequences.seq_id = constant_segments.seq_id \
-            AND sequences.consensus_rank = 1 \
-            JOIN %s.event ON event.event_id = sequences.event_id \
-            where sequences.locus = '%s' \
-            AND event.event_id IN (%s) \
-            GROUP BY constant_segments.name " % (db, db, db, args.locus, event_statement)
-        gene_statement = gene_statement + order
-            
-    else: 
-        print "Parameter 'resolve' needs to be either 'genes' or 'families' or 'constant'. Exiting....\n"
-        exit
+def plot_segment_usage (args, cursor=None, snapshot=None, argv=None):
+    """
+    Plot the segment usage of the event groups of args.event_infile.
+    
+    Args:
+    args        Options as parsed by get_parser.
+    cursor      Database cursor, not used if snapshot is given.
+    snapshot    Optional igdb_snapshot.Snapshot read instead of the database.
+    argv        Command line logged in the plot title, sys.argv if not given.
+    """
+    if argv is None:
+        argv = sys.argv
+    # get variables
+    db = args.database
+
+    lib = 'library_scireptor'
+    print "Using library scheme %s. Do not use this script if this is not correct." % (lib)
+    if args.constant:
+        resolve = 'constant'
+        segment = ""
+    elif args.families:
+        resolve = 'families'
+        segment = args.families
+    elif args.genes:
+        resolve = 'genes'
+        segment = args.genes
+
+    # generate event list. Will later on be generated by another program and taken up by pickle (or called as module).
 
-    cursor.execute(gene_statement)
-    gene_rows = cursor.fetchall()
+    event_names, event_statements = igdbq.read_eventfile(args.event_infile, db)
+    if snapshot is not None:
+        # event groups were resolved when the snapshot was exported
+        event_statements = snapshot.event_groups(event_names)
+    else:
+        # resolve each event group once into the indexed event_set_members table,
+        # the query below joins it by event_set_id
+        event_statements = igdbq.materialize_event_sets(event_names, event_statements, cursor)
 
-    gene_heights = []
-    gene_labels = []
+    # serve repeated queries from the on-disk result cache
+    if args.cache and cursor is not None:
+        cursor = igdbcache.QueryCache(db, args.cache).cursor(cursor)
+
+    def get_count_matrix (event_statements, cursor):
+        """
+        Count segment families, genes or constant segments of all event groups at once.
     
-    for gene in gene_rows:
-        gene_heights.append(gene[0])
+        Returns:
+        count_matrix    Array (event groups x labels) of counts.
+        labels          Labels of the columns, ordered by name.
+        """
         if resolve == 'genes':
-            gene_labels.append(gene[1] + '-' + gene[2])
-        if resolve == 'families':
-            gene_labels.append(gene[1])
-        if resolve == 'constant':
-            gene_labels.append(gene[1])
+            label_columns = "seg_family, seg_gene"
+        elif resolve == 'families':
+            label_columns = "seg_family"
+        elif resolve == 'constant':
+            label_columns = "constant_segments.name"
+        else: 
+            print "Parameter 'resolve' needs to be either 'genes' or 'families' or 'constant'. Exiting....\n"
+            exit
+    
+        if snapshot is not None:
+            # the snapshot is evaluated per group in memory, rows are prefixed by the group index
+            group_rows = []
+            for group_index, event_ids in enumerate(event_statements):
+                for row in snapshot.segment_rows(event_ids, resolve, segment, args.locus, 'name'):
+                    group_rows.append((group_index,) + tuple(row))
+            group_index_dict = dict((group_index, [group_index]) for group_index in range(len(event_statements)))
+        else:
+            # every event is tagged with its group by the event_set_members join, one scan counts all groups
+            event_set_join = "JOIN %s.event_set_members AS event_set ON event_set.event_id = sequences.event_id \
+                AND event_set.event_set_id IN (%s)" % (db, igdbq.event_list_sql(event_statements))
+            if resolve == 'constant':
+                group_statement = "SELECT event_set.event_set_id, COUNT(constant_segments.name) as cnt, %s \
+                    FROM %s.constant_segments \
+                    JOIN %s.sequences ON sequences.seq_id = constant_segments.seq_id \
+                    AND sequences.consensus_rank = 1 \
+                    %s \
+                    where sequences.locus = '%s' \
+                    GROUP BY event_set.event_set_id, %s" % (label_columns, db, db, event_set_join, args.locus, label_columns)
+            else:
+                group_statement = "SELECT event_set.event_set_id, COUNT(seg_family) as cnt, %s \
+                    FROM %s.VDJ_segments \
+                    JOIN %s.sequences ON sequences.seq_id = VDJ_segments.seq_id \
+                    AND sequences.consensus_rank = 1 \
+                    JOIN %s.VDJ_library on VDJ_library.VDJ_id = VDJ_segments.VDJ_id \
+                    %s \
+                    where igblast_rank=1 and VDJ_segments.type = '%s' AND VDJ_segments.locus = '%s' \
+                    GROUP BY event_set.event_set_id, %s" % (label_columns, db, db, lib, event_set_join, 
+                                                            segment, args.locus, label_columns)
+            if args.explain:
+                igdbq.check_index_use(group_statement, cursor)
+            cursor.execute(group_statement)
+            group_rows = cursor.fetchall()
+            # groups with the same statement share an event_set_id, its rows are counted for each of them
+            group_index_dict = igdbq.event_set_groups(event_statements)
     
-    return gene_heights, gene_labels 
+        # label keys are sorted like the ORDER BY of the names, e.g. (seg_family, seg_gene)
+        label_keys = sorted(set(tuple(row[2:]) for row in group_rows))
+        label_index_dict = dict((label_key, label_index) for label_index, label_key in enumerate(label_keys))
+        count_matrix = np.zeros((len(event_statements), len(label_keys)))
+        for row in group_rows:
+            for group_index in group_index_dict[row[0]]:
+                count_matrix[group_index, label_index_dict[tuple(row[2:])]] += row[1]
+        labels = ['-'.join(part for part in label_key if part is not None) for label_key in label_keys]
     
-if args.plotstyle == 'hist':
-    for event_statement, event_name in zip(event_statements, event_names):
-        gene_heights, gene_labels = get_gene_list(event_statement)
-        plt.figure(figsize=(0.3*len(gene_labels), 7))
+        return count_matrix, labels
+
+    count_matrix, labels = get_count_matrix(event_statements, cursor)
+
+    if args.plotstyle == 'hist':
+        for group_counts, event_name in zip(count_matrix, event_names):
+            # labels observed in this group, most frequent first
+            order = [label_index for label_index in np.argsort(-group_counts, kind='mergesort') if group_counts[label_index] > 0]
+            gene_heights = group_counts[order]
+            gene_labels = [labels[label_index] for label_index in order]
+            plt.figure(figsize=(0.3*len(gene_labels), 7))
         
-        if args.normalize == True:
-            norm_fact = 1./sum(gene_heights)
-            gene_heights = [height*norm_fact for height in gene_heights]
-            norm = "norm"
-            plt.ylabel("Relative Frequencies")
-        else:
-            norm_fact = 1
-            norm = "abs"
-            plt.ylabel("Absolute frequencies")
+            if args.normalize == True:
+                norm_fact = 1./sum(gene_heights)
+                gene_heights = gene_heights*norm_fact
+                norm = "norm"
+                plt.ylabel("Relative Frequencies")
+            else:
+                norm_fact = 1
+                norm = "abs"
+                plt.ylabel("Absolute frequencies")
     
-        positions = np.arange(0,len(gene_heights),1)    
-        plt.bar(positions, gene_heights, color = 'grey')
-        ticks = plt.xticks(positions + 0.4, gene_labels, rotation = 90, fontsize = 12)
-        ttl = plt.title(event_name + "\n" + igplt.plot_log('Segment usage', sys.argv))
-        plt.savefig("%s_%s_%s_%s_%s_%s_%s" % (args.event_infile, event_name, resolve, segment, args.locus, args.plotstyle, norm) 
-                    + '.pdf', bbox_extra_artists=(ttl,), bbox_inches='tight')
+            positions = np.arange(0,len(gene_heights),1)    
+            plt.bar(positions, gene_heights, color = 'grey')
+            ticks = plt.xticks(positions + 0.4, gene_labels, rotation = 90, fontsize = 12)
+            ttl = plt.title(event_name + "\n" + igplt.plot_log('Segment usage', argv, db))
+            plt.savefig("%s_%s_%s_%s_%s_%s_%s" % (args.event_infile, event_name, resolve, segment, args.locus, args.plotstyle, norm) 
+                        + '.pdf', bbox_extra_artists=(ttl,), bbox_inches='tight')
         
-elif args.plotstyle == 'stacked':
-    plt.figure(figsize=(7, 0.7*len(event_statements))) 
-    label_list = []
-    for event_statement, i in zip(event_statements, range(len(event_statements))):
-        #print event_statement
-        gene_heights, gene_labels = get_gene_list(event_statement)
+    elif args.plotstyle == 'stacked':
+        plt.figure(figsize=(7, 0.7*len(event_statements))) 
         if args.normalize == True:
-            norm_fact = 1./sum(gene_heights)
+            widths = count_matrix / count_matrix.sum(axis=1)[:, np.newaxis]
             plt.xlim(0,1)
             norm = "norm"
         else:
-            norm_fact = 1
+            widths = count_matrix
             norm = "abs"
-        palette = igplt.random_colors(200)
-        bottom = 0
-        for height, label in zip(gene_heights, gene_labels):
-            # make redundant labels dissapear from legend
-            if label not in label_list:
-                label_list.append(label)
-                leg_label = label
-            else: leg_label = ""
-            plt.bar(left = bottom, height = 0.8, width = height*norm_fact, orientation='horizontal', label = leg_label, bottom = i, color = igplt.get_color(label) + (0.8,))
-            
-            bottom = height*norm_fact + bottom
-           
-        
+        # left edge of every bar: cumulative width of the labels before it in the same group
+        lefts = np.cumsum(widths, axis=1) - widths
+        label_list = []
+        for i in range(len(event_statements)):
+            for label_index in np.flatnonzero(count_matrix[i]):
+                label = labels[label_index]
+                # make redundant labels dissapear from legend
+                if label not in label_list:
+                    label_list.append(label)
+                    leg_label = label
+                else: leg_label = ""
+                plt.bar(left = lefts[i, label_index], height = 0.8, width = widths[i, label_index], orientation='horizontal', label = leg_label, bottom = i, color = igplt.get_color(label) + (0.8,))
+    
         # format legend
         if len(label_list) > 15:
             ncol = 2
         else: ncol = 1
-    lgd = plt.legend(loc='center left', bbox_to_anchor=(1, 0.5), ncol = ncol)
-    plt.yticks(np.arange(len(event_names))+0.4, event_names)
-    lbl = plt.xlabel('Counts')
-    plt.ylim(-0.1, len(event_names)-0.1)
-    ttl = plt.title(igplt.plot_log('Segment usage', sys.argv, db))
-    plt.savefig(args.outputdir + "/%s_%s_%s_%s_%s_%s_%s" % (db, args.event_infile, resolve, segment, args.locus, args.plotstyle, norm) + '.pdf', bbox_extra_artists=(ttl,lbl,), bbox_inches='tight')
-else:
-    print "Plot option must be 'hist' or 'stacked'\n"
-    exit
+        lgd = plt.legend(loc='center left', bbox_to_anchor=(1, 0.5), ncol = ncol)
+        plt.yticks(np.arange(len(event_names))+0.4, event_names)
+        lbl = plt.xlabel('Counts')
+        plt.ylim(-0.1, len(event_names)-0.1)
+        ttl = plt.title(igplt.plot_log('Segment usage', argv, db))
+        plt.savefig(args.outputdir + "/%s_%s_%s_%s_%s_%s_%s" % (db, args.event_infile, resolve, segment, args.locus, args.plotstyle, norm) + '.pdf', bbox_extra_artists=(ttl,lbl,), bbox_inches='tight')
+    else:
+        print "Plot option must be 'hist' or 'stacked'\n"
+        exit
+    plt.close('all')
+
+def run (args, argv=None):
+    """
+    Generate the plots of args with a pooled database connection or from the snapshot of args.
+    """
+    if args.profile:
+        igdbq.start_profile(args.profile, args.profile_explain)
+    if args.snapshot:
+        plot_segment_usage(args, snapshot=igdbsnap.open_snapshot(args.snapshot), argv=argv)
+    else:
+        with igdbconn.get_pool(args.database).cursor() as cursor:
+            plot_segment_usage(args, igdbq.instrument(cursor), argv=argv)
+
+def main (argv=None):
+    if argv is None:
+        argv = sys.argv
+    run(get_parser().parse_args(argv[1:]), argv)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+shm_distribution.py
+
+Distribution of somatic hypermutation (SHM) counts of the event groups of an event file. The
+mutation counts of the consensus rank 1 sequences of one locus are loaded for all groups at once
+into NumPy arrays. Per group, the histogram, the median and the mean are computed together with
+bootstrap confidence intervals. The resamples are drawn as one matrix of resample indices per
+chunk, and chunks can be spread over several processes for large cohorts. The plots and a
+tab separated summary are written to the output directory next to the segment usage plots.
+
+usage: shm_distribution.py [-h] [-d DATABASE] [-l {H,K,L}] [-m {total,replacement}] [-n]
+                           [-b BOOTSTRAP] [--confidence CONFIDENCE] [--seed SEED] [-j JOBS]
+                           [-o OUTPUTDIR] [-s SNAPSHOT] [-C [CACHE]] [-x] [-Q PROFILE]
+                           [--profile-explain]
+                           event_infile
+
+positional arguments:
+  event_infile          File containing different SQL queries yielding a list of event_ids.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -d DATABASE, --database DATABASE
+                        Database the event statements refer to.
+  -l {H,K,L}, --locus {H,K,L}
+                        Immunoglobulin locus (default H).
+  -m {total,replacement}, --measure {total,replacement}
+                        Count all mutations (mutations table) or the replacement mutations of the
+                        V segment (derived_mutations_replacement, database only).
+  -n, --normalize       Show relative instead of absolute frequencies in the histogram.
+  -b BOOTSTRAP, --bootstrap BOOTSTRAP
+                        Number of bootstrap resamples (default 1000).
+  --confidence CONFIDENCE
+                        Level of the confidence intervals (default 0.95).
+  --seed SEED           Seed of the resampling, results do not depend on -j.
+  -j JOBS, --jobs JOBS  Number of processes used for the resampling.
+"""
+
+import numpy as np
+import matplotlib as mpl
+mpl.use('Agg')
+import matplotlib.pyplot as plt
+import multiprocessing
+import argparse
+import sys
+import igdb_queries as igdbq
+import igdb_connection as igdbconn
+import igdb_plotting as igdbplt
+import igdb_snapshot as igdbsnap
+import igdb_cache as igdbcache
+
+# resamples drawn at once are limited to about this number of elements of the index matrix
+resample_elements = 10000000
+
+def get_parser ():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("event_infile",
+                        type = str,
+                        help="File containing different SQL queries yielding a list of event_ids.")
+    parser.add_argument("-d", "--database",
+                        type = str,
+                        help="manual input of database scheme")
+    parser.add_argument("-l", "--locus", type=str, default='H',
+                        help="locus H, K, L",
+                        choices=['H','K','L'])
+    parser.add_argument("-m", "--measure", type=str, default='total',
+                        help="all mutations or replacement mutations of the V segment",
+                        choices=['total','replacement'])
+    parser.add_argument("-n", "--normalize",
+                        help="normalization of the histograms to the number of events",
+                        action="store_true")
+    parser.add_argument("-b", "--bootstrap", type=int, default=1000,
+                        help="number of bootstrap resamples")
+    parser.add_argument("--confidence", type=float, default=0.95,
+                        help="level of the bootstrap confidence intervals")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the bootstrap resampling")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes used for the bootstrap resampling")
+    parser.add_argument("-o", "--outputdir", type=str,
+                        help="directory for pdf output")
+    parser.add_argument("-s", "--snapshot", type=str,
+                        help="directory of a snapshot (igdb_snapshot.py) used instead of the database")
+    parser.add_argument("-C", "--cache", type=str, nargs='?', const=igdbcache.default_cache_dir,
+                        help="cache query results on disk (default directory ~/.igdb_cache)")
+    parser.add_argument("-x", "--explain", action="store_true",
+                        help="warn about queries whose plan reads a table by a full scan")
+    parser.add_argument("-Q", "--profile", type=str,
+                        help="write statistics of all SQL statements to this file at exit (.json or .csv)")
+    parser.add_argument("--profile-explain", action="store_true",
+                        help="include the EXPLAIN FORMAT=JSON plan of each SELECT in the profile")
+    return parser
+
+def get_mutation_arrays (event_statements, db, locus, measure='total', cursor=None, snapshot=None, explain=False):
+    """
+    Load the mutation counts of the events of all event groups with one query.
+
+    Args:
+    event_statements    event_set_ids of the event groups, or event_id arrays of a snapshot.
+    locus               Locus of the consensus rank 1 sequences.
+    measure             'total' (mutations table) or 'replacement' (derived_mutations_replacement).
+
+    Returns:
+    List of arrays of the mutation counts of the events of each group. Events with a sequence
+    of locus but without mutations count 0.
+    """
+    if snapshot is not None:
+        if measure != 'total':
+            raise ValueError("Snapshots only contain the total number of mutations")
+        return [snapshot.event_mutation_arrays(event_ids, locus)[1] for event_ids in event_statements]
+
+    if measure == 'total':
+        mutation_join = "LEFT JOIN %s.mutations ON mutations.seq_id = sequences.seq_id" % (db)
+        mutation_column = "IFNULL(SUM(mutations.replacement) + SUM(mutations.silent), 0)"
+    else:
+        mutation_join = "JOIN %s.derived_mutations_replacement AS replacement \
+            ON replacement.seq_id = sequences.seq_id" % (db)
+        mutation_column = "SUM(replacement.repl_mutations)"
+    # every event is tagged with its group by the event_set_members join, one scan loads all groups
+    mutation_statement = "SELECT event_set.event_set_id, sequences.event_id, %s AS mutations \
+        FROM %s.sequences \
+        JOIN %s.event_set_members AS event_set ON event_set.event_id = sequences.event_id \
+        AND event_set.event_set_id IN (%s) \
+        %s \
+        WHERE sequences.consensus_rank = 1 AND sequences.locus = '%s' \
+        GROUP BY event_set.event_set_id, sequences.event_id" % (mutation_column, db, db,
+        igdbq.event_list_sql(event_statements), mutation_join, locus)
+    if explain:
+        igdbq.check_index_use(mutation_statement, cursor)
+    event_set_ids, event_ids, mutations = igdbq.fetch_arrays(mutation_statement, cursor,
+                                                             [np.int64, np.int64, np.int64])
+    return [mutations[event_set_ids == event_set_id] for event_set_id in event_statements]
+
+def mutation_histograms (group_mutations, normalize=False):
+    """
+    Returns:
+    Array (event groups x number of mutations) of the number (or fraction) of events.
+    """
+    n_bins = max([len(mutations) and mutations.max() + 1 for mutations in group_mutations] + [1])
+    histograms = np.array([np.bincount(mutations, minlength=n_bins) for mutations in group_mutations], dtype=float)
+    if normalize:
+        histograms /= np.maximum(histograms.sum(axis=1), 1)[:, np.newaxis]
+    return histograms
+
+def bootstrap_chunk (chunk):
+    """
+    Medians and means of n_resamples resamples of mutations, drawn with the given seed as one
+    matrix (resamples x events) of indices.
+
+    Args:
+    chunk       Tuple (mutations, n_resamples, seed), seed is a sequence of integers.
+    """
+    mutations, n_resamples, seed = chunk
+    random_state = np.random.RandomState(seed)
+    resamples = mutations[random_state.randint(0, len(mutations), size=(n_resamples, len(mutations)))]
+    return np.median(resamples, axis=1), resamples.mean(axis=1)
+
+def bootstrap_chunks (mutations, n_resamples, seed):
+    """
+    Split n_resamples into chunks of at most resample_elements elements. Each chunk is seeded by
+    the sequence (seed..., start of the chunk), so that the resamples do not depend on the number
+    of processes and the streams of different seeds and chunks do not overlap.
+    """
+    chunk_size = max(1, resample_elements // max(len(mutations), 1))
+    return [(mutations, min(chunk_size, n_resamples - start), seed + (start,))
+            for start in range(0, n_resamples, chunk_size)]
+
+def bootstrap_statistics (group_mutations, n_resamples=1000, confidence=0.95, seed=0, jobs=1):
+    """
+    Median and mean of the mutation counts of each group with percentile bootstrap confidence
+    intervals.
+
+    Returns:
+    List of dictionaries with the keys n, median, median_low, median_high, mean, mean_low and
+    mean_high, one per group. Statistics that cannot be computed (no events or no resamples)
+    are NaN.
+    """
+    chunks = []
+    for group_index, mutations in enumerate(group_mutations):
+        if len(mutations):
+            chunks += [(group_index, chunk) for chunk in bootstrap_chunks(mutations, n_resamples, (seed, group_index))]
+    if jobs > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(bootstrap_chunk, [chunk for group_index, chunk in chunks])
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+    else:
+        results = [bootstrap_chunk(chunk) for group_index, chunk in chunks]
+
+    percentiles = [50 * (1 - confidence), 50 * (1 + confidence)]
+    statistics = []
+    for group_index, mutations in enumerate(group_mutations):
+        group_statistics = dict([('n', len(mutations))] + [(key, np.nan) for key in
+                                ['median', 'median_low', 'median_high', 'mean', 'mean_low', 'mean_high']])
+        if len(mutations):
+            group_statistics.update(median=np.median(mutations), mean=mutations.mean())
+        group_results = [result for (chunk_group, chunk), result in zip(chunks, results) if chunk_group == group_index]
+        if group_results:
+            medians = np.concatenate([result[0] for result in group_results])
+            means = np.concatenate([result[1] for result in group_results])
+            group_statistics['median_low'], group_statistics['median_high'] = np.percentile(medians, percentiles)
+            group_statistics['mean_low'], group_statistics['mean_high'] = np.percentile(means, percentiles)
+        statistics.append(group_statistics)
+    return statistics
+
+def write_summary (path, event_names, statistics):
+    summary = open(path, 'w')
+    columns = ['n', 'median', 'median_low', 'median_high', 'mean', 'mean_low', 'mean_high']
+    summary.write("\t".join(['group'] + columns) + "\n")
+    for event_name, group_statistics in zip(event_names, statistics):
+        summary.write("\t".join([event_name] + ["%g" % (group_statistics[column]) for column in columns]) + "\n")
+    summary.close()
+
+def plot_shm_distribution (args, cursor=None, snapshot=None, argv=None):
+    """
+    Plot the mutation count distributions of the event groups of args.event_infile.
+
+    Args:
+    args        Options as parsed by get_parser.
+    cursor      Database cursor, not used if snapshot is given.
+    snapshot    Optional igdb_snapshot.Snapshot read instead of the database.
+    argv        Command line logged in the plot title, sys.argv if not given.
+    """
+    if argv is None:
+        argv = sys.argv
+    db = args.database
+
+    event_names, event_statements = igdbq.read_eventfile(args.event_infile, db)
+    if snapshot is not None:
+        # event groups were resolved when the snapshot was exported
+        event_statements = snapshot.event_groups(event_names)
+    else:
+        # resolve each event group once into the indexed event_set_members table,
+        # the query below joins it by event_set_id
+        event_statements = igdbq.materialize_event_sets(event_names, event_statements, cursor)
+
+    # serve repeated queries from the on-disk result cache
+    if args.cache and cursor is not None:
+        cursor = igdbcache.QueryCache(db, args.cache).cursor(cursor)
+
+    group_mutations = get_mutation_arrays(event_statements, db, args.locus, args.measure, cursor, snapshot, args.explain)
+    histograms = mutation_histograms(group_mutations, args.normalize)
+    statistics = bootstrap_statistics(group_mutations, args.bootstrap, args.confidence, args.seed, args.jobs)
+
+    output_name = args.outputdir + "/%s_%s_%s_shm_%s" % (db, args.event_infile, args.locus, args.measure)
+    write_summary(output_name + '.txt', event_names, statistics)
+
+    figure, (histogram_axes, median_axes) = plt.subplots(1, 2, figsize=(14, max(4, 0.5*len(event_names))),
+                                                         gridspec_kw={'width_ratios': [2, 1]})
+    # event groups are not in the segment color table, they get colors of their own
+    group_colors = igdbplt.random_colors(len(event_names))
+    mutation_bins = np.arange(histograms.shape[1])
+    for event_name, histogram, color in zip(event_names, histograms, group_colors):
+        histogram_axes.step(mutation_bins, histogram, where='mid', label=event_name, color=color)
+    histogram_axes.set_xlabel("Number of %s mutations (locus %s)" % (args.measure, args.locus))
+    if args.normalize:
+        histogram_axes.set_ylabel("Relative frequency")
+    else:
+        histogram_axes.set_ylabel("Number of events")
+
+    # medians with their confidence intervals, first group on top like the stacked segment usage
+    positions = np.arange(len(event_names))[::-1]
+    for position, group_statistics, color in zip(positions, statistics, group_colors):
+        median_axes.errorbar(group_statistics['median'], position, fmt='o', color=color,
+                             xerr=[[group_statistics['median'] - group_statistics['median_low']],
+                                   [group_statistics['median_high'] - group_statistics['median']]])
+    median_axes.set_yticks(positions)
+    median_axes.set_yticklabels(["%s (n=%d)" % (event_name, group_statistics['n'])
+                                 for event_name, group_statistics in zip(event_names, statistics)])
+    median_axes.yaxis.tick_right()
+    median_axes.set_ylim(-0.5, len(event_names) - 0.5)
+    median_axes.set_xlabel("Median (%g%% bootstrap CI)" % (100 * args.confidence))
+
+    lgd = histogram_axes.legend(loc='upper right')
+    ttl = figure.suptitle(igdbplt.plot_log('Somatic hypermutation distribution', argv, db), y=1.02)
+    figure.savefig(output_name + '.pdf', bbox_extra_artists=(lgd, ttl), bbox_inches='tight')
+    plt.close(figure)
+
+def run (args, argv=None):
+    """
+    Generate the plot of args with a pooled database connection or from the snapshot of args.
+    """
+    if args.profile:
+        igdbq.start_profile(args.profile, args.profile_explain)
+    if args.snapshot:
+        plot_shm_distribution(args, snapshot=igdbsnap.open_snapshot(args.snapshot), argv=argv)
+    else:
+        with igdbconn.get_pool(args.database).cursor() as cursor:
+            plot_shm_distribution(args, igdbq.instrument(cursor), argv=argv)
+
+def main (argv=None):
+    if argv is None:
+        argv = sys.argv
+    run(get_parser().parse_args(argv[1:]), argv)
+
+if __name__ == '__main__':
+    main()